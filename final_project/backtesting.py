@@ -0,0 +1,219 @@
+"""
+This module contains functions related to backtesting, i.e. the measurement of
+the forecast accuracy with a rolling forecast origin (cutoff)
+
+The module contains the following functions:
+* start_backtest: initializes the worker processes for backtesting
+* get_cutoffs: determines the cutoff dates of a cluster time series
+* get_backtest_tasks: combines clusters and cutoffs to independent tasks
+* mp_backtest: implementation of a single backtesting task
+* export_backtest_metrics: appends error metrics to a csv file
+* summarize_backtest_metrics: aggregates error metrics per cluster and horizon
+"""
+import numpy as np
+from .process import *
+
+
+@dec_validation
+@dec_logger
+def start_backtest(
+    df_traffic, dict_so_cluster, dict_config, cluster_ids, max_processes=32
+):
+    """ Initialize the worker processes for backtesting. Every pair of cluster
+    and cutoff is an independent task; with warm-start all cutoffs of a cluster
+    form one task so that every fit starts from the previous one. Error
+    metrics are written to a csv file as soon as a task is finished.
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param cluster_ids: cluster IDs to be backtested
+    :type cluster_ids: list of ints
+    :param max_processes: upper bound for the number of process
+    :type max_processes: int
+    :return: mean error metrics per cluster and horizon
+    :rtype: pandas DataFrame
+    """
+    n_processes = get_number_processes(max_processes)
+
+    # Pre-process every cluster once and reuse the series for all cutoffs
+    dict_ts_clusters = start_preprocess(
+        df_traffic, dict_so_cluster, dict_config, cluster_ids, max_processes
+    )
+    tasks = get_backtest_tasks(dict_ts_clusters, dict_config)
+
+    # Start a new metrics file
+    fp_metrics = os.path.join(
+        dict_config["dir_results_local"], dict_config["bt_metrics_file"]
+    )
+    if os.path.exists(fp_metrics):
+        os.remove(fp_metrics)
+
+    # Export metrics of every task as soon as it is finished
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [
+            executor.submit(mp_backtest, dict_config, clu_id, df_ts, cutoffs)
+            for clu_id, df_ts, cutoffs in tasks
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            export_backtest_metrics(future.result(), fp_metrics)
+
+    return summarize_backtest_metrics(fp_metrics)
+
+
+@dec_validation
+@dec_logger
+def get_cutoffs(df_ts_cluster, dict_config):
+    """ Determine the cutoff dates of a cluster time series. The last cutoff
+    leaves the largest horizon for evaluation, earlier cutoffs follow every
+    bt_period_days days as long as bt_initial_days days are left for fitting.
+
+    :param df_ts_cluster: cleaned time series of a cluster with DateTimeIndex
+    :type df_ts_cluster: pandas DataFrame
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: sorted list of cutoff dates
+    :rtype: list of pandas Timestamps
+    """
+    if df_ts_cluster.empty:
+        return []
+
+    ts_start = df_ts_cluster.index.min()
+    cutoff = df_ts_cluster.index.max() - pd.Timedelta(
+        days=max(dict_config["bt_horizons"])
+    )
+    cutoff_min = ts_start + pd.Timedelta(days=dict_config["bt_initial_days"])
+
+    cutoffs = []
+    while cutoff >= cutoff_min:
+        cutoffs.append(cutoff)
+        cutoff -= pd.Timedelta(days=dict_config["bt_period_days"])
+
+    return sorted(cutoffs)
+
+
+@dec_validation
+@dec_logger
+def get_backtest_tasks(dict_ts_clusters, dict_config):
+    """ Combine clusters and cutoffs to independent backtesting tasks
+
+    :param dict_ts_clusters: cleaned time series for every cluster
+    :type dict_ts_clusters: Dictionary (cluster ID --> pandas DataFrame)
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: tasks consisting of cluster ID, time series and cutoffs
+    :rtype: list of tuples (int, pandas DataFrame, list of pandas Timestamps)
+    """
+    tasks = []
+    for clu_id, df_ts in dict_ts_clusters.items():
+        cutoffs = get_cutoffs(df_ts, dict_config)
+        if not cutoffs:
+            continue
+
+        # Adjacent cutoffs of a cluster must be fitted one after another for
+        # warm-starts
+        if dict_config.get("bt_warm_start"):
+            tasks.append((clu_id, df_ts, cutoffs))
+        else:
+            tasks.extend((clu_id, df_ts, [cutoff]) for cutoff in cutoffs)
+
+    return tasks
+
+
+def mp_backtest(dict_config, cluster_id, df_ts_cluster, cutoffs):
+    """ Implementation of a single backtesting task, i.e. a forecast for every
+    cutoff of a cluster that is compared to the actual values
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param cluster_id: a specific cluster ID
+    :type cluster_id: int
+    :param df_ts_cluster: cleaned time series of the cluster
+    :type df_ts_cluster: pandas DataFrame
+    :param cutoffs: sorted cutoff dates
+    :type cutoffs: list of pandas Timestamps
+    :return: error metrics for every cutoff and horizon
+    :rtype: pandas DataFrame
+    """
+    logger = configure_logger(dict_config)
+
+    # Forecast the largest horizon after each cutoff
+    dict_config_bt = dict(dict_config, fcst_days=max(dict_config["bt_horizons"]))
+    df_ts_prophet = prepare_forecast(df_ts_cluster)
+
+    list_metrics = []
+    init = None
+    for cutoff in cutoffs:
+        df_train = df_ts_prophet.loc[df_ts_prophet["ds"] <= cutoff]
+
+        # Note: fbprophet requires at least 2 non-NaN rows
+        if df_train["y"].count() < 2:
+            continue
+
+        logger.info(f"> Start backtest cluster ID {cluster_id} cutoff {cutoff:%F}")
+        df_fcst, model = make_forecast(df_train, dict_config_bt, init=init)
+        logger.info(f"+ End backtest cluster ID {cluster_id} cutoff {cutoff:%F}")
+
+        if dict_config.get("bt_warm_start"):
+            init = get_warm_start_params(model)
+
+        df_metrics = calc_error_metrics(
+            df_fcst, df_ts_prophet, cutoff, dict_config["bt_horizons"]
+        )
+        df_metrics["cluster_id"] = cluster_id
+        list_metrics.append(df_metrics)
+
+    if not list_metrics:
+        return pd.DataFrame(
+            columns=["cluster_id", "cutoff", "horizon", "n", "mape", "rmse"]
+        )
+
+    return pd.concat(list_metrics, ignore_index=True)[
+        ["cluster_id", "cutoff", "horizon", "n", "mape", "rmse"]
+    ]
+
+
+@dec_validation
+@dec_logger
+def export_backtest_metrics(df_metrics, fp_metrics):
+    """ Append error metrics to a csv file, which is created if necessary
+
+    :param df_metrics: error metrics
+    :type df_metrics: pandas DataFrame
+    :param fp_metrics: path of csv file
+    :type fp_metrics: str
+    """
+    df_metrics.to_csv(
+        fp_metrics, mode="a", header=not os.path.exists(fp_metrics), index=False
+    )
+
+
+@dec_validation
+@dec_logger
+def summarize_backtest_metrics(fp_metrics):
+    """ Aggregate the error metrics of all cutoffs per cluster and horizon
+
+    :param fp_metrics: path of csv file with error metrics
+    :type fp_metrics: str
+    :return: mean error metrics and number of cutoffs per cluster and horizon
+    :rtype: pandas DataFrame
+    """
+    if not os.path.exists(fp_metrics):
+        return pd.DataFrame(
+            columns=["cluster_id", "horizon", "cutoffs", "mape", "rmse"]
+        )
+
+    df_metrics = pd.read_csv(fp_metrics, parse_dates=["cutoff"])
+
+    return (
+        df_metrics.groupby(["cluster_id", "horizon"])
+        .agg(
+            cutoffs=("cutoff", "count"),
+            mape=("mape", "mean"),
+            rmse=("rmse", "mean"),
+        )
+        .reset_index()
+    )
@@ -0,0 +1,242 @@
+"""
+This module contains functions related to the on-disk cache of the cleaned
+time series of all clusters, i.e. a matrix of dates x clusters which is stored
+as numpy files and opened memory-mapped (zero-copy) by all processes
+
+The module contains the following functions:
+* load_ts_data: loads and cleans the input data or opens the cache if it is
+                up to date
+* get_ts_cache_key: calculates the key of the cache for the current input data
+* get_input_checksums: calculates the checksums of the input files
+* build_ts_matrix: builds the matrix of cleaned time series of all clusters
+* save_ts_matrix: writes the matrix of cleaned time series to the cache
+* open_ts_matrix: opens the matrix of cleaned time series memory-mapped
+* get_cached_ts: returns the cleaned time series of a cluster from the cache
+"""
+import hashlib
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from .quality import *
+
+# Matrices opened by the current process, i.e. cache directory --> matrix
+_dict_ts_matrices = {}
+
+
+@dec_validation
+@dec_logger
+def load_ts_data(dict_config):
+    """ Load the clustering and, unless the cache of cleaned time series is up
+    to date, the traffic data. If the cache is used, its directory is set as
+    "ts_cache" in the config data and the traffic data is not loaded at all.
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: a dictionary with site-to-cluster mapping and a DataFrame with
+             traffic data (None if the cache is used)
+    :rtype tuple (dictionary, DataFrame)
+    """
+    if not dict_config.get("use_ts_cache"):
+        return load_clean_data(dict_config)
+
+    dir_cache = os.path.join(dict_config["dir_cache"], get_ts_cache_key(dict_config))
+
+    # Skip loading and aggregation of the traffic data for a cache hit
+    if os.path.exists(dir_cache):
+        dict_so_cluster = load_clustering(dict_config)
+        df_traffic = None
+    else:
+        dict_so_cluster, df_traffic = load_clean_data(dict_config)
+        dates, cluster_ids, values = build_ts_matrix(
+            df_traffic, dict_so_cluster, dict_config
+        )
+        save_ts_matrix(dates, cluster_ids, values, dir_cache)
+
+    dict_config["ts_cache"] = dir_cache
+
+    return dict_so_cluster, df_traffic
+
+
+@dec_validation
+@dec_logger
+def get_ts_cache_key(dict_config):
+    """ Calculate the key of the cache from the checksums of the traffic and
+    clustering files, the considered period and the config of the cleaning
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: key of the cache
+    :rtype: str
+    """
+    dict_key = dict(
+        get_input_checksums(dict_config),
+        ts_input_start=dict_config["ts_input_start"],
+        ts_input_end=dict_config["ts_input_end"],
+        **get_quality_config(dict_config),
+    )
+
+    return hashlib.sha256(json.dumps(dict_key, sort_keys=True).encode()).hexdigest()[
+        :16
+    ]
+
+
+@dec_validation
+@dec_logger
+def get_input_checksums(dict_config):
+    """ Calculate the checksums of the input files, i.e. the clustering file
+    and the traffic file or the cluster aggregates of the traffic store
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: checksum of every input file (None for a missing file)
+    :rtype: Dictionary
+    """
+    if dict_config.get("use_traffic_store"):
+        fp_traffic = os.path.join(dict_config["dir_store"], "cluster_agg.h5")
+    else:
+        fp_traffic = os.path.join(dict_config["dir_local"], dict_config["f_traffic"])
+    fp_clustering = os.path.join(dict_config["dir_local"], dict_config["f_clustering"])
+
+    dict_checksums = {}
+    for name, fp in [("traffic", fp_traffic), ("clustering", fp_clustering)]:
+        dict_checksums[name] = get_file_checksum(fp) if os.path.exists(fp) else None
+
+    return dict_checksums
+
+
+@dec_validation
+@dec_logger
+def build_ts_matrix(df_traffic, dict_so_cluster, dict_config):
+    """ Build the cleaned time series of all clusters at once, i.e. the same
+    result as make_ts and make_clean_ts for every cluster: days without data
+    between the first and the last day of a cluster are 0, days outside this
+    range are NaN
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex,
+                       either per site or aggregated per cluster
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: dates, cluster IDs and matrix of traffic (dates x clusters)
+    :rtype: tuple (numpy array, numpy array, numpy array)
+    """
+    # Aggregate per cluster and date within the specified period
+    if "cluster_id" not in df_traffic.columns:
+        df_traffic = aggregate_traffic(df_traffic, dict_so_cluster)
+    df_traffic = df_traffic.sort_index().loc[
+        dict_config["ts_input_start"] : dict_config["ts_input_end"]
+    ]
+    df_agg = (
+        df_traffic.groupby([df_traffic.index, "cluster_id"])["gb"].sum().unstack()
+    )
+
+    # Daily dates between the first and the last day of all clusters
+    if df_agg.empty:
+        return (
+            np.array([], dtype="datetime64[D]"),
+            np.array([], dtype="int64"),
+            np.empty((0, 0)),
+        )
+    dates = pd.date_range(df_agg.index.min(), df_agg.index.max(), freq="D")
+    values = df_agg.reindex(dates).values.astype("float64")
+
+    # Fill days without data with 0 between the first and last day of a cluster
+    has_data = ~np.isnan(values)
+    idx_first = has_data.argmax(axis=0)
+    idx_last = len(dates) - 1 - has_data[::-1].argmax(axis=0)
+    idx_dates = np.arange(len(dates))[:, None]
+    in_range = (idx_dates >= idx_first) & (idx_dates <= idx_last)
+    values = np.where(in_range, np.nan_to_num(values), np.nan)
+
+    return (
+        dates.values.astype("datetime64[D]"),
+        df_agg.columns.values.astype("int64"),
+        values,
+    )
+
+
+@dec_validation
+@dec_logger
+def save_ts_matrix(dates, cluster_ids, values, dir_cache):
+    """ Write the matrix of cleaned time series to a cache directory. The
+    matrix is stored column-major, i.e. the time series of a cluster is
+    contiguous on disk.
+
+    :param dates: dates of the matrix rows
+    :type dates: numpy array
+    :param cluster_ids: cluster IDs of the matrix columns
+    :type cluster_ids: numpy array
+    :param values: matrix of traffic (dates x clusters)
+    :type values: numpy array
+    :param dir_cache: cache directory
+    :type dir_cache: str
+    """
+    # Write into a temporary directory first so that a cache is always complete
+    dir_tmp = f"{dir_cache}.tmp{os.getpid()}"
+    os.makedirs(dir_tmp, exist_ok=True)
+    np.save(os.path.join(dir_tmp, "dates.npy"), dates)
+    np.save(os.path.join(dir_tmp, "cluster_ids.npy"), cluster_ids)
+    np.save(os.path.join(dir_tmp, "values.npy"), np.asfortranarray(values))
+
+    try:
+        os.rename(dir_tmp, dir_cache)
+    except OSError:
+        # Cache has been written by another process in the meantime
+        shutil.rmtree(dir_tmp)
+
+
+@dec_validation
+@dec_logger
+def open_ts_matrix(dir_cache):
+    """ Open the matrix of cleaned time series memory-mapped; every process
+    opens a cache directory only once
+
+    :param dir_cache: cache directory
+    :type dir_cache: str
+    :return: dates, dictionary cluster ID --> column and matrix of traffic
+    :rtype: tuple (pandas DatetimeIndex, dictionary, numpy memmap)
+    """
+    if dir_cache not in _dict_ts_matrices:
+        dates = pd.DatetimeIndex(np.load(os.path.join(dir_cache, "dates.npy")))
+        cluster_ids = np.load(os.path.join(dir_cache, "cluster_ids.npy"))
+        values = np.load(os.path.join(dir_cache, "values.npy"), mmap_mode="r")
+        _dict_ts_matrices[dir_cache] = (
+            dates,
+            {clu_id: i for i, clu_id in enumerate(cluster_ids.tolist())},
+            values,
+        )
+
+    return _dict_ts_matrices[dir_cache]
+
+
+@dec_validation
+@dec_logger
+def get_cached_ts(cluster_id, dict_config):
+    """ Get the cleaned time series of a cluster from the cache
+
+    :param cluster_id: a specific cluster ID
+    :type cluster_id: int
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: a cleaned time series for the cluster with respect to data traffic
+    :rtype: pandas DataFrame with DateTimeIndex "dt" and column "gb"
+    """
+    dates, dict_columns, values = open_ts_matrix(dict_config["ts_cache"])
+
+    if cluster_id not in dict_columns:
+        return pd.DataFrame({"gb": []}, index=pd.DatetimeIndex([], name="dt"))
+
+    # Cut the days outside the range of the cluster
+    ts = values[:, dict_columns[cluster_id]]
+    idx = np.flatnonzero(~np.isnan(ts))
+    ts_range = slice(idx[0], idx[-1] + 1) if idx.size else slice(0, 0)
+
+    df_ts_cluster = pd.DataFrame(
+        {"gb": ts[ts_range]}, index=dates[ts_range].rename("dt")
+    )
+    df_ts_cluster.index.freq = "D"
+
+    return df_ts_cluster
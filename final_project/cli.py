@@ -15,20 +15,155 @@ Why does this file exist, and why not put this in __main__?
   Also see (1) from http://click.pocoo.org/5/setuptools/#setuptools-integration
 """
 import argparse
+import collections
+import contextlib
 import datetime
-from .process import *
+import glob
+import re
+from .backtesting import *
+from .service import *
+from .pipeline import *
+from .publish import *
 
-parser = argparse.ArgumentParser()
+
+def parse_shard(value):
+    """ Parse a shard argument of the form "i/n" with 0 <= i < n
+
+    :param value: command line value
+    :type value: str
+    :return: shard index and number of shards
+    :rtype: tuple (int, int)
+    """
+    try:
+        shard_index, n_shards = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard '{value}' is not of the form i/n")
+    if not 0 <= shard_index < n_shards:
+        raise argparse.ArgumentTypeError(f"Shard '{value}' requires 0 <= i < n")
+    return shard_index, n_shards
+
+
+# Selection of the clusters, accepted before and after the subcommands predict
+# and backtest; its defaults are set by parse_arguments, so that a subcommand
+# does not reset a selection given before it
+parser_selection = argparse.ArgumentParser(add_help=False)
+parser_selection.add_argument(
+    "--clusters", dest="cluster_ids", type=int, nargs="+", default=argparse.SUPPRESS
+)
+parser_selection.add_argument(
+    "--shard", dest="shard", type=parse_shard, default=argparse.SUPPRESS
+)
+parser_selection.add_argument(
+    "--shard-strategy",
+    dest="shard_strategy",
+    choices=["hash", "cost"],
+    default=argparse.SUPPRESS,
+)
+
+parser = argparse.ArgumentParser(parents=[parser_selection])
 parser.add_argument("-d", dest="fcst_days", type=int, default=365)
+parser.add_argument("--use-store", dest="use_traffic_store", action="store_true")
+parser.add_argument("--no-data-quality", dest="data_quality", action="store_false")
+parser.add_argument("--routing", dest="routing", action="store_true")
+parser.add_argument("--plot-pack", dest="plot_pack", choices=["pdf", "atlas"])
+parser.add_argument("--model-grid", dest="use_model_grid", action="store_true")
+parser.add_argument("--publish", dest="publish", action="store_true")
+parser.add_argument("--profile-memory", dest="profile_memory", action="store_true")
+parser.add_argument("--mem-budget", dest="mem_budget_mb", type=float)
+parser.add_argument("--dry-run", dest="dry_run", action="store_true")
+parser.add_argument(
+    "--force",
+    dest="force",
+    action="append",
+    default=[],
+    choices=[stage["name"] for stage in get_pipeline_stages()],
+)
+subparsers = parser.add_subparsers(dest="command")
+
+# Merge the result files of several shards into the final result file
+parser_merge = subparsers.add_parser("merge")
+parser_merge.add_argument("filepaths", nargs="*")
+parser_merge.add_argument("-o", dest="filename", default="forecast.h5")
+
+# Forecast one or several horizons with stored models, i.e. without fitting
+parser_predict = subparsers.add_parser("predict", parents=[parser_selection])
+parser_predict.add_argument("-d", dest="horizons", type=int, nargs="+", default=[365])
+
+# Measure the forecast accuracy with a rolling forecast origin
+parser_backtest = subparsers.add_parser("backtest", parents=[parser_selection])
+parser_backtest.add_argument("--horizons", dest="horizons", type=int, nargs="+")
+parser_backtest.add_argument("--warm-start", dest="warm_start", action="store_true")
+
+# Append new daily site records to the local traffic store
+parser_ingest = subparsers.add_parser("ingest")
+parser_ingest.add_argument("filepaths", nargs="*")
+parser_ingest.add_argument("--replace", dest="replace", action="store_true")
+parser_ingest.add_argument("--rebuild", dest="rebuild", action="store_true")
+
+# Answer forecast queries of single clusters via a local HTTP service
+parser_serve = subparsers.add_parser("serve")
+parser_serve.add_argument("--host", dest="host", default="127.0.0.1")
+parser_serve.add_argument("--port", dest="port", type=int, default=8080)
+parser_serve.add_argument("--cache-mb", dest="cache_mb", type=int, default=256)
+
+
+def parse_arguments(arguments=None):
+    """ Parse the command line arguments
+
+    :param arguments: command line arguments (default: sys.argv)
+    :type arguments: list of str
+    :return: parsed command line arguments
+    :rtype: argparse Namespace
+    """
+    namespace = argparse.Namespace(cluster_ids=None, shard=None, shard_strategy="hash")
+    args = parser.parse_args(arguments, namespace=namespace)
+
+    # The cluster aggregates of the traffic store contain no site records
+    if args.use_traffic_store and args.data_quality:
+        parser.error("--use-store requires --no-data-quality")
+
+    return args
 
 
 def main():
     # Get number of days to be forecasted which is at least 0 days
-    args = parser.parse_args()
+    args = parse_arguments()
 
     # Get config data
     dict_config = get_config_data()
     dict_config["fcst_days"] = max(args.fcst_days, 0)
+    dict_config["cluster_ids"] = args.cluster_ids
+    dict_config["shard"] = args.shard
+    dict_config["shard_strategy"] = args.shard_strategy
+    dict_config["use_traffic_store"] = args.use_traffic_store
+    dict_config["data_quality"] = args.data_quality
+    dict_config["routing"] = args.routing
+    dict_config["plot_pack"] = args.plot_pack
+    dict_config["use_model_grid"] = args.use_model_grid
+    dict_config["publish"] = args.publish
+    dict_config["profile_memory"] = args.profile_memory
+    dict_config["mem_budget_mb"] = args.mem_budget_mb
+
+    if args.command == "merge":
+        run_merge(args, dict_config)
+        return
+
+    if args.command == "predict":
+        run_predict(args, dict_config)
+        return
+
+    if args.command == "backtest":
+        run_backtest(args, dict_config)
+        return
+
+    if args.command == "ingest":
+        run_ingest(args, dict_config)
+        return
+
+    if args.command == "serve":
+        configure_logger(dict_config)
+        start_service(dict_config, args.host, args.port, args.cache_mb * 2 ** 20)
+        return
 
     # Init time for program start
     t_start = datetime.datetime.now()
@@ -36,16 +171,223 @@ def main():
     # Create and configure logger
     logger = configure_logger(dict_config)
     logger.info("Program start")
+    if args.profile_memory:
+        reset_memory_profile(dict_config)
 
-    # Download data from AWS, import clustering and traffic data
-    download_data_aws(dict_config)
-    dict_so_cluster, df_traffic = load_data(dict_config)
+    # Run the stages of the workflow whose inputs have changed; consider all
+    # cluster IDs for explicit IDs / shards and export a shard to its own file
+    # to be merged later
+    dict_config["subset"] = not (args.cluster_ids or args.shard)
+    dict_config["f_results"] = get_results_filename(args.shard)
 
-    # Start worker processes
-    df_fcst_results = start_process(df_traffic, dict_so_cluster, dict_config)
+    # Upload results and images in the background while the stages are running
+    publisher = (
+        ResultPublisher(dict_config)
+        if args.publish and not args.dry_run
+        else contextlib.nullcontext()
+    )
+    with publisher:
+        run_pipeline(dict_config, force=args.force, dry_run=args.dry_run)
 
-    # Export data
-    export_fcst_results_hdf5(df_fcst_results, dict_config)
+    if args.profile_memory:
+        logger.info(summarize_memory_profile(dict_config))
 
     # Measure final time and display overall time
     logger.info(f"Program end\nProgram duration: {(datetime.datetime.now() - t_start)}")
+
+
+def get_results_filename(shard=None, horizon=None):
+    """ Get the name of the result file of a run
+
+    :param shard: shard index and number of shards, if any
+    :type shard: tuple (int, int)
+    :param horizon: number of forecast days if several horizons are exported
+    :type horizon: int
+    :return: name of result file
+    :rtype: str
+    """
+    filename = "forecast"
+    if shard:
+        filename += "_shard_{}_of_{}".format(*shard)
+    if horizon is not None:
+        filename += f"_{horizon}d"
+
+    return filename + ".h5"
+
+
+def get_shard_filepaths(dir_results):
+    """ Get the result files of all shards of one sharded run, i.e. the files
+    forecast_shard_i_of_n.h5 for i = 0, ..., n - 1 without horizon suffix
+
+    :param dir_results: folder of the result files
+    :type dir_results: str
+    :return: sorted file paths of the shards
+    :rtype: list of str
+    """
+    pattern = re.compile(r"forecast_shard_(\d+)_of_(\d+)\.h5$")
+    dict_shards = collections.defaultdict(list)
+    for fp in glob.glob(os.path.join(dir_results, "forecast_shard_*.h5")):
+        match = pattern.search(os.path.basename(fp))
+        if match:
+            dict_shards[int(match.group(2))].append((int(match.group(1)), fp))
+
+    # Files of several sharded runs cannot be told apart
+    if len(dict_shards) != 1:
+        raise ValueError(
+            f"Found shard files of {len(dict_shards)} shard counts "
+            f"{sorted(dict_shards)} in {dir_results}; give the files explicitly"
+        )
+    n_shards, shards = dict_shards.popitem()
+    indices = sorted(index for index, _ in shards)
+    if indices != list(range(n_shards)):
+        raise ValueError(
+            f"Shard files of {n_shards} shards with indices {indices} in "
+            f"{dir_results}; every index from 0 to {n_shards - 1} is required once"
+        )
+
+    return [fp for _, fp in sorted(shards)]
+
+
+def run_predict(args, dict_config):
+    """ Forecast one or several horizons with the fitted models of the model
+    store and export one result file per horizon
+
+    :param args: parsed command line arguments
+    :type args: argparse Namespace
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    """
+    t_start = datetime.datetime.now()
+    logger = configure_logger(dict_config)
+    logger.info("Prediction start")
+
+    # Restrict stored models to explicit cluster IDs or one shard
+    horizons = sorted(set(max(horizon, 0) for horizon in args.horizons))
+    stored_ids = get_stored_cluster_ids(dict_config)
+    cluster_ids = stored_ids
+    if args.cluster_ids:
+        cluster_ids = [c for c in stored_ids if c in set(args.cluster_ids)]
+
+    # Clusters without a stored model, e.g. forecasted in bulk by the routing,
+    # cannot be predicted
+    expected_ids = set(args.cluster_ids or [])
+    fp_clustering = os.path.join(dict_config["dir_local"], dict_config["f_clustering"])
+    if not args.cluster_ids and os.path.exists(fp_clustering):
+        expected_ids = set(load_clustering(dict_config).values()) | {-1}
+    missing_ids = sorted(expected_ids - set(stored_ids))
+    if missing_ids:
+        logger.warning(
+            f"No stored models of {len(missing_ids)} clusters, which are not "
+            f"predicted: {missing_ids}"
+        )
+
+    if args.shard:
+        # The cost strategy weights the clusters by their number of sites
+        dict_so_cluster = {}
+        if args.shard_strategy == "cost":
+            dict_so_cluster = load_clustering(dict_config)
+        cluster_ids = get_shard(
+            cluster_ids,
+            dict_so_cluster,
+            args.shard[0],
+            args.shard[1],
+            args.shard_strategy,
+        )
+
+    dict_fcst_results = start_predict(dict_config, horizons, cluster_ids)
+
+    # Export one file per horizon if several horizons are forecasted
+    for horizon, df_fcst_results in dict_fcst_results.items():
+        filename = get_results_filename(
+            args.shard, horizon if len(horizons) > 1 else None
+        )
+        export_fcst_results_hdf5(df_fcst_results, dict_config, filename=filename)
+
+    logger.info(
+        f"Prediction end\nPrediction duration: {(datetime.datetime.now() - t_start)}"
+    )
+
+
+def run_backtest(args, dict_config):
+    """ Measure the forecast accuracy of the selected clusters with a rolling
+    forecast origin and export the error metrics
+
+    :param args: parsed command line arguments
+    :type args: argparse Namespace
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    """
+    t_start = datetime.datetime.now()
+    logger = configure_logger(dict_config)
+    logger.info("Backtest start")
+
+    if args.horizons:
+        dict_config["bt_horizons"] = sorted(set(max(h, 1) for h in args.horizons))
+    dict_config["bt_warm_start"] = args.warm_start
+
+    # Download data from AWS, import clustering and traffic data unless the
+    # cache of cleaned time series is up to date
+    download_data_aws(dict_config)
+    dict_so_cluster, df_traffic = load_ts_data(dict_config)
+
+    # Backtest the selected clusters
+    subset = not (args.cluster_ids or args.shard)
+    cluster_ids = select_cluster_ids(dict_so_cluster, dict_config, subset)
+    df_summary = start_backtest(df_traffic, dict_so_cluster, dict_config, cluster_ids)
+
+    # Export mean error metrics per cluster and horizon
+    fp_summary = os.path.join(dict_config["dir_results_local"], "backtest_summary.csv")
+    df_summary.to_csv(fp_summary, index=False)
+
+    logger.info(
+        f"Backtest end\n{df_summary.groupby('horizon')[['mape', 'rmse']].mean()}\n"
+        f"Backtest duration: {(datetime.datetime.now() - t_start)}"
+    )
+
+
+def run_ingest(args, dict_config):
+    """ Append the daily site records of traffic files to the local traffic
+    store and update the cluster aggregates
+
+    :param args: parsed command line arguments
+    :type args: argparse Namespace
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    """
+    logger = configure_logger(dict_config)
+    logger.info("Ingestion start")
+
+    dict_so_cluster = load_clustering(dict_config)
+
+    # Ingest every file, by default only dates after the last date in the store
+    for fp in args.filepaths:
+        dates = ingest_traffic(
+            pd.read_hdf(fp, "df"), dict_so_cluster, dict_config, not args.replace
+        )
+        logger.info(f"Ingested {len(dates)} dates from {fp}")
+
+    # Recalculate the aggregates e.g. after a change of the clustering
+    if args.rebuild:
+        rebuild_cluster_aggregates(dict_so_cluster, dict_config)
+
+    logger.info("Ingestion end")
+
+
+def run_merge(args, dict_config):
+    """ Merge the result files of several shards into one result file
+
+    :param args: parsed command line arguments
+    :type args: argparse Namespace
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    """
+    logger = configure_logger(dict_config)
+    logger.info("Merge start")
+
+    # Use the shard files of the results folder if no files are given
+    filepaths = args.filepaths or get_shard_filepaths(
+        dict_config["dir_results_local"]
+    )
+    fp_results = merge_fcst_results_hdf5(filepaths, dict_config, args.filename)
+
+    logger.info(f"Merge end\nMerged {len(filepaths)} files into {fp_results}")
@@ -4,15 +4,53 @@ This module contains functions related to input / output of data
 The module contains the following functions:
 * load_data: calls download from AWS S3 and put it into DataFrame & Dictionary
 * download_data_aws: downloads clustering and traffic data from AWS S3
+* upload_results_aws: uploads result files to AWS S3 in parallel
+* upload_file_aws: uploads a single file to AWS S3 unless it is unchanged
 * load_clustering: loads clustering data from a csv file to a dictionary
+* load_cluster_states: loads the German state of every cluster
 * load_traffic: loads data traffic info from hdf file to pandas DataFrame
 * export_fcst_results_hdf5: exports a DataFrame as hdf file
+* merge_fcst_results_hdf5: merges the hdf files of several shards into one file
+* append_fcst_table: appends forecast results to an indexed hdf table
+* read_forecast: reads the forecast results of some clusters and dates
+* read_history_end: reads the end of the history of some clusters
 * prepare_fcst_df: creates a DataFrame in the format necessary for export
 * get_config_data: returns configuration data for the app
 """
+import concurrent.futures
+import threading
 import boto3
+import botocore
+import numpy as np
 import pandas as pd
 from .utils import *
+from .store import *
+from boto3.s3.transfer import TransferConfig
+
+# Abbreviations of the German states by the first two digits of the kgs12 key
+KGS_STATES = {
+    "01": "SH",
+    "02": "HH",
+    "03": "NI",
+    "04": "HB",
+    "05": "NW",
+    "06": "HE",
+    "07": "RP",
+    "08": "BW",
+    "09": "BY",
+    "10": "SL",
+    "11": "BE",
+    "12": "BB",
+    "13": "MV",
+    "14": "SN",
+    "15": "ST",
+    "16": "TH",
+}
+
+# Checksums of the objects uploaded by the current process, i.e. (bucket, key)
+# --> MD5 checksum, to skip unchanged files without a request
+_dict_uploaded = {}
+_lock_uploaded = threading.Lock()
 
 
 @dec_validation
@@ -30,8 +68,12 @@ def load_data(dict_config):
     dict_so_cluster = load_clustering(dict_config)
     assert dict_so_cluster is not None, "Import of clustering data is None."
 
-    # Read data traffic
-    df_traffic = load_traffic(dict_config)
+    # Read data traffic, i.e. the maintained cluster aggregates of the store
+    # or the site records of the traffic file
+    if dict_config.get("use_traffic_store"):
+        df_traffic = load_cluster_aggregates(dict_config)
+    else:
+        df_traffic = load_traffic(dict_config)
     assert df_traffic is not None, "Import of traffic data is None."
 
     return dict_so_cluster, df_traffic
@@ -59,6 +101,10 @@ def download_data_aws(dict_config):
         fp_clustering,
     )
 
+    # The traffic store is updated via ingestion instead of a full download
+    if dict_config.get("use_traffic_store"):
+        return
+
     # Download traffic data
     fp_traffic = os.path.join(dict_config["dir_local"], dict_config["f_traffic"])
     s3.download_file(
@@ -68,6 +114,97 @@ def download_data_aws(dict_config):
     )
 
 
+@dec_validation
+@dec_logger
+def upload_results_aws(dict_config, filepaths):
+    """ Upload local result files (e.g. forecast file and images) to the AWS
+    S3 bucket with a bounded number of threads; large files are uploaded in
+    parts. A file is stored with the path relative to the local data folder,
+    e.g. "fcst_results/forecast.h5" is uploaded as
+    "final_project/fcst_results/forecast.h5".
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param filepaths: paths of local files within the local data folder
+    :type filepaths: list of str
+    :return: keys of the uploaded and of the skipped (unchanged) files
+    :rtype: tuple (list of str, list of str)
+    """
+    # Access S3 bucket; clients are thread-safe
+    s3 = boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+    )
+    transfer_config = TransferConfig(
+        multipart_threshold=dict_config.get("s3_multipart_mb", 64) * 2 ** 20,
+        multipart_chunksize=dict_config.get("s3_multipart_mb", 64) * 2 ** 20,
+        max_concurrency=4,
+    )
+
+    uploaded, skipped = [], []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=dict_config.get("s3_max_workers", 8)
+    ) as executor:
+        dict_futures = {
+            executor.submit(upload_file_aws, s3, fp, dict_config, transfer_config): fp
+            for fp in filepaths
+        }
+        for future in concurrent.futures.as_completed(dict_futures):
+            key, is_uploaded = future.result()
+            (uploaded if is_uploaded else skipped).append(key)
+
+    return sorted(uploaded), sorted(skipped)
+
+
+def upload_file_aws(s3, fp, dict_config, transfer_config=None):
+    """ Upload a single file to the AWS S3 bucket unless the object has the
+    same MD5 checksum, which is stored as metadata "md5" of the object (the
+    ETag of multipart uploads is not the MD5 checksum)
+
+    :param s3: S3 client
+    :type s3: boto3 S3 client
+    :param fp: path of a local file within the local data folder
+    :type fp: str
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param transfer_config: configuration of multipart uploads
+    :type transfer_config: boto3 TransferConfig
+    :return: key of the object and flag indicating if the file was uploaded
+    :rtype: tuple (str, bool)
+    """
+    bucket = dict_config["aws_bucket"]
+    key = "/".join(
+        [dict_config["dir_bucket"]]
+        + os.path.relpath(fp, dict_config["dir_local"]).split(os.sep)
+    )
+    checksum = get_file_checksum(fp)
+
+    # Compare with the checksum of an upload of this process or of the object
+    with _lock_uploaded:
+        checksum_remote = _dict_uploaded.get((bucket, key))
+    if checksum_remote is None:
+        try:
+            checksum_remote = s3.head_object(Bucket=bucket, Key=key)["Metadata"].get(
+                "md5"
+            )
+        except botocore.exceptions.ClientError:
+            checksum_remote = None
+
+    if checksum_remote != checksum:
+        s3.upload_file(
+            fp,
+            bucket,
+            key,
+            ExtraArgs={"Metadata": {"md5": checksum}},
+            Config=transfer_config,
+        )
+    with _lock_uploaded:
+        _dict_uploaded[(bucket, key)] = checksum
+
+    return key, checksum_remote != checksum
+
+
 @dec_validation
 @dec_logger
 def load_clustering(dict_config):
@@ -94,6 +231,33 @@ def load_clustering(dict_config):
     return dict_so_cluster
 
 
+@dec_validation
+@dec_logger
+def load_cluster_states(dict_config):
+    """ Load the German state of every cluster from the municipality keys
+    (kgs12) of its sites, i.e. the state of most of its sites; the first two
+    digits of a key are the state
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: dictionary mapping cluster IDs to state abbreviations (e.g. "BY")
+    :rtype: dictionary
+    """
+    df_clustering = pd.read_csv(
+        os.path.join(dict_config["dir_local"], dict_config["f_clustering"]),
+        sep=";",
+        dtype={"kgs12": str},
+    )
+
+    # Note: leading zeros of the keys may be missing
+    sr_states = (
+        df_clustering["kgs12"].str.zfill(12).str[:2].map(KGS_STATES).dropna()
+    )
+    sr_clusters = df_clustering.loc[sr_states.index, "cluster"]
+
+    return sr_states.groupby(sr_clusters).agg(lambda x: x.mode().iloc[0]).to_dict()
+
+
 @dec_validation
 @dec_logger
 def load_traffic(dict_config, key="df"):
@@ -119,7 +283,8 @@ def load_traffic(dict_config, key="df"):
 @dec_logger
 def export_fcst_results_hdf5(df_fcst_results, dict_config, filename="forecast.h5"):
     """ Writes the content of a DataFrame containing the forecasting results
-    for each cluster into a HDF5 file
+    for each cluster into a compressed HDF5 table indexed by cluster ID, which
+    can be read partially via read_forecast
 
     :param df_fcst_results: DataFrame containing the forecasting results of
                             each cluster
@@ -129,9 +294,188 @@ def export_fcst_results_hdf5(df_fcst_results, dict_config, filename="forecast.h5
     :param filename: name of output file
     :type filename: str
     """
-    # Replace NaN values with 0 and export as hdf file
     fp_results = os.path.join(dict_config["dir_results_local"], filename)
-    df_fcst_results.fillna(0).to_hdf(fp_results, key="df", mode="w")
+    with pd.HDFStore(fp_results, mode="w", complevel=9, complib="blosc") as store:
+        append_fcst_table(store, df_fcst_results)
+
+        # Note: empty results are not written, i.e. the file contains no table
+        if "df" in store:
+            store.create_table_index("df", columns=["cluster_id"], kind="full")
+
+
+@dec_validation
+@dec_logger
+def merge_fcst_results_hdf5(filepaths, dict_config, filename="forecast.h5"):
+    """ Merges the forecasting results of several shards into one HDF5 file.
+    The shard files are read and appended one after another, i.e. only one
+    shard is kept in memory at a time.
+
+    :param filepaths: paths of the hdf files with the results of each shard
+    :type filepaths: list of str
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param filename: name of output file
+    :type filename: str
+    :return: path of the merged output file
+    :rtype: str
+    """
+    fp_results = os.path.join(dict_config["dir_results_local"], filename)
+
+    # Do not read the output file as one of the shards
+    filepaths = [
+        fp for fp in filepaths if os.path.abspath(fp) != os.path.abspath(fp_results)
+    ]
+    if not filepaths:
+        raise ValueError("No shard files to be merged.")
+
+    with pd.HDFStore(fp_results, mode="w", complevel=9, complib="blosc") as store:
+        for fp in sorted(filepaths):
+            with pd.HDFStore(fp, mode="r") as store_shard:
+                if "df" in store_shard:
+                    append_fcst_table(
+                        store,
+                        store_shard.select("df"),
+                        store_shard.select("history_end"),
+                    )
+        if "df" in store:
+            store.create_table_index("df", columns=["cluster_id"], kind="full")
+
+    return fp_results
+
+
+@dec_validation
+@dec_logger
+def append_fcst_table(store, df_fcst_results, df_history_end=None):
+    """ Appends forecasting results to the table "df" of a HDF5 file; values
+    are stored as float32 with NaN values replaced by 0 and "cluster_id" and
+    "ds" are data columns, i.e. can be used for selections. The end of the
+    history of every cluster is appended to the table "history_end".
+
+    :param store: opened HDF5 file
+    :type store: pandas HDFStore
+    :param df_fcst_results: DataFrame containing the forecasting results of
+                            each cluster
+    :type df_fcst_results: pandas DataFrame
+    :param df_history_end: end of the history of every cluster, e.g. of an
+                           exported shard; derived from the original values
+                           of the results if None
+    :type df_history_end: pandas DataFrame
+    """
+    # The last day with an original value, as missing values are stored as 0
+    if df_history_end is None:
+        df_history_end = (
+            pd.DataFrame(
+                {
+                    "cluster_id": df_fcst_results["cluster_id"].values.astype("int64"),
+                    "history_end": pd.to_datetime(df_fcst_results["ds"])
+                    .where(df_fcst_results["y"].notna().values)
+                    .values,
+                }
+            )
+            .groupby("cluster_id", as_index=False)["history_end"]
+            .max()
+        )
+
+    # Columns of the result DataFrame may have object type, e.g. cluster IDs
+    df_export = pd.DataFrame(
+        {
+            "ds": df_fcst_results["ds"].values,
+            "cluster_id": df_fcst_results["cluster_id"].values.astype("int64"),
+        }
+    )
+
+    # Replace NaN values with 0 in the float32 copies of the values
+    for col in df_fcst_results.columns.drop(["ds", "cluster_id"]):
+        values = df_fcst_results[col].values.astype("float32")
+        df_export[col] = np.nan_to_num(values, copy=False)
+
+    store.append(
+        "df",
+        df_export,
+        format="table",
+        data_columns=["ds", "cluster_id"],
+        index=False,
+    )
+    store.append(
+        "history_end",
+        df_history_end,
+        format="table",
+        data_columns=["cluster_id"],
+        index=False,
+    )
+
+
+@dec_validation
+@dec_logger
+def read_forecast(
+    dict_config, cluster_ids=None, start=None, end=None, filename="forecast.h5"
+):
+    """ Reads the forecasting results of some clusters and dates from a HDF5
+    file written by export_fcst_results_hdf5, i.e. only the requested rows are
+    read from disk
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param cluster_ids: cluster IDs to be read; all clusters if None
+    :type cluster_ids: list of ints
+    :param start: first date to be read; no lower bound if None
+    :type start: str or pandas Timestamp
+    :param end: last date to be read; no upper bound if None
+    :type end: str or pandas Timestamp
+    :param filename: name of result file
+    :type filename: str
+    :return: the original and forecasted time series of the clusters; empty
+             if the results are empty
+    :rtype: pandas DataFrame
+    """
+    where = []
+    if cluster_ids is not None:
+        cluster_ids = [int(c) for c in cluster_ids]
+        where.append("cluster_id in cluster_ids")
+    if start is not None:
+        start = pd.Timestamp(start)
+        where.append("ds >= start")
+    if end is not None:
+        end = pd.Timestamp(end)
+        where.append("ds <= end")
+
+    fp_results = os.path.join(dict_config["dir_results_local"], filename)
+    with pd.HDFStore(fp_results, mode="r") as store:
+        # The file of empty results contains no table
+        if "df" not in store:
+            return prepare_fcst_df()
+        return store.select("df", where=" & ".join(where) or None)
+
+
+@dec_validation
+@dec_logger
+def read_history_end(dict_config, cluster_ids=None, filename="forecast.h5"):
+    """ Reads the end of the history, i.e. the last day with an original
+    value, of some clusters from a HDF5 file written by
+    export_fcst_results_hdf5
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param cluster_ids: cluster IDs to be read; all clusters if None
+    :type cluster_ids: list of ints
+    :param filename: name of result file
+    :type filename: str
+    :return: end of the history by cluster ID (NaT for clusters without
+             original values)
+    :rtype: pandas Series
+    """
+    where = None
+    if cluster_ids is not None:
+        cluster_ids = [int(c) for c in cluster_ids]
+        where = "cluster_id in cluster_ids"
+
+    fp_results = os.path.join(dict_config["dir_results_local"], filename)
+    with pd.HDFStore(fp_results, mode="r") as store:
+        if "history_end" not in store:
+            return pd.Series(dtype="datetime64[ns]", name="history_end")
+        df_history_end = store.select("history_end", where=where)
+
+    return df_history_end.set_index("cluster_id")["history_end"]
 
 
 @dec_validation
@@ -159,14 +503,67 @@ def get_config_data():
     dict_config = {
         "f_clustering": "clustering.csv",
         "f_traffic": "traffic_small.h5",
+        "f_results": "forecast.h5",
         "aws_bucket": "cmeier-csci-e-29",
         "dir_bucket": "final_project",
         "dir_local": "./data",
         "dir_results_local": "./data/fcst_results",
         "dir_plot": "./data/fcst_images",
+        "plot_format": "png",
+        "plot_dpi": 100,
+        "plot_pack": None,
+        "plot_atlas_size": 16,
+        "plot_atlas_cols": 4,
+        "dir_models": "./data/fcst_models",
         "dir_logs": "./logs",
+        "dir_store": "./data/traffic_store",
+        "dir_cache": "./data/cache",
+        "use_model_grid": False,
+        "model_grid": [
+            {"name": "multiplicative", "seasonality_mode": "multiplicative"},
+            {"name": "additive", "seasonality_mode": "additive"},
+            {
+                "name": "multiplicative_state",
+                "seasonality_mode": "multiplicative",
+                "holidays": "state",
+            },
+            {
+                "name": "additive_state",
+                "seasonality_mode": "additive",
+                "holidays": "state",
+            },
+        ],
+        "mg_holdout_days": 90,
+        "mg_metric": "mape",
+        "mg_metrics_file": "model_grid_metrics.csv",
+        "profile_memory": False,
+        "mem_top_n": 5,
+        "mem_budget_mb": None,
+        "s3_max_workers": 8,
+        "s3_multipart_mb": 64,
+        "s3_publish_interval": 10,
+        "use_ts_cache": True,
+        "data_quality": True,
+        "dq_window": "Q",
+        "dq_z_threshold": 5,
+        "dq_fill": "median",
+        "dq_report_file": "quality_report.csv",
+        "routing": False,
+        "export_intervals": False,
+        "rt_min_days": 90,
+        "rt_min_coverage": 0.5,
+        "rt_max_zero_ratio": 0.3,
+        "rt_max_cv": 0.05,
+        "rt_season_days": 7,
+        "rt_ses_alpha": 0.3,
+        "use_traffic_store": False,
         "ts_input_start": "2017-07-01",
         "ts_input_end": "2019-12-31",
+        "bt_initial_days": 365,
+        "bt_period_days": 90,
+        "bt_horizons": [30, 90, 180],
+        "bt_warm_start": False,
+        "bt_metrics_file": "backtest_metrics.csv",
     }
 
     return dict_config
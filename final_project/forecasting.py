@@ -7,10 +7,29 @@ The module contains the following functions:
                     necessary for forecasting
 * make_forecast: builds and fits the forecasting model and subsequently makes
                  the forecast
+* build_model: builds the (unfitted) forecasting model of a model variant
+* get_regional_holidays: returns the holidays of a German state
+* forecast_grid: fits several model variants and forecasts with the best one
+* select_variant: returns the index of the most accurate model variant
+* calc_error_metrics: calculates error metrics of a forecast for each horizon
+* get_warm_start_params: returns the parameters of a fitted model for warm-starts
+* predict_forecast: makes the forecast of a fitted model for a number of days
+* save_model: serializes a fitted model into the model store
+* load_model: loads a fitted model from the model store
+* get_model_filepath: returns the file of a model in the model store
+* get_stored_cluster_ids: returns the cluster IDs of all models in the store
 """
+import copy
+import glob
+import gzip
+import pickle
+import re
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from .utils import *
 from fbprophet import Prophet
+from fbprophet.make_holidays import make_holidays_df
 
 
 @dec_validation
@@ -63,35 +82,357 @@ def prepare_forecast(df_ts_cluster):
 
 @dec_validation
 @dec_logger
-def make_forecast(df_ts_prophet, dict_config):
+def make_forecast(df_ts_prophet, dict_config, init=None):
     """ Make forecast for cluster time series using fbprophet package
 
     :param df_ts_prophet: time series of cluster in the required fbprophet format
     :type df_ts_prophet: pandas DataFrame
     :param dict_config: Dictionary with config data
     :type dict_config: Dictionary
+    :param init: parameters of a previously fitted model to warm-start the fit
+    :type init: Dictionary
     :return:  the original and forecasted time series of a cluster as well as
               the corresponding fbporphet model
     :rtype: tuple (pandas DataFrame, fbprophet model)
     """
+    model = build_model()
+
+    if init is None:
+        # Fit model
+        model.fit(df_ts_prophet)
+    else:
+        try:
+            # Fit model starting from the parameters of the previous model
+            model.fit(df_ts_prophet, init=init)
+        except (ValueError, RuntimeError):
+            # The number of parameters differs, e.g. due to other holidays in
+            # the history; a fitted model cannot be fitted again
+            model = build_model()
+            model.fit(df_ts_prophet)
+
+    # Make forecast
+    df_fcst_prophet = predict_forecast(model, dict_config["fcst_days"])
+
+    return df_fcst_prophet, model
+
+
+@dec_validation
+@dec_logger
+def build_model(dict_variant=None, df_holidays=None):
+    """ Build the fbprophet model used for forecasting. By default, the model
+    is multiplicative with yearly seasonality and country-wide German holidays.
+
+    :param dict_variant: model variant, i.e. keyword arguments of Prophet and
+                         optionally "holidays" ("country", "state" or None)
+                         and "name"
+    :type dict_variant: Dictionary
+    :param df_holidays: holidays of the state of the cluster, required for
+                        variants with state holidays
+    :type df_holidays: pandas DataFrame
+    :return: unfitted fbprophet model
+    :rtype: fbprophet model
+    """
+    dict_variant = dict(
+        {
+            "seasonality_mode": "multiplicative",
+            "yearly_seasonality": True,
+            "holidays": "country",
+        },
+        **(dict_variant or {}),
+    )
+    dict_params = {
+        k: v for k, v in dict_variant.items() if k not in ["name", "holidays"]
+    }
+
     # Build fbprophet model with most parameters set as default
-    model = Prophet(seasonality_mode="multiplicative", yearly_seasonality=True,)
+    if dict_variant["holidays"] == "state":
+        model = Prophet(holidays=df_holidays, **dict_params)
+    else:
+        model = Prophet(**dict_params)
 
     # Use country-wide German holidays
-    model.add_country_holidays(country_name="DE")
+    if dict_variant["holidays"] == "country":
+        model.add_country_holidays(country_name="DE")
 
-    # Fit model
+    return model
+
+
+@lru_cache(maxsize=64)
+def get_regional_holidays(state, years):
+    """ Get the holidays of a German state, i.e. the country-wide holidays and
+    the holidays of the state (computed once per process)
+
+    :param state: abbreviation of the state, e.g. "BY" (None for country-wide
+                  holidays only)
+    :type state: str
+    :param years: years of the holidays
+    :type years: tuple of ints
+    :return: holidays with columns "ds" and "holiday"
+    :rtype: pandas DataFrame
+    """
+    return make_holidays_df(year_list=list(years), country="DE", province=state)
+
+
+@dec_validation
+@dec_logger
+def forecast_grid(df_ts_cluster, dict_config, state=None):
+    """ Fit every model variant of the model grid on the time series of a
+    cluster except the last mg_holdout_days days, measure the accuracy on
+    these days and forecast with the best variant fitted on the whole series.
+    The time series and, if a variant uses them, the holidays of the state are
+    prepared only once for all variants. Variants whose fit fails are not
+    selected.
+
+    :param df_ts_cluster: time series of cluster to be forecasted with respect
+                          to traffic data
+    :type df_ts_cluster: pandas DataFrame with DateTimeIndex
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param state: abbreviation of the state of the cluster for state holidays
+    :type state: str
+    :return: the forecasted time series, the fbprophet model of the best
+             variant and the accuracy of every variant
+    :rtype: tuple (pandas DataFrame, fbprophet model, pandas DataFrame)
+    """
+    variants = dict_config["model_grid"]
+    df_ts_prophet = prepare_forecast(df_ts_cluster)
+
+    # Holidays of all years from the start of the history to the forecast end
+    df_holidays = None
+    if any(dict_variant.get("holidays") == "state" for dict_variant in variants):
+        year_end = (
+            df_ts_prophet["ds"].max() + pd.Timedelta(days=dict_config["fcst_days"])
+        ).year
+        df_holidays = get_regional_holidays(
+            state, tuple(range(df_ts_prophet["ds"].min().year, year_end + 1))
+        )
+
+    # Measure the accuracy of every variant on the holdout days
+    cutoff = df_ts_prophet["ds"].max() - pd.Timedelta(
+        days=dict_config["mg_holdout_days"]
+    )
+    df_train = df_ts_prophet.loc[df_ts_prophet["ds"] <= cutoff]
+    list_metrics = []
+    for i, dict_variant in enumerate(variants):
+        df_metrics = pd.DataFrame(
+            {
+                "horizon": [dict_config["mg_holdout_days"]],
+                "n": [0],
+                "mape": [np.nan],
+                "rmse": [np.nan],
+            }
+        )
+
+        # A single variant needs no selection; fbprophet requires at least 2
+        # non-NaN rows
+        if len(variants) > 1 and df_train["y"].count() >= 2:
+            model = build_model(dict_variant, df_holidays)
+            try:
+                model.fit(df_train)
+                df_pred = model.predict(
+                    df_ts_prophet.loc[df_ts_prophet["ds"] > cutoff]
+                )
+            except (ValueError, RuntimeError) as e:
+                # The metrics of a failed variant remain NaN
+                mp.get_logger().warning(f"Variant {i} could not be fitted: {e}")
+            else:
+                df_metrics = calc_error_metrics(
+                    df_pred, df_ts_prophet, cutoff, [dict_config["mg_holdout_days"]]
+                )
+        df_metrics["variant"] = dict_variant.get("name", str(i))
+        list_metrics.append(df_metrics)
+
+    # Select the best variant
+    df_variants = pd.concat(list_metrics, ignore_index=True)
+    idx_best = select_variant(df_variants, dict_config.get("mg_metric", "mape"))
+    df_variants["selected"] = df_variants.index == idx_best
+
+    # Forecast with the best variant fitted on the whole time series
+    model = build_model(variants[idx_best], df_holidays)
     model.fit(df_ts_prophet)
+    df_fcst_prophet = predict_forecast(model, dict_config["fcst_days"])
 
-    # Construct future DataFrame with number of days to be predicted
-    df_future = model.make_future_dataframe(
-        periods=dict_config["fcst_days"], freq="D"
+    return (
+        df_fcst_prophet,
+        model,
+        df_variants[["variant", "horizon", "n", "mape", "rmse", "selected"]],
     )
 
+
+def select_variant(df_variants, metric):
+    """ Select the model variant with the lowest error; the first of several
+    variants with the same error and the first variant if no variant could be
+    measured. Variants without error, e.g. failed fits, are not selected.
+
+    :param df_variants: accuracy of every variant in the order of the grid
+    :type df_variants: pandas DataFrame
+    :param metric: error metric, i.e. "mape" or "rmse"
+    :type metric: str
+    :return: position of the selected variant
+    :rtype: int
+    """
+    errors = df_variants[metric].values.astype(float)
+    if np.isnan(errors).all():
+        return 0
+
+    return int(np.nanargmin(errors))
+
+
+@dec_validation
+@dec_logger
+def calc_error_metrics(df_fcst, df_ts_prophet, cutoff, horizons):
+    """ Calculate MAPE and RMSE of a forecast made at a cutoff for every
+    horizon, i.e. over all days from the cutoff up to the horizon
+
+    Note: days with actual value 0 are ignored for the MAPE
+
+    :param df_fcst: forecasted time series with columns "ds" and "yhat"
+    :type df_fcst: pandas DataFrame
+    :param df_ts_prophet: actual time series with columns "ds" and "y"
+    :type df_ts_prophet: pandas DataFrame
+    :param cutoff: last date used for fitting
+    :type cutoff: pandas Timestamp
+    :param horizons: numbers of days after the cutoff to be evaluated
+    :type horizons: list of ints
+    :return: error metrics for every horizon
+    :rtype: pandas DataFrame
+    """
+    # Compare forecast with actual values after the cutoff
+    df_eval = df_fcst[["ds", "yhat"]].merge(df_ts_prophet[["ds", "y"]], on="ds")
+    df_eval = df_eval.loc[(df_eval["ds"] > cutoff) & df_eval["y"].notnull()]
+    days = (df_eval["ds"] - cutoff).dt.days.values
+    y = df_eval["y"].values.astype(float)
+    err = df_eval["yhat"].values - y
+
+    list_metrics = []
+    for horizon in sorted(horizons):
+        in_horizon = days <= horizon
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ape = np.abs(err[in_horizon & (y != 0)] / y[in_horizon & (y != 0)])
+        list_metrics.append(
+            {
+                "cutoff": cutoff,
+                "horizon": horizon,
+                "n": int(in_horizon.sum()),
+                "mape": ape.mean() if ape.size else np.nan,
+                "rmse": np.sqrt(np.mean(err[in_horizon] ** 2))
+                if in_horizon.any()
+                else np.nan,
+            }
+        )
+
+    return pd.DataFrame(list_metrics)
+
+
+@dec_validation
+@dec_logger
+def get_warm_start_params(model):
+    """ Get the parameters of a fitted model in the format required to
+    initialize the fit of another model (warm-start)
+
+    :param model: fitted fbprophet model
+    :type model: fbprophet model
+    :return: initial values of the model parameters
+    :rtype: Dictionary
+    """
+    dict_params = {}
+    for name in ["k", "m", "sigma_obs"]:
+        dict_params[name] = model.params[name][0][0]
+    for name in ["delta", "beta"]:
+        dict_params[name] = model.params[name][0]
+
+    return dict_params
+
+
+@dec_validation
+@dec_logger
+def predict_forecast(model, fcst_days):
+    """ Make forecast with a fitted fbprophet model, i.e. without fitting
+
+    :param model: fitted fbprophet model
+    :type model: fbprophet model
+    :param fcst_days: number of days to be forecasted after the history
+    :type fcst_days: int
+    :return: the original and forecasted time series of a cluster
+    :rtype: pandas DataFrame
+    """
+    # Construct future DataFrame with number of days to be predicted
+    df_future = model.make_future_dataframe(periods=fcst_days, freq="D")
+
     # Make forecast
     df_fcst_prophet = model.predict(df_future)
 
-    # Add original values
-    df_fcst_prophet["y"] = df_ts_prophet["y"]
+    # Add original values of the history used for fitting
+    df_fcst_prophet = df_fcst_prophet.merge(
+        model.history[["ds", "y"]], on="ds", how="left"
+    )
 
-    return df_fcst_prophet, model
+    return df_fcst_prophet
+
+
+@dec_validation
+@dec_logger
+def save_model(model, cluster_id, dict_config):
+    """ Serialize a fitted fbprophet model as gzipped pickle into the model
+    store. The JSON serialization of fbprophet requires version 0.7, and the
+    Stan backend, i.e. the compiled Stan model, is not needed for forecasts
+    without fitting and is not stored.
+
+    :param model: fitted fbprophet model
+    :type model: fbprophet model
+    :param cluster_id: a specific cluster ID
+    :type cluster_id: int
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    """
+    model = copy.copy(model)
+    model.stan_backend = None
+    with gzip.open(get_model_filepath(cluster_id, dict_config), "wb") as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+@dec_validation
+@dec_logger
+def load_model(cluster_id, dict_config):
+    """ Load a fitted fbprophet model from the model store
+
+    :param cluster_id: a specific cluster ID
+    :type cluster_id: int
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: fitted fbprophet model
+    :rtype: fbprophet model
+    """
+    with gzip.open(get_model_filepath(cluster_id, dict_config), "rb") as f:
+        return pickle.load(f)
+
+
+def get_model_filepath(cluster_id, dict_config):
+    """ Get the file of the model of a cluster in the model store
+
+    :param cluster_id: a specific cluster ID
+    :type cluster_id: int
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: path of the model file
+    :rtype: str
+    """
+    return os.path.join(dict_config["dir_models"], f"model_cluster_{cluster_id}.pkl.gz")
+
+
+@dec_validation
+@dec_logger
+def get_stored_cluster_ids(dict_config):
+    """ Get the cluster IDs of all models in the model store
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: sorted list of cluster IDs
+    :rtype: list of ints
+    """
+    filepaths = glob.glob(os.path.join(dict_config["dir_models"], "*.pkl.gz"))
+    pattern = re.compile(r"model_cluster_(-?\d+)\.pkl\.gz$")
+
+    return sorted(
+        int(m.group(1)) for m in (pattern.search(fp) for fp in filepaths) if m
+    )
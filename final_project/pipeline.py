@@ -0,0 +1,387 @@
+"""
+This module contains functions related to the pipeline of the forecasting
+workflow, i.e. a graph of stages (download, load, forecast and export) over
+the existing functions. The output of every stage is
+cached by a fingerprint of its config data and the fingerprints of the stages
+it depends on, so that only stages with changed inputs are executed again.
+Stages are executed one after another in topological order.
+
+A stage is a dictionary with the following keys:
+* name: unique name of the stage
+* func: function called with the config data and the outputs of its deps
+* deps: names of the stages whose outputs are passed to func
+* config_keys: config keys which the output of the stage depends on
+* mode: "always" (executed on every run; its output is part of the
+  fingerprint), "cached" (output is cached on disk) or "lazy" (executed only
+  if a dependent stage is executed)
+* probe: optional function replacing func of an "always" stage for dry runs
+* check: optional function called with the config data and the cached output
+  of a "cached" stage, which returns False if the files written by the stage
+  are missing or have been changed since, i.e. the stage has to be executed
+
+The module contains the following functions:
+* get_pipeline_stages: returns the stages of the forecasting workflow
+* run_pipeline: executes all stages whose inputs have changed
+* plan_pipeline: determines the fingerprints and the stages to be executed
+* get_stage_fingerprint: calculates the fingerprint of a stage
+* get_stage_filepath: returns the cache file of a stage output
+* run_download: stage function for the download of the input data
+* run_load: stage function for loading the input data
+* run_forecast: stage function for the forecasts and plots of all clusters
+* run_export: stage function for the export of the forecasts
+* check_export: checks that the result file of the export is unchanged
+"""
+import hashlib
+import json
+import pickle
+import time
+from .process import *
+
+
+def get_pipeline_stages():
+    """ Get the stages of the forecasting workflow in topological order
+
+    :return: stages
+    :rtype: list of Dictionaries
+    """
+    ts_keys = ["ts_input_start", "ts_input_end"]
+
+    # Plots are rendered by the forecast workers with the models fitted in the
+    # same run. Note: the models written to the model store are no output of
+    # the stage, i.e. a changed model store does not invalidate it.
+    plot_keys = ["dir_plot", "plot_format", "plot_dpi", "plot_pack"]
+    plot_keys += ["plot_atlas_size", "plot_atlas_cols"]
+
+    stages = [
+        {
+            "name": "download",
+            "func": run_download,
+            "probe": get_input_checksums,
+            "deps": [],
+            "config_keys": [],
+            "mode": "always",
+        },
+        {
+            "name": "load",
+            "func": run_load,
+            "deps": ["download"],
+            "config_keys": ts_keys
+            + ["use_traffic_store", "use_ts_cache"]
+            + QUALITY_CONFIG_KEYS,
+            "mode": "lazy",
+        },
+        {
+            "name": "forecast",
+            "func": run_forecast,
+            "deps": ["load"],
+            "config_keys": ts_keys
+            + ["fcst_days", "cluster_ids", "shard", "shard_strategy", "subset"]
+            + ["routing", "rt_min_days", "rt_min_coverage", "rt_max_zero_ratio"]
+            + ["rt_max_cv", "rt_season_days", "rt_ses_alpha", "export_intervals"]
+            + ["use_model_grid", "model_grid", "mg_holdout_days", "mg_metric"]
+            + plot_keys,
+            "mode": "cached",
+        },
+        {
+            "name": "export",
+            "func": run_export,
+            "check": check_export,
+            "deps": ["forecast"],
+            "config_keys": ["dir_results_local", "f_results"],
+            "mode": "cached",
+        },
+    ]
+
+    return stages
+
+
+@dec_validation
+@dec_logger
+def run_pipeline(dict_config, stages=None, force=(), dry_run=False):
+    """ Execute all stages whose inputs have changed one after another in
+    topological order
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param stages: stages in topological order (default: forecasting workflow)
+    :type stages: list of Dictionaries
+    :param force: names of stages to be executed in any case, together with
+                  all stages depending on them
+    :type force: iterable of str
+    :param dry_run: flag indicating if the stages to be executed shall only be
+                    logged; "always" stages are replaced by their probe
+    :type dry_run: bool
+    :return: plan of the pipeline, i.e. stage name --> fingerprint and flag
+             indicating if the stage has been executed
+    :rtype: Dictionary
+    """
+    logger = mp.get_logger()
+    if stages is None:
+        stages = get_pipeline_stages()
+    dict_stages = {stage["name"]: stage for stage in stages}
+
+    # Execute "always" stages first since their outputs are part of the
+    # fingerprints of all subsequent stages
+    dict_outputs = {}
+    for stage in stages:
+        if stage["mode"] == "always":
+            func = stage.get("probe", stage["func"]) if dry_run else stage["func"]
+            dict_outputs[stage["name"]] = func(
+                dict_config, *(dict_outputs[dep] for dep in stage["deps"])
+            )
+
+    dict_plan = plan_pipeline(stages, dict_config, dict_outputs, force)
+    for name, dict_node in dict_plan.items():
+        status = "run" if dict_node["run"] else dict_stages[name]["mode"]
+        logger.info(f"Stage '{name}' [{dict_node['fingerprint']}]: {status}")
+    if dry_run:
+        return dict_plan
+
+    def get_output(name):
+        # Outputs of cached stages which are not executed are read from disk
+        if name not in dict_outputs:
+            fp = get_stage_filepath(name, dict_plan[name]["fingerprint"], dict_config)
+            with open(fp, "rb") as f:
+                dict_outputs[name] = pickle.load(f)
+        return dict_outputs[name]
+
+    def execute(stage):
+        t_start = time.perf_counter()
+        with MemoryProfiler(f"stage {stage['name']}", dict_config):
+            output = stage["func"](
+                dict_config, *(get_output(d) for d in stage["deps"])
+            )
+        if stage["mode"] == "cached":
+            fp = get_stage_filepath(
+                stage["name"], dict_plan[stage["name"]]["fingerprint"], dict_config
+            )
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+            with open(f"{fp}.tmp", "wb") as f:
+                pickle.dump(output, f)
+            os.replace(f"{fp}.tmp", fp)
+        logger.info(
+            f"Stage '{stage['name']}' finished in {time.perf_counter() - t_start:.1f}s"
+        )
+        return output
+
+    for stage in stages:
+        if dict_plan[stage["name"]]["run"]:
+            dict_outputs[stage["name"]] = execute(stage)
+
+    return dict_plan
+
+
+@dec_validation
+@dec_logger
+def plan_pipeline(stages, dict_config, dict_outputs, force=()):
+    """ Determine the fingerprint of every stage and whether it has to be
+    executed, i.e. a cached stage without valid cached output for its
+    fingerprint, a forced stage, a stage depending on an executed stage or a lazy stage
+    required by an executed stage
+
+    :param stages: stages in topological order
+    :type stages: list of Dictionaries
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param dict_outputs: outputs of the "always" stages
+    :type dict_outputs: Dictionary
+    :param force: names of stages to be executed in any case
+    :type force: iterable of str
+    :return: stage name --> fingerprint and flag indicating if the stage has to
+             be executed
+    :rtype: Dictionary
+    """
+    unknown_stages = set(force) - set(stage["name"] for stage in stages)
+    if unknown_stages:
+        raise ValueError(f"Unknown stages: {sorted(unknown_stages)}")
+
+    dict_plan = {}
+    for stage in stages:
+        missing_deps = [dep for dep in stage["deps"] if dep not in dict_plan]
+        if missing_deps:
+            raise ValueError(
+                f"Stage '{stage['name']}' precedes its deps {missing_deps}"
+            )
+
+        fingerprint = get_stage_fingerprint(
+            stage,
+            dict_config,
+            [dict_plan[dep]["fingerprint"] for dep in stage["deps"]],
+            dict_outputs.get(stage["name"]),
+        )
+        is_invalid = stage["mode"] == "cached" and not is_cache_valid(
+            stage, get_stage_filepath(stage["name"], fingerprint, dict_config),
+            dict_config
+        )
+        dict_plan[stage["name"]] = {
+            "fingerprint": fingerprint,
+            "run": stage["mode"] != "always"
+            and (
+                is_invalid
+                or stage["name"] in force
+                or any(dict_plan[dep]["run"] for dep in stage["deps"])
+            ),
+        }
+
+    # Lazy stages are only executed if an executed stage depends on them
+    dict_modes = {stage["name"]: stage["mode"] for stage in stages}
+    for stage in reversed(stages):
+        if dict_plan[stage["name"]]["run"]:
+            for dep in stage["deps"]:
+                if dict_modes[dep] == "lazy":
+                    dict_plan[dep]["run"] = True
+
+    return dict_plan
+
+
+def is_cache_valid(stage, fp, dict_config):
+    """ Check if the cached output of a stage exists and, if the stage has a
+    check, that the files written by the stage are unchanged
+
+    :param stage: a cached stage
+    :type stage: Dictionary
+    :param fp: path of the cached output
+    :type fp: str
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: flag indicating if the cached output can be used
+    :rtype: bool
+    """
+    if not os.path.exists(fp):
+        return False
+    if "check" not in stage:
+        return True
+    with open(fp, "rb") as f:
+        output = pickle.load(f)
+
+    return stage["check"](dict_config, output)
+
+
+def get_stage_fingerprint(stage, dict_config, dep_fingerprints, output=None):
+    """ Calculate the fingerprint of a stage from its config data, the
+    fingerprints of its deps and, for "always" stages, its output
+
+    :param stage: a stage
+    :type stage: Dictionary
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param dep_fingerprints: fingerprints of the deps of the stage
+    :type dep_fingerprints: list of str
+    :param output: output of the stage, if it is part of the fingerprint
+    :return: fingerprint
+    :rtype: str
+    """
+    dict_key = {
+        "name": stage["name"],
+        "config": {key: dict_config.get(key) for key in stage["config_keys"]},
+        "deps": dep_fingerprints,
+        "output": output,
+    }
+
+    return hashlib.sha256(
+        json.dumps(dict_key, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+def get_stage_filepath(name, fingerprint, dict_config):
+    """ Get the cache file of the output of a stage
+
+    :param name: name of the stage
+    :type name: str
+    :param fingerprint: fingerprint of the stage
+    :type fingerprint: str
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: path of the cache file
+    :rtype: str
+    """
+    return os.path.join(
+        dict_config["dir_cache"], "pipeline", f"{name}_{fingerprint}.pkl"
+    )
+
+
+def run_download(dict_config):
+    """ Download the input data from AWS
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: checksum of every input file
+    :rtype: Dictionary
+    """
+    download_data_aws(dict_config)
+
+    return get_input_checksums(dict_config)
+
+
+def run_load(dict_config, dict_checksums):
+    """ Load the clustering and, unless the cache of cleaned time series is up
+    to date, the traffic data
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param dict_checksums: checksum of every input file
+    :type dict_checksums: Dictionary
+    :return: a dictionary with site-to-cluster mapping and a DataFrame with
+             traffic data
+    :rtype tuple (dictionary, DataFrame)
+    """
+    return load_ts_data(dict_config)
+
+
+def run_forecast(dict_config, data):
+    """ Forecast and plot all selected clusters
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param data: a dictionary with site-to-cluster mapping and a DataFrame
+                 with traffic data
+    :type data: tuple (dictionary, DataFrame)
+    :return: the original and forecasted time series for every cluster
+    :rtype: pandas DataFrame
+    """
+    dict_so_cluster, df_traffic = data
+
+    return start_process(
+        df_traffic,
+        dict_so_cluster,
+        dict_config,
+        subset=dict_config.get("subset", True),
+    )
+
+
+def run_export(dict_config, df_fcst_results):
+    """ Export the forecasts of all clusters
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param df_fcst_results: the original and forecasted time series for every
+                            cluster
+    :type df_fcst_results: pandas DataFrame
+    :return: path and checksum of the result file
+    :rtype: tuple (str, str)
+    """
+    export_fcst_results_hdf5(
+        df_fcst_results, dict_config, filename=dict_config["f_results"]
+    )
+    fp_results = os.path.join(
+        dict_config["dir_results_local"], dict_config["f_results"]
+    )
+
+    return fp_results, get_file_checksum(fp_results)
+
+
+def check_export(dict_config, export_output):
+    """ Check that the result file of an export still exists and has not been
+    overwritten since, e.g. by a predict or merge run
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param export_output: path and checksum of the result file
+    :type export_output: tuple (str, str)
+    :return: flag indicating if the result file is unchanged
+    :rtype: bool
+    """
+    fp_results, checksum = export_output
+
+    return os.path.exists(fp_results) and get_file_checksum(fp_results) == checksum
+
@@ -10,6 +10,7 @@ The module contains the following functions:
 * make_clean_ts: cleans the time series of a cluster
 """
 from .utils import *
+from .cache import *
 
 
 @dec_validation
@@ -26,6 +27,10 @@ def preprocess_data(df_traffic, dict_so_cluster, cluster_id, dict_config):
     :return: a cleaned time series for the cluster
     :rtype: pandas DataFrame
     """
+    # Use the cached time series if the cache is up to date
+    if dict_config.get("ts_cache"):
+        return get_cached_ts(cluster_id, dict_config)
+
     # Create time series for cluster
     df_ts = make_ts(df_traffic, dict_so_cluster, cluster_id, dict_config)
 
@@ -39,7 +44,8 @@ def preprocess_data(df_traffic, dict_so_cluster, cluster_id, dict_config):
 @dec_logger
 def make_ts(df_traffic, dict_so_cluster, cluster_id, dict_config):
     """ Makes a time series as pandas DataFrame for a certain cluster assuming
-    traffic input data for all clusters
+    traffic input data for all clusters, either per site or already aggregated
+    per cluster (column "cluster_id")
 
     :param df_traffic: DataFrame with traffic related data and DateTimeIndex
     :type df_traffic: pandas DataFrame
@@ -53,6 +59,15 @@ def make_ts(df_traffic, dict_so_cluster, cluster_id, dict_config):
     :rtype pandas DataFrame with DateTimeIndex and one column
     """
 
+    # Traffic already aggregated per cluster, e.g. loaded from the traffic store
+    if "cluster_id" in df_traffic.columns:
+        df_ts_cluster = df_traffic.loc[df_traffic["cluster_id"] == cluster_id]
+        df_ts_cluster = df_ts_cluster.loc[
+            dict_config["ts_input_start"] : dict_config["ts_input_end"]
+        ]
+        df_ts_cluster.index.names = ["dt"]
+        return df_ts_cluster.groupby(["dt"]).agg({"gb": "sum"})
+
     # Get list of sites in selected cluster ID
     if cluster_id >= 0:
         so_cluster = [
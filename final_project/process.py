@@ -3,13 +3,26 @@ This module contains functions related to multiprocessing
 
 The module contains the following functions:
 * start_process: triggers all functions necessary for the forecasting workflow
+* select_cluster_ids: determines the cluster IDs to be forecasted in a run
+* get_shard: deterministically partitions cluster IDs and returns one shard
 * get_number_processes: determines number of processes used for multi-processing
 * get_cluster_chunks: splits up a list of cluster IDs into n-disjoint chunks
 * mp_run: implementation of a single process
+* get_chunk_name: returns the name of a chunk of cluster IDs
+* start_preprocess: initializes the worker processes for pre-processing only
+* mp_preprocess: implementation of a single process for pre-processing only
+* start_predict: initializes the worker processes for forecasts with stored models
+* mp_predict: implementation of a single process for forecasts with stored models
 """
 import concurrent.futures
+import time
+import zlib
 from functools import partial
 from .preprocessing import *
+from .routing import *
+from .shared import *
+from .rendering import *
+from .profiling import *
 from .forecasting import *
 from .data import *
 
@@ -29,7 +42,8 @@ def start_process(
     :type dict_config: Dictionary
     :param max_processes: upper bound for the number of process
     :type max_processes: int
-    :param subset: flag indicating if all cluster IDs shall be considered
+    :param subset: flag indicating if all cluster IDs shall be considered; it
+                   is ignored if explicit cluster IDs or a shard are configured
     :type subset: bool
     :return: the original and forecasted time series for every cluster
     :rtype pandas DataFrame
@@ -37,33 +51,188 @@ def start_process(
     # Determine max number of processes to be initialized
     n_processes = get_number_processes(max_processes)
 
-    # Determine cluster IDs to be forecasted and set ID -1 for total Germany
+    # Determine cluster IDs to be forecasted
+    cluster_ids = select_cluster_ids(dict_so_cluster, dict_config, subset)
+
+    # Regional holidays of the model grid require the state of every cluster
+    if dict_config.get("use_model_grid"):
+        dict_config = dict(dict_config, cluster_states=load_cluster_states(dict_config))
+
+    # Preallocate shared result arrays for all clusters, which are filled in
+    # place by the workers
+    dict_shared = create_shared_results(cluster_ids, dict_config)
+
+    # Forecast sparse, short or flat clusters in bulk instead of with fbprophet
+    if dict_config.get("routing"):
+        cluster_ids, df_fcst_bulk, sr_engines, seconds_bulk = start_routing(
+            df_traffic, dict_so_cluster, dict_config, cluster_ids
+        )
+        write_shared_fcst(dict_shared, df_fcst_bulk)
+
+    # Create chunks with cluster ID; with a memory budget, smaller chunks are
+    # submitted as long as the budget allows
+    budget_mb = dict_config.get("mem_budget_mb")
+    cluster_chunks = get_cluster_chunks(
+        cluster_ids, n_processes * (4 if budget_mb else 1)
+    )
+
+    # Create a partial function to pass multiple arguments
+    func = partial(mp_run, df_traffic, dict_so_cluster, dict_config)
+
+    # Use context manager for ProcessPoolExecutor and iterate over cluster chunks
+    t_start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=n_processes,
+        initializer=init_shared_results,
+        initargs=(dict_shared,),
+    ) as executor:
+        if budget_mb:
+            results = map_with_budget(
+                executor, func, cluster_chunks, budget_mb, n_processes
+            )
+        else:
+            results = executor.map(func, cluster_chunks)
+
+        # Workers only return the number of forecasted days and the accuracy
+        # of the model variants per cluster
+        list_variants = []
+        for fcst_status in results:
+            for clu_id, n_days, records in fcst_status:
+                mp.get_logger().info(f"Cluster ID {clu_id}: {n_days} days")
+                list_variants.extend(records)
+
+    # Export the accuracy of all model variants per cluster
+    if dict_config.get("use_model_grid"):
+        pd.DataFrame(
+            list_variants,
+            columns=["cluster_id", "variant", "horizon", "n", "mape", "rmse"]
+            + ["selected"],
+        ).to_csv(
+            os.path.join(
+                dict_config["dir_results_local"], dict_config["mg_metrics_file"]
+            ),
+            index=False,
+        )
+
+    # Combine forecast results of all clusters to one DataFrame
+    df_fcst_results = assemble_fcst_results(dict_shared)
+
+    if dict_config.get("routing"):
+        mp.get_logger().info(
+            get_routing_summary(
+                sr_engines, seconds_bulk, time.perf_counter() - t_start, n_processes
+            )
+        )
+
+    return df_fcst_results
+
+
+@dec_validation
+@dec_logger
+def select_cluster_ids(dict_so_cluster, dict_config, subset=True):
+    """ Determine the cluster IDs to be forecasted, i.e. either explicitly
+    configured cluster IDs, one shard of all cluster IDs or (optionally) a
+    subset of the first 10 cluster IDs
+
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: Dictionary with config data; the optional keys
+                        "cluster_ids" (list of ints) and "shard" (tuple of
+                        shard index and number of shards) are considered
+    :type dict_config: Dictionary
+    :param subset: flag indicating if only the first 10 cluster IDs shall be
+                   considered
+    :type subset: bool
+    :return: sorted list of cluster IDs
+    :rtype: list of ints
+    """
+    # Determine all cluster IDs and set ID -1 for total Germany
     # Note: IDs are not consecutive numbers
-    cluster_ids = list(set(val for val in dict_so_cluster.values()))
+    cluster_ids = sorted(set(val for val in dict_so_cluster.values()))
     cluster_ids.append(-1)
 
+    # Explicitly configured cluster IDs take precedence
+    if dict_config.get("cluster_ids"):
+        unknown_ids = set(dict_config["cluster_ids"]) - set(cluster_ids)
+        if unknown_ids:
+            raise ValueError(f"Unknown cluster IDs: {sorted(unknown_ids)}")
+        return sorted(set(dict_config["cluster_ids"]))
+
+    # Consider only one shard of all cluster IDs
+    if dict_config.get("shard"):
+        shard_index, n_shards = dict_config["shard"]
+        return get_shard(
+            cluster_ids,
+            dict_so_cluster,
+            shard_index,
+            n_shards,
+            dict_config.get("shard_strategy", "hash"),
+        )
+
     # Check if only a subset of cluster IDs shall be considered
     if subset:
         cluster_ids = cluster_ids[:10]
 
-    # Create result DataFrame
-    df_fcst_results = prepare_fcst_df()
+    return cluster_ids
 
-    # Create chunks with cluster ID
-    cluster_chunks = get_cluster_chunks(cluster_ids, n_processes)
 
-    # Create a partial function to pass multiple arguments
-    func = partial(mp_run, df_traffic, dict_so_cluster, dict_config)
+@dec_validation
+@dec_logger
+def get_shard(cluster_ids, dict_so_cluster, shard_index, n_shards, strategy="hash"):
+    """ Partition cluster IDs deterministically into n_shards disjoint shards
+    and return the shard with index shard_index. The partition is independent
+    of the machine and the Python hash seed, so that independent jobs agree on
+    it.
+
+    Strategies:
+    * hash: a cluster ID is assigned to shard crc32(ID) mod n_shards
+    * cost: clusters are assigned greedily (largest first) to the shard with
+            the lowest total cost, where the cost of a cluster is its number of
+            sites (total Germany counts all sites)
 
-    # Use context manager for ProcessPoolExecutor and iterate over cluster chunks
-    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
-        fcst_results = executor.map(func, cluster_chunks)
+    :param cluster_ids: list of cluster IDs
+    :type cluster_ids: list of ints
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param shard_index: index of the shard to be returned (0 <= index < n)
+    :type shard_index: int
+    :param n_shards: number of shards
+    :type n_shards: int
+    :param strategy: partitioning strategy, i.e. "hash" or "cost"
+    :type strategy: str
+    :return: sorted list of cluster IDs in the shard
+    :rtype: list of ints
+    """
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(f"Invalid shard {shard_index}/{n_shards}")
+
+    if strategy == "hash":
+        return sorted(
+            clu_id
+            for clu_id in cluster_ids
+            if zlib.crc32(str(clu_id).encode()) % n_shards == shard_index
+        )
 
-        # Combine forecast results of all chunks to one DataFrame
-        for fcst in fcst_results:
-            df_fcst_results = df_fcst_results.append(fcst)
+    if strategy == "cost":
+        # Number of sites per cluster as cost estimate
+        costs = dict.fromkeys(cluster_ids, 0)
+        for clu_id in dict_so_cluster.values():
+            if clu_id in costs:
+                costs[clu_id] += 1
+        if -1 in costs:
+            costs[-1] = len(dict_so_cluster)
 
-    return df_fcst_results
+        # Longest processing time first; ties are broken by ID / shard index
+        shard_costs = [0] * n_shards
+        shards = [[] for _ in range(n_shards)]
+        for clu_id in sorted(cluster_ids, key=lambda c: (-costs[c], c)):
+            i = min(range(n_shards), key=lambda s: (shard_costs[s], s))
+            shards[i].append(clu_id)
+            shard_costs[i] += costs[clu_id]
+
+        return sorted(shards[shard_index])
+
+    raise ValueError(f"Unknown shard strategy '{strategy}'")
 
 
 @dec_validation
@@ -127,44 +296,240 @@ def mp_run(df_traffic, dict_so_cluster, dict_config, cluster_chunk):
     :param cluster_chunk: chunk of cluster IDs to be processed
     :type cluster_chunk: list of ints
     :return the original & forecasted time series for all clusters in the chunk
-    :rtype pandas DataFrame
+            or, if the forecasts are written into shared result arrays, the
+            number of forecasted days and the accuracy records of the model
+            variants (if any) per cluster
+    :rtype pandas DataFrame or list of tuples (int, int, list of Dictionaries)
     """
 
     # Configure logger for each individual process and get process ID
     logger = configure_logger(dict_config)
 
+    # Shared result arrays of the process (if any)
+    dict_shared = get_shared_results()
+    fcst_status = []
+
     # Create result DataFrame for cluster chunk
     df_fcst_results = prepare_fcst_df()
 
-    # Iterate over all cluster IDs in chunk
-    for clu_id in cluster_chunk:
-        # Run pre-processing
-        df_ts_cluster = preprocess_data(
-            df_traffic, dict_so_cluster, clu_id, dict_config
-        )
-
-        # Note: a cluster time series must have at least 2 NaN rows. This is a
-        # constraint of fbprophet
-        if len(df_ts_cluster.index) > 2:
-            # Run forecasting to get a DataFrame with forecasted time series
-            logger.info(f"> Start forecast cluster ID {clu_id}")
-            df_fcst, model = forecast(df_ts_cluster, dict_config)
-            logger.info(f"+ End forecast cluster ID: {clu_id}")
-
-            # Add cluster identifier for the time series
-            df_fcst["cluster_id"] = clu_id
-            df_fcst_results = df_fcst_results.append(
-                df_fcst[["ds", "cluster_id", "y", "yhat"]]
+    # One renderer reuses its figures for all plots of the chunk; figures and
+    # profiler are also released if a forecast fails
+    with MemoryProfiler(
+        f"worker {get_chunk_name(cluster_chunk)}", dict_config
+    ), ForecastRenderer(dict_config, get_chunk_name(cluster_chunk)) as renderer:
+        # Iterate over all cluster IDs in chunk
+        for clu_id in cluster_chunk:
+            # Run pre-processing
+            df_ts_cluster = preprocess_data(
+                df_traffic, dict_so_cluster, clu_id, dict_config
             )
 
-            # Plot the forecasting result and save it
-            fp = os.path.join(dict_config["dir_plot"], f"fcst_cluster_{clu_id}.png")
-            model.plot(df_fcst).savefig(fp)
+            # Note: a cluster time series must have at least 2 NaN rows. This is
+            # a constraint of fbprophet
+            if len(df_ts_cluster.index) > 2:
+                # Run forecasting to get a DataFrame with forecasted time series
+                logger.info(f"> Start forecast cluster ID {clu_id}")
+                if dict_config.get("use_model_grid"):
+                    df_fcst, model, df_variants = forecast_grid(
+                        df_ts_cluster,
+                        dict_config,
+                        dict_config.get("cluster_states", {}).get(clu_id),
+                    )
+                    df_variants.insert(0, "cluster_id", clu_id)
+                    records = df_variants.to_dict("records")
+                else:
+                    df_fcst, model = forecast(df_ts_cluster, dict_config)
+                    records = []
+                logger.info(f"+ End forecast cluster ID: {clu_id}")
+
+                # Store fitted model for later forecasts without fitting
+                if dict_config.get("dir_models"):
+                    save_model(model, clu_id, dict_config)
+
+                # Add cluster identifier for the time series
+                df_fcst["cluster_id"] = clu_id
+                if dict_shared:
+                    write_shared_fcst(dict_shared, df_fcst)
+                    fcst_status.append((clu_id, len(df_fcst), records))
+                else:
+                    df_fcst_results = df_fcst_results.append(
+                        df_fcst[["ds", "cluster_id", "y", "yhat"]]
+                    )
+
+                # Plot the forecasting result and its components and save them
+                renderer.render(model, df_fcst, clu_id)
+
+    if dict_shared:
+        return fcst_status
+
+    return df_fcst_results
+
+
+def get_chunk_name(cluster_chunk):
+    """ Get the name of a chunk of cluster IDs, e.g. for the files of a worker
+
+    :param cluster_chunk: chunk of cluster IDs
+    :type cluster_chunk: list of ints
+    :return: name of the chunk
+    :rtype: str
+    """
+    if not cluster_chunk:
+        return "empty"
+
+    return f"clusters_{cluster_chunk[0]}_to_{cluster_chunk[-1]}"
+
+
+@dec_validation
+@dec_logger
+def start_preprocess(
+    df_traffic, dict_so_cluster, dict_config, cluster_ids, max_processes=32
+):
+    """ Initialize the worker processes for pre-processing only, i.e. to get
+    the cleaned time series of clusters for reuse in several forecasts
 
-            # Plot the forecasting components and save them
-            fp = os.path.join(
-                dict_config["dir_plot"], f"components_cluster_{clu_id}.png"
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param cluster_ids: cluster IDs to be pre-processed
+    :type cluster_ids: list of ints
+    :param max_processes: upper bound for the number of process
+    :type max_processes: int
+    :return: cleaned time series for every cluster
+    :rtype: Dictionary (cluster ID --> pandas DataFrame)
+    """
+    n_processes = get_number_processes(max_processes)
+    cluster_chunks = get_cluster_chunks(cluster_ids, n_processes)
+    func = partial(mp_preprocess, df_traffic, dict_so_cluster, dict_config)
+
+    dict_ts_clusters = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        for dict_ts_chunk in executor.map(func, cluster_chunks):
+            dict_ts_clusters.update(dict_ts_chunk)
+
+    return dict_ts_clusters
+
+
+def mp_preprocess(df_traffic, dict_so_cluster, dict_config, cluster_chunk):
+    """ Implementation of a single process / worker for pre-processing only
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param cluster_chunk: chunk of cluster IDs to be processed
+    :type cluster_chunk: list of ints
+    :return: cleaned time series for all clusters in the chunk
+    :rtype: Dictionary (cluster ID --> pandas DataFrame)
+    """
+    configure_logger(dict_config)
+
+    return {
+        clu_id: preprocess_data(df_traffic, dict_so_cluster, clu_id, dict_config)
+        for clu_id in cluster_chunk
+    }
+
+
+@dec_validation
+@dec_logger
+def start_predict(dict_config, horizons, cluster_ids=None, max_processes=32):
+    """ Initialize the worker processes for forecasts with fitted models from
+    the model store, i.e. without fitting. Several horizons are derived from
+    one forecast with the largest horizon.
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param horizons: numbers of days to be forecasted
+    :type horizons: list of ints
+    :param cluster_ids: cluster IDs to be forecasted; all stored models if None
+    :type cluster_ids: list of ints
+    :param max_processes: upper bound for the number of process
+    :type max_processes: int
+    :return: the original and forecasted time series for every cluster for
+             each horizon
+    :rtype: Dictionary (horizon --> pandas DataFrame)
+    """
+    # Determine max number of processes to be initialized
+    n_processes = get_number_processes(max_processes)
+
+    # Use all models in the model store if no cluster IDs are given
+    if cluster_ids is None:
+        cluster_ids = get_stored_cluster_ids(dict_config)
+
+    # Create result DataFrames for each horizon
+    dict_fcst_results = {horizon: [prepare_fcst_df()] for horizon in horizons}
+
+    # Create chunks with cluster ID; with a memory budget, smaller chunks are
+    # submitted as long as the budget allows
+    budget_mb = dict_config.get("mem_budget_mb")
+    cluster_chunks = get_cluster_chunks(
+        cluster_ids, n_processes * (4 if budget_mb else 1)
+    )
+
+    # Create a partial function to pass multiple arguments
+    func = partial(mp_predict, dict_config, horizons)
+
+    # Use context manager for ProcessPoolExecutor and iterate over cluster chunks
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        if budget_mb:
+            results = map_with_budget(
+                executor, func, cluster_chunks, budget_mb, n_processes
             )
-            model.plot_components(df_fcst).savefig(fp)
+        else:
+            results = executor.map(func, cluster_chunks)
 
-    return df_fcst_results
+        for dict_fcst in results:
+            for horizon, df_fcst in dict_fcst.items():
+                dict_fcst_results[horizon].append(df_fcst)
+
+    # Combine forecast results of all chunks to one DataFrame per horizon
+    return {
+        horizon: pd.concat(dfs, ignore_index=True)
+        for horizon, dfs in dict_fcst_results.items()
+    }
+
+
+def mp_predict(dict_config, horizons, cluster_chunk):
+    """ Implementation of a single process / worker for forecasts with fitted
+    models from the model store
+
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param horizons: numbers of days to be forecasted
+    :type horizons: list of ints
+    :param cluster_chunk: chunk of cluster IDs to be processed
+    :type cluster_chunk: list of ints
+    :return the original & forecasted time series for all clusters in the chunk
+            for each horizon
+    :rtype Dictionary (horizon --> pandas DataFrame)
+    """
+    # Configure logger for each individual process
+    logger = configure_logger(dict_config)
+
+    dict_fcst_results = {horizon: [prepare_fcst_df()] for horizon in horizons}
+
+    for clu_id in cluster_chunk:
+        # Forecast the largest horizon once without fitting
+        logger.info(f"> Start prediction cluster ID {clu_id}")
+        model = load_model(clu_id, dict_config)
+        df_fcst = predict_forecast(model, max(horizons))
+        df_fcst["cluster_id"] = clu_id
+        logger.info(f"+ End prediction cluster ID: {clu_id}")
+
+        # Cut the forecast for each horizon after the end of the history
+        history_end = model.history["ds"].max()
+        for horizon in horizons:
+            df_horizon = df_fcst.loc[
+                df_fcst["ds"] <= history_end + pd.Timedelta(days=horizon),
+                ["ds", "cluster_id", "y", "yhat"],
+            ]
+            dict_fcst_results[horizon].append(df_horizon)
+
+    return {
+        horizon: pd.concat(dfs, ignore_index=True)
+        for horizon, dfs in dict_fcst_results.items()
+    }
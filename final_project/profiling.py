@@ -0,0 +1,283 @@
+"""
+This module contains functions related to the (opt-in) memory profiling of
+stages and worker processes and to the memory budget of the process pool
+
+Every profiled section records its RSS at the start and the end, its peak RSS,
+the peak of the memory traced by tracemalloc and the top allocating lines. The
+records of all processes are appended to "memory_profile.jsonl" in the logs
+folder and summarized at the end of a run. Sections running concurrently in
+threads of the same process share RSS and traced memory.
+
+The module contains the following functions and classes:
+* MemoryProfiler: records the memory usage of a section of a process
+* get_rss: returns the current resident set size of the process
+* get_peak_rss: returns the peak resident set size of the process
+* reset_peak_rss: resets the peak resident set size of the process
+* reset_memory_profile: removes the records of a previous run
+* summarize_memory_profile: summarizes the records of a run
+* call_with_rss: calls a function and returns the RSS of the worker with it
+* map_with_budget: submits tasks to a pool while the memory budget allows
+"""
+import concurrent.futures
+import json
+import resource
+import threading
+import time
+import tracemalloc
+from .utils import *
+
+# Number of profilers using tracemalloc in the current process
+_n_tracing = [0]
+_lock_tracing = threading.Lock()
+
+
+class MemoryProfiler:
+    """ Profiler of the memory usage of a section of a process; it does
+    nothing unless "profile_memory" is set in the config data
+    """
+
+    def __init__(self, name, dict_config):
+        """ Initialize a profiler without starting it
+
+        :param name: name of the profiled section, e.g. the stage
+        :type name: str
+        :param dict_config: config data
+        :type dict_config: Dictionary
+        """
+        self.name = name
+        self.dict_config = dict_config
+        self.active = bool(dict_config.get("profile_memory"))
+        self.record = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """ Start the profiling
+
+        :return: the profiler
+        :rtype: MemoryProfiler
+        """
+        if not self.active:
+            return self
+
+        with _lock_tracing:
+            if _n_tracing[0] == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            _n_tracing[0] += 1
+        reset_peak_rss()
+        self.t_start = time.perf_counter()
+        self.rss_start = get_rss()
+
+        return self
+
+    def stop(self):
+        """ Stop the profiling and append its record to the profile of the run
+
+        :return: the record of the section (None if the profiler is inactive)
+        :rtype: Dictionary
+        """
+        if not self.active or self.record is not None:
+            return self.record
+
+        top_n = self.dict_config.get("mem_top_n", 5)
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+        )
+        self.record = {
+            "name": self.name,
+            "pid": os.getpid(),
+            "seconds": round(time.perf_counter() - self.t_start, 3),
+            "rss_start_mb": self.rss_start / 2 ** 20,
+            "rss_end_mb": get_rss() / 2 ** 20,
+            "rss_peak_mb": get_peak_rss() / 2 ** 20,
+            "traced_peak_mb": tracemalloc.get_traced_memory()[1] / 2 ** 20,
+            "top_allocations": [
+                {
+                    "location": f"{stat.traceback[0].filename}:"
+                    f"{stat.traceback[0].lineno}",
+                    "size_mb": stat.size / 2 ** 20,
+                    "count": stat.count,
+                }
+                for stat in snapshot.statistics("lineno")[:top_n]
+            ],
+        }
+
+        with _lock_tracing:
+            _n_tracing[0] -= 1
+            if _n_tracing[0] == 0:
+                tracemalloc.stop()
+
+        # Lines of less than 4 KiB are written at once by all processes
+        fp = os.path.join(self.dict_config["dir_logs"], "memory_profile.jsonl")
+        with open(fp, "a") as f:
+            f.write(json.dumps(self.record) + "\n")
+
+        return self.record
+
+
+def get_rss():
+    """ Get the current resident set size (RSS) of the process
+
+    :return: RSS in bytes
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss()
+
+
+def get_peak_rss():
+    """ Get the peak resident set size of the process since its start or the
+    last reset
+
+    :return: peak RSS in bytes
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # Note: ru_maxrss is given in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """ Reset the peak resident set size of the process to its current RSS
+    (Linux only; otherwise the peak since the start of the process is kept)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def reset_memory_profile(dict_config):
+    """ Remove the records of a previous run
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    """
+    fp = os.path.join(dict_config["dir_logs"], "memory_profile.jsonl")
+    if os.path.exists(fp):
+        os.remove(fp)
+
+
+@dec_validation
+@dec_logger
+def summarize_memory_profile(dict_config):
+    """ Summarize the records of a run, i.e. the peak RSS of every section and
+    the top allocating lines of all sections, and write them to
+    "memory_profile.json" in the logs folder
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: summary for the log
+    :rtype: str
+    """
+    fp = os.path.join(dict_config["dir_logs"], "memory_profile.jsonl")
+    if not os.path.exists(fp):
+        return "No memory profile"
+    with open(fp) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    # Largest allocating lines over all sections
+    dict_allocations = {}
+    for record in records:
+        for allocation in record["top_allocations"]:
+            size_mb = dict_allocations.get(allocation["location"], 0)
+            dict_allocations[allocation["location"]] = max(
+                size_mb, allocation["size_mb"]
+            )
+    top_allocations = sorted(dict_allocations.items(), key=lambda x: -x[1])[
+        : dict_config.get("mem_top_n", 5)
+    ]
+
+    with open(os.path.join(dict_config["dir_logs"], "memory_profile.json"), "w") as f:
+        json.dump(
+            {"sections": records, "top_allocations": dict(top_allocations)}, f, indent=2
+        )
+
+    lines = ["Memory profile (peak RSS / traced peak in MB):"]
+    lines += [
+        f"  {r['name']} [pid {r['pid']}]: {r['rss_peak_mb']:.0f} / "
+        f"{r['traced_peak_mb']:.0f} in {r['seconds']:.1f}s"
+        for r in records
+    ]
+    lines += ["Top allocations (MB):"]
+    lines += [f"  {location}: {size_mb:.1f}" for location, size_mb in top_allocations]
+
+    return "\n".join(lines)
+
+
+def call_with_rss(func, *args):
+    """ Call a function in a worker process and return the RSS of the worker
+    after the call together with the result
+
+    :param func: function to be called
+    :param args: arguments of the function
+    :return: process ID, RSS in bytes and result of the function
+    :rtype: tuple (int, int, any)
+    """
+    result = func(*args)
+
+    return os.getpid(), get_rss(), result
+
+
+def map_with_budget(executor, func, tasks, budget_mb, max_pending):
+    """ Submit tasks to a process pool and yield their results as they
+    complete. New tasks are only submitted while the RSS of the current
+    process and the last RSS reported by every worker are within the memory
+    budget; at least one task is always pending.
+
+    :param executor: process pool
+    :type executor: concurrent.futures.ProcessPoolExecutor
+    :param func: function called with every task
+    :param tasks: arguments of the function
+    :type tasks: list
+    :param budget_mb: memory budget in MB
+    :type budget_mb: float
+    :param max_pending: maximum number of pending tasks
+    :type max_pending: int
+    :return: results of the function in order of completion
+    :rtype: generator
+    """
+    logger = mp.get_logger()
+    tasks = list(tasks)
+    dict_rss = {}
+    pending = set()
+    n_throttled = 0
+
+    while tasks or pending:
+        while tasks and len(pending) < max_pending:
+            rss_mb = (get_rss() + sum(dict_rss.values())) / 2 ** 20
+            if pending and rss_mb > budget_mb:
+                n_throttled += 1
+                break
+            pending.add(executor.submit(call_with_rss, func, tasks.pop(0)))
+
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            pid, rss, result = future.result()
+            dict_rss[pid] = rss
+            yield result
+
+    logger.info(
+        f"Memory budget {budget_mb} MB: {n_throttled} times throttled, last RSS of "
+        f"workers {sum(dict_rss.values()) / 2 ** 20:.0f} MB"
+    )
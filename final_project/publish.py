@@ -0,0 +1,136 @@
+"""
+This module contains functions related to the publication of the results in
+the AWS S3 bucket, i.e. the upload of the result file and the images rendered
+in the current run while the forecasting is still running
+
+The module contains the following functions and classes:
+* ResultPublisher: uploads new and changed result files in the background
+* get_publish_filepaths: returns the local files to be published
+"""
+import tempfile
+import threading
+from .data import *
+
+
+class ResultPublisher:
+    """ Background thread which regularly uploads the result file and images
+    that have not changed since the previous check, i.e. which have been
+    completely written. Remaining files are uploaded when it is stopped
+    without an error. The images are taken from a plot manifest of the run,
+    which is set in the config data (config "plot_manifest") and is removed
+    when the publisher is stopped.
+    """
+
+    def __init__(self, dict_config):
+        """ Initialize a publisher without starting it
+
+        :param dict_config: config data
+        :type dict_config: Dictionary
+        """
+        self.dict_config = dict_config
+        self.interval = dict_config.get("s3_publish_interval", 10)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.file_states = {}
+        self.published = {}
+        self.n_uploaded = 0
+        self.n_skipped = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(final=exc_type is None)
+        return False
+
+    def start(self):
+        """ Create the plot manifest and start the background thread """
+        fd, fp = tempfile.mkstemp(
+            prefix="plot_manifest_", suffix=".txt", dir=self.dict_config.get("dir_logs")
+        )
+        os.close(fd)
+        self.dict_config["plot_manifest"] = fp
+        self.thread.start()
+
+    def stop(self, final=True):
+        """ Stop the background thread and upload all remaining files
+
+        :param final: flag indicating if the remaining files shall be uploaded,
+                      i.e. False if the run failed
+        :type final: bool
+        """
+        self.stopped.set()
+        self.thread.join()
+        try:
+            if final:
+                self.publish(final=True)
+        finally:
+            fp = self.dict_config.pop("plot_manifest", None)
+            if fp is not None and os.path.exists(fp):
+                os.remove(fp)
+        mp.get_logger().info(
+            f"Published {self.n_uploaded} files, {self.n_skipped} unchanged files"
+        )
+
+    def run(self):
+        """ Upload completely written files until the publisher is stopped """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                mp.get_logger().error(f"!! Publication failed: {e}")
+
+    def publish(self, final=False):
+        """ Upload all files which have not been published with their current
+        size and modification time and, unless it is the final upload, which
+        have not changed since the previous check
+
+        :param final: flag indicating if files shall be uploaded regardless of
+                      a recent change
+        :type final: bool
+        """
+        filepaths = []
+        for fp in get_publish_filepaths(self.dict_config):
+            try:
+                stat = os.stat(fp)
+            except OSError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            is_stable = final or self.file_states.get(fp) == state
+            self.file_states[fp] = state
+            if is_stable and self.published.get(fp) != state:
+                filepaths.append(fp)
+
+        if not filepaths:
+            return
+
+        uploaded, skipped = upload_results_aws(self.dict_config, filepaths)
+        self.n_uploaded += len(uploaded)
+        self.n_skipped += len(skipped)
+        for fp in filepaths:
+            self.published[fp] = self.file_states[fp]
+
+
+def get_publish_filepaths(dict_config):
+    """ Get the local files to be published, i.e. the result file of the run
+    and the images listed in the plot manifest of the run (single plots or
+    atlases in the plot format and PDFs of packed plots), but no other files
+    of the result folder such as shard files or reports and no images of
+    previous runs
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: sorted list of file paths
+    :rtype: list of str
+    """
+    filepaths = [
+        os.path.join(dict_config["dir_results_local"], dict_config["f_results"])
+    ]
+
+    fp_manifest = dict_config.get("plot_manifest")
+    if fp_manifest is not None and os.path.exists(fp_manifest):
+        with open(fp_manifest) as f:
+            filepaths += [line.rstrip("\n") for line in f if line.strip()]
+
+    return sorted(set(fp for fp in filepaths if os.path.isfile(fp)))
@@ -0,0 +1,225 @@
+"""
+This module contains functions related to the data quality of the raw traffic
+data, i.e. a vectorized cleaning pass over the daily site records of all
+clusters before they are aggregated per cluster
+
+The module contains the following functions:
+* load_clean_data: loads the input data and cleans the traffic data
+* clean_traffic: removes duplicates and fills or masks missing days, outages
+                 and spikes
+* get_quality_config: returns the config data the cleaning depends on
+"""
+import numpy as np
+import pandas as pd
+from .data import *
+
+# Config keys the cleaning of the traffic data depends on
+QUALITY_CONFIG_KEYS = ["data_quality", "dq_window", "dq_z_threshold", "dq_fill"]
+
+
+@dec_validation
+@dec_logger
+def load_clean_data(dict_config):
+    """ Load the input data, clean the site records of the traffic data and
+    write the quality report of the clusters
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: a dictionary with site-to-cluster mapping and a DataFrame with
+             the cleaned traffic data
+    :rtype tuple (dictionary, DataFrame)
+    """
+    dict_so_cluster, df_traffic = load_data(dict_config)
+
+    if not dict_config.get("data_quality"):
+        return dict_so_cluster, df_traffic
+
+    # Cluster aggregates of the traffic store contain no site records
+    if "cluster_id" in df_traffic.columns:
+        raise ValueError(
+            "Data quality: the cluster aggregates of the traffic store cannot be "
+            "cleaned"
+        )
+
+    df_traffic, df_report = clean_traffic(df_traffic, dict_so_cluster, dict_config)
+    df_report.to_csv(
+        os.path.join(dict_config["dir_results_local"], dict_config["dq_report_file"]),
+        index=False,
+    )
+    total = df_report.iloc[-1]
+    mp.get_logger().info(
+        f"Data quality: {int(total['duplicates'])} duplicates, "
+        f"{int(total['missing'])} missing days, {int(total['outages'])} outages, "
+        f"{int(total['spikes'])} spikes in {int(total['records'])} site records, "
+        f"{int(total['unfilled'])} records of sites without valid records removed"
+    )
+
+    return dict_so_cluster, df_traffic
+
+
+@dec_validation
+@dec_logger
+def clean_traffic(df_traffic, dict_so_cluster, dict_config):
+    """ Clean the daily site records of all clusters at once:
+
+    * duplicates: only the last record of a site and date is kept
+    * missing days: days between the first and the last record of a site
+      without any record are added as outages
+    * outages: records without positive traffic
+    * spikes: records whose robust z-score, i.e. the deviation from the median
+      of the site within the period dq_window (e.g. "Q" for quarters) divided
+      by the scaled median absolute deviation (MAD), exceeds dq_z_threshold;
+      if the MAD is 0, e.g. for mostly constant traffic, the scaled mean
+      absolute deviation is used instead
+
+    Outages and spikes are replaced by the median of the site within the
+    period (dq_fill "median") or removed (dq_fill "mask"). If a period of a
+    site has no valid record, the median of the site over all periods is
+    used instead; records of sites without any valid record are removed and
+    counted as unfilled.
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: the cleaned traffic data, ordered by site and date, and the
+             quality report per cluster, including total Germany (cluster ID
+             -1) as last row
+    :rtype: tuple (pandas DataFrame, pandas DataFrame)
+    """
+    # Remove duplicated records of a site and date
+    dates = df_traffic.index.normalize()
+    is_duplicate = pd.DataFrame(
+        {"dt": dates, "so_number": df_traffic["so_number"]}
+    ).duplicated(keep="last").values
+    idx_records = pd.MultiIndex.from_arrays(
+        [df_traffic["so_number"].values[~is_duplicate], dates[~is_duplicate]]
+    )
+
+    # All days from the first to the last record of every site
+    df_span = (
+        pd.Series(idx_records.get_level_values(1), idx_records.get_level_values(0))
+        .groupby(level=0)
+        .agg(["min", "max"])
+    )
+    n_days = (df_span["max"] - df_span["min"]).dt.days.values + 1
+    offsets = np.arange(n_days.sum()) - np.repeat(np.cumsum(n_days) - n_days, n_days)
+    idx_days = pd.MultiIndex.from_arrays(
+        [
+            np.repeat(df_span.index.values, n_days),
+            np.repeat(df_span["min"].values, n_days)
+            + offsets.astype("timedelta64[D]"),
+        ]
+    )
+
+    # Missing days have no traffic, i.e. are outages
+    pos_records = idx_days.get_indexer(idx_records)
+    df_clean = df_traffic.loc[~is_duplicate].set_axis(idx_records).reindex(idx_days)
+    df_clean["so_number"] = idx_days.get_level_values(0)
+    df_clean.index = idx_days.get_level_values(1).rename(df_traffic.index.name)
+    is_missing = np.ones(len(df_clean), dtype=bool)
+    is_missing[pos_records] = False
+
+    # Outages have no positive traffic
+    sr_gb = pd.Series(df_clean["gb"].values.astype("float64"))
+    is_outage = ~(sr_gb.values > 0)
+    sr_valid = sr_gb.where(~is_outage)
+
+    # Robust z-score per site and period with the MAD or, if it is 0, the mean
+    # absolute deviation, both scaled to the standard deviation of normally
+    # distributed traffic; sites without variation have none
+    keys = [
+        df_clean["so_number"].values,
+        df_clean.index.to_period(dict_config.get("dq_window", "Q")).values,
+    ]
+    sr_median = sr_valid.groupby(keys).transform("median")
+    sr_deviation = (sr_valid - sr_median).abs()
+    sr_mad = sr_deviation.groupby(keys).transform("median")
+    sr_meanad = sr_deviation.groupby(keys).transform("mean")
+    scale = np.where(
+        sr_mad.values > 0, 1.4826 * sr_mad.values, 1.2533 * sr_meanad.values
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (sr_valid.values - sr_median.values) / scale
+    is_spike = np.abs(np.nan_to_num(z, nan=0.0, posinf=0.0, neginf=0.0)) > (
+        dict_config.get("dq_z_threshold", 5)
+    )
+
+    # Fill or mask outages and spikes; periods without valid records are
+    # filled with the median of the site over all periods
+    is_invalid = is_outage | is_spike
+    is_unfilled = np.zeros(len(df_clean), dtype=bool)
+    if dict_config.get("dq_fill", "median") == "mask":
+        df_clean = df_clean.loc[~is_invalid]
+    else:
+        sr_fill = sr_median.fillna(sr_valid.groupby(keys[0]).transform("median"))
+        is_unfilled = is_invalid & np.isnan(sr_fill.values)
+        df_clean["gb"] = np.where(is_invalid, sr_fill.values, sr_gb.values)
+        df_clean = df_clean.loc[~is_unfilled]
+
+    # Quality report per cluster and for total Germany; missing days are no
+    # records
+    n_rows = [len(df_traffic), is_missing.sum()]
+    df_flags = pd.DataFrame(
+        {
+            "so_number": np.concatenate(
+                [
+                    df_traffic["so_number"].values,
+                    idx_days.get_level_values(0)[is_missing],
+                ]
+            ),
+            "records": np.repeat([1, 0], n_rows),
+            "duplicates": False,
+            "missing": np.repeat([False, True], n_rows),
+            "outages": False,
+            "spikes": False,
+            "unfilled": np.concatenate(
+                [np.zeros(len(df_traffic), dtype=bool), is_unfilled[is_missing]]
+            ),
+        }
+    )
+    df_flags["cluster_id"] = df_flags["so_number"].map(dict_so_cluster)
+    df_flags.loc[: len(df_traffic) - 1, "duplicates"] = is_duplicate
+    idx_kept = np.flatnonzero(~is_duplicate)
+    df_flags.loc[idx_kept, "outages"] = is_outage[pos_records]
+    df_flags.loc[idx_kept, "spikes"] = is_spike[pos_records]
+    df_flags.loc[idx_kept, "unfilled"] = is_unfilled[pos_records]
+    df_flags = df_flags.dropna(subset=["cluster_id"])
+
+    df_report = df_flags.groupby("cluster_id").agg(
+        sites=("so_number", "nunique"),
+        records=("records", "sum"),
+        duplicates=("duplicates", "sum"),
+        missing=("missing", "sum"),
+        outages=("outages", "sum"),
+        spikes=("spikes", "sum"),
+        unfilled=("unfilled", "sum"),
+    )
+    df_report.loc[-1] = [df_flags["so_number"].nunique()] + df_report[
+        ["records", "duplicates", "missing", "outages", "spikes", "unfilled"]
+    ].sum().tolist()
+    df_report = df_report.astype("int64").rename_axis("cluster_id").reset_index()
+    df_report["cluster_id"] = df_report["cluster_id"].astype("int64")
+    df_report["outage_ratio"] = (df_report["missing"] + df_report["outages"]) / (
+        df_report["records"] - df_report["duplicates"] + df_report["missing"]
+    )
+    df_report["spike_ratio"] = df_report["spikes"] / df_report["records"]
+
+    return df_clean, df_report
+
+
+def get_quality_config(dict_config):
+    """ Get the config data the cleaning of the traffic data depends on, e.g.
+    as part of cache keys
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: config data of the cleaning
+    :rtype: Dictionary
+    """
+    if not dict_config.get("data_quality"):
+        return {"data_quality": False}
+
+    return {key: dict_config.get(key) for key in QUALITY_CONFIG_KEYS}
@@ -0,0 +1,302 @@
+"""
+This module contains functions related to the rendering of the forecast and
+component plots of many clusters. Instead of building new figures for every
+cluster (model.plot / model.plot_components), one figure template per plot
+type is created on the Agg canvas and only its data is updated per cluster.
+Plots are written as separate files, as pages of one PDF or as image atlases
+(config "plot_pack": None, "pdf" or "atlas"). The paths of all completely
+written files are appended to the manifest "plot_manifest", if configured, e.g.
+to publish only the plots of the current run.
+
+The module contains the following functions and classes:
+* ForecastRenderer: renders the plots of the clusters of a worker
+* set_limits: sets the axis limits to the data
+* get_seasonal_components: returns the weekly and yearly profile of a model
+"""
+import matplotlib.dates as mdates
+import matplotlib.image as mimage
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from .utils import *
+
+# Colors of fbprophet plots
+COLOR_FCST = "#0072B2"
+COLOR_DATA = "k"
+
+
+class ForecastRenderer:
+    """ Renderer of the forecast and component plots of the clusters of a
+    worker. Figures are created on the first plot and closed by close() or by
+    leaving the context manager.
+    """
+
+    def __init__(self, dict_config, part="all"):
+        """ Initialize a renderer without figures
+
+        :param dict_config: config data
+        :type dict_config: Dictionary
+        :param part: name of the packed files of the renderer, e.g. to
+                     distinguish the files of several workers
+        :type part: str
+        """
+        self.dir_plot = dict_config["dir_plot"]
+        self.fmt = dict_config.get("plot_format", "png")
+        self.dpi = dict_config.get("plot_dpi", 100)
+        self.pack = dict_config.get("plot_pack")
+        self.atlas_size = dict_config.get("plot_atlas_size", 16)
+        self.atlas_cols = dict_config.get("plot_atlas_cols", 4)
+        self.part = part
+        self.manifest = dict_config.get("plot_manifest")
+        self.figures = {}
+        self.artists = {}
+        self.pdf = None
+        self.tiles = {"fcst": [], "components": []}
+        self.n_sheets = {"fcst": 0, "components": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def render(self, model, df_fcst, cluster_id):
+        """ Render the forecast and component plots of a cluster
+
+        :param model: fitted fbprophet model
+        :type model: fbprophet model
+        :param df_fcst: forecasted time series of the model with column "y"
+        :type df_fcst: pandas DataFrame
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        """
+        self.draw_forecast(df_fcst, cluster_id)
+        self.save_figure("fcst", cluster_id)
+
+        self.draw_components(df_fcst, get_seasonal_components(model), cluster_id)
+        self.save_figure("components", cluster_id)
+
+    def draw_forecast(self, df_fcst, cluster_id):
+        """ Update the forecast plot with the data of a cluster
+
+        :param df_fcst: forecasted time series with column "y"
+        :type df_fcst: pandas DataFrame
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        """
+        if "fcst" not in self.figures:
+            fig = self.create_figure("fcst", (10, 6), 1)
+            ax = fig.axes[0]
+            self.artists["history"] = ax.plot([], [], ".", c=COLOR_DATA)[0]
+            self.artists["yhat"] = ax.plot([], [], ls="-", c=COLOR_FCST)[0]
+            self.artists["interval"] = None
+            ax.xaxis_date()
+            ax.set_xlabel("ds")
+            ax.set_ylabel("y")
+
+        ax = self.figures["fcst"].axes[0]
+        x = mdates.date2num(pd.to_datetime(df_fcst["ds"]))
+        self.artists["history"].set_data(x, df_fcst["y"].values)
+        self.artists["yhat"].set_data(x, df_fcst["yhat"].values)
+
+        # The uncertainty interval is a new polygon for every cluster
+        if self.artists["interval"] is not None:
+            self.artists["interval"].remove()
+        self.artists["interval"] = ax.fill_between(
+            x,
+            df_fcst["yhat_lower"].values,
+            df_fcst["yhat_upper"].values,
+            color=COLOR_FCST,
+            alpha=0.2,
+        )
+
+        y = df_fcst[["y", "yhat", "yhat_lower", "yhat_upper"]].values
+        set_limits(ax, x, y)
+        ax.set_title(f"Cluster {cluster_id}")
+
+    def draw_components(self, df_fcst, df_seasonal, cluster_id):
+        """ Update the component plot with the data of a cluster; components
+        the model does not contain are left empty
+
+        :param df_fcst: forecasted time series
+        :type df_fcst: pandas DataFrame
+        :param df_seasonal: seasonal components of one year starting on a Sunday
+        :type df_seasonal: pandas DataFrame
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        """
+        if "components" not in self.figures:
+            fig = self.create_figure("components", (9, 12), 4)
+            for ax, name in zip(fig.axes, ["trend", "holidays", "weekly", "yearly"]):
+                self.artists[name] = ax.plot([], [], ls="-", c=COLOR_FCST)[0]
+                ax.set_ylabel(name)
+            for ax in [fig.axes[0], fig.axes[1], fig.axes[3]]:
+                ax.xaxis_date()
+            fig.axes[0].set_xlabel("ds")
+            fig.axes[1].set_xlabel("ds")
+            fig.axes[2].set_xticks(range(7))
+            fig.axes[2].set_xticklabels(
+                ["Sunday", "Monday", "Tuesday", "Wednesday"]
+                + ["Thursday", "Friday", "Saturday"]
+            )
+            fig.axes[2].set_xlabel("Day of week")
+            fig.axes[3].xaxis.set_major_formatter(mdates.DateFormatter("%B %d"))
+            fig.axes[3].set_xlabel("Day of year")
+
+        x_fcst = mdates.date2num(pd.to_datetime(df_fcst["ds"]))
+        x_seasonal = mdates.date2num(pd.to_datetime(df_seasonal["ds"]))
+        components = [
+            ("trend", x_fcst, df_fcst.get("trend")),
+            ("holidays", x_fcst, df_fcst.get("holidays")),
+            ("weekly", np.arange(7), df_seasonal.get("weekly")),
+            ("yearly", x_seasonal, df_seasonal.get("yearly")),
+        ]
+        for ax, (name, x, y) in zip(self.figures["components"].axes, components):
+            if y is None:
+                y = np.full(len(x), np.nan)
+            y = np.asarray(y, dtype=float)[: len(x)]
+            self.artists[name].set_data(x, y)
+            set_limits(ax, x, y)
+        self.figures["components"].axes[0].set_title(f"Cluster {cluster_id}")
+
+    def create_figure(self, kind, figsize, n_axes):
+        """ Create the figure template of a plot type on the Agg canvas
+
+        :param kind: plot type, i.e. "fcst" or "components"
+        :type kind: str
+        :param figsize: width and height in inches
+        :type figsize: tuple (int, int)
+        :param n_axes: number of axes below each other
+        :type n_axes: int
+        :return: figure
+        :rtype: matplotlib Figure
+        """
+        fig = Figure(figsize=figsize, dpi=self.dpi, facecolor="w")
+        FigureCanvasAgg(fig)
+        for i in range(n_axes):
+            ax = fig.add_subplot(n_axes, 1, i + 1)
+            ax.grid(True, which="major", c="gray", ls="-", lw=1, alpha=0.2)
+        fig.subplots_adjust(left=0.1, right=0.95, hspace=0.4)
+        self.figures[kind] = fig
+
+        return fig
+
+    def save_figure(self, kind, cluster_id):
+        """ Write the current plot of a type to its own file, the PDF or the
+        tiles of the next atlas
+
+        :param kind: plot type, i.e. "fcst" or "components"
+        :type kind: str
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        """
+        fig = self.figures[kind]
+
+        if self.pack == "pdf":
+            if self.pdf is None:
+                self.fp_pdf = os.path.join(self.dir_plot, f"plots_{self.part}.pdf")
+                self.pdf = PdfPages(self.fp_pdf)
+            self.pdf.savefig(fig)
+        elif self.pack == "atlas":
+            fig.canvas.draw()
+            self.tiles[kind].append(np.array(fig.canvas.buffer_rgba()))
+            if len(self.tiles[kind]) >= self.atlas_size:
+                self.save_atlas(kind)
+        else:
+            fp = os.path.join(self.dir_plot, f"{kind}_cluster_{cluster_id}.{self.fmt}")
+            fig.savefig(fp, format=self.fmt, dpi=self.dpi)
+            self.add_to_manifest(fp)
+
+    def save_atlas(self, kind):
+        """ Write the collected tiles of a plot type as one image with
+        atlas_cols tiles per row
+
+        :param kind: plot type, i.e. "fcst" or "components"
+        :type kind: str
+        """
+        tiles = self.tiles[kind]
+        if not tiles:
+            return
+
+        # Fill the last row with blank tiles
+        n_rows = -(-len(tiles) // self.atlas_cols)
+        tiles = tiles + [np.full_like(tiles[0], 255)] * (
+            n_rows * self.atlas_cols - len(tiles)
+        )
+        atlas = np.concatenate(
+            [
+                np.concatenate(tiles[i : i + self.atlas_cols], axis=1)
+                for i in range(0, len(tiles), self.atlas_cols)
+            ]
+        )
+
+        fp = os.path.join(
+            self.dir_plot,
+            f"{kind}_atlas_{self.part}_{self.n_sheets[kind]:03d}.{self.fmt}",
+        )
+        mimage.imsave(fp, atlas, format=self.fmt)
+        self.add_to_manifest(fp)
+        self.n_sheets[kind] += 1
+        self.tiles[kind] = []
+
+    def close(self):
+        """ Write pending atlas tiles, close the PDF and release the figures """
+        for kind in self.tiles:
+            self.save_atlas(kind)
+        if self.pdf is not None:
+            self.pdf.close()
+            self.pdf = None
+            self.add_to_manifest(self.fp_pdf)
+        for fig in self.figures.values():
+            fig.clear()
+        self.figures = {}
+        self.artists = {}
+
+    def add_to_manifest(self, fp):
+        """ Append the path of a completely written file to the manifest
+
+        :param fp: path of the file
+        :type fp: str
+        """
+        if self.manifest is None:
+            return
+
+        # Lines of less than 4 KiB are written at once by all processes
+        with open(self.manifest, "a") as f:
+            f.write(fp + "\n")
+
+
+def set_limits(ax, x, y):
+    """ Set the axis limits to the data, ignoring NaN values
+
+    :param ax: axes
+    :type ax: matplotlib Axes
+    :param x: x values
+    :type x: numpy array
+    :param y: y values
+    :type y: numpy array
+    """
+    if len(x):
+        ax.set_xlim(np.min(x), np.max(x) if np.max(x) > np.min(x) else np.min(x) + 1)
+    if np.isfinite(y).any():
+        y_min, y_max = np.nanmin(y), np.nanmax(y)
+        margin = 0.05 * (y_max - y_min) or 1
+        ax.set_ylim(y_min - margin, y_max + margin)
+
+
+def get_seasonal_components(model):
+    """ Get the seasonal components of a model for one year starting on a
+    Sunday, i.e. the weekly profile are the first seven days
+
+    :param model: fitted fbprophet model
+    :type model: fbprophet model
+    :return: seasonal components with column "ds"
+    :rtype: pandas DataFrame
+    """
+    df_days = pd.DataFrame({"ds": pd.date_range("2017-01-01", "2017-12-31")})
+    df_seasonal = model.predict_seasonal_components(df_days)
+    df_seasonal["ds"] = df_days["ds"].values
+
+    return df_seasonal
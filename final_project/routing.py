@@ -0,0 +1,321 @@
+"""
+This module contains functions related to model routing, i.e. the triage of
+clusters into clusters forecasted with fbprophet and sparse, short or flat
+clusters forecasted in bulk with cheap vectorized forecasting methods
+
+The module contains the following functions:
+* start_routing: routes clusters and forecasts the cheap ones in bulk
+* profile_ts_matrix: calculates the profile of the time series of all clusters
+* route_clusters: assigns a forecasting engine to every cluster
+* forecast_seasonal_naive: seasonal naive forecast of all clusters at once
+* forecast_ses: simple exponential smoothing forecast of all clusters at once
+* get_routing_summary: summarizes the routing split and the time saved
+"""
+import time
+import numpy as np
+from .preprocessing import *
+
+
+@dec_validation
+@dec_logger
+def start_routing(df_traffic, dict_so_cluster, dict_config, cluster_ids):
+    """ Route the clusters to forecasting engines and forecast all clusters
+    which are not routed to fbprophet in bulk
+
+    Note: no plots are generated for clusters forecasted in bulk
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+                       (None if the cache of cleaned time series is used)
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :param cluster_ids: cluster IDs to be forecasted
+    :type cluster_ids: list of ints
+    :return: cluster IDs to be forecasted with fbprophet, the original and
+             forecasted time series of all other clusters, the engine of every
+             cluster and the duration of routing and bulk forecasts in seconds
+    :rtype: tuple (list of ints, pandas DataFrame, pandas Series, float)
+    """
+    t_start = time.perf_counter()
+
+    # Get the cleaned time series of all clusters
+    if dict_config.get("ts_cache"):
+        dates, dict_columns, values = open_ts_matrix(dict_config["ts_cache"])
+    else:
+        dates, all_cluster_ids, values = build_ts_matrix(
+            df_traffic, dict_so_cluster, dict_config
+        )
+        dates = pd.DatetimeIndex(dates)
+        dict_columns = {c: i for i, c in enumerate(all_cluster_ids.tolist())}
+
+    # Consider only the selected clusters with data
+    cluster_ids_data = [c for c in cluster_ids if c in dict_columns]
+    values = np.asarray(values[:, [dict_columns[c] for c in cluster_ids_data]])
+
+    df_profile = profile_ts_matrix(values, cluster_ids_data, dict_config)
+    sr_engines = route_clusters(df_profile, dict_config)
+
+    # Forecast every group of clusters in bulk
+    dict_fcst = {
+        "snaive": forecast_seasonal_naive,
+        "ses": forecast_ses,
+    }
+    list_fcst = [prepare_fcst_df()]
+    for engine, func in dict_fcst.items():
+        is_engine = (sr_engines == engine).values
+        if is_engine.any():
+            list_fcst.append(
+                func(
+                    dates,
+                    sr_engines.index[is_engine],
+                    values[:, is_engine],
+                    dict_config,
+                )
+            )
+
+    # Clusters without data are forecasted by fbprophet, which skips them
+    cluster_ids_prophet = [
+        c for c in cluster_ids if sr_engines.get(c, "prophet") == "prophet"
+    ]
+    df_fcst_bulk = pd.concat(list_fcst, ignore_index=True)
+
+    return (
+        cluster_ids_prophet,
+        df_fcst_bulk,
+        sr_engines,
+        time.perf_counter() - t_start,
+    )
+
+
+@dec_validation
+@dec_logger
+def profile_ts_matrix(values, cluster_ids, dict_config):
+    """ Calculate the profile of the cleaned time series of all clusters, i.e.
+    length, coverage of the considered period, ratio of zero values and
+    coefficient of variation
+
+    :param values: matrix of traffic (dates x clusters), NaN outside of the
+                   range of a cluster
+    :type values: numpy array
+    :param cluster_ids: cluster IDs of the matrix columns
+    :type cluster_ids: list of ints
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: profile of every cluster
+    :rtype: pandas DataFrame with index "cluster_id"
+    """
+    n_days_period = (
+        pd.Timestamp(dict_config["ts_input_end"])
+        - pd.Timestamp(dict_config["ts_input_start"])
+    ).days + 1
+
+    in_range = ~np.isnan(values)
+    length = in_range.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zero_ratio = ((values == 0) & in_range).sum(axis=0) / length
+        mean = np.nanmean(np.where(in_range, values, np.nan), axis=0)
+        cv = np.nanstd(values, axis=0) / np.abs(mean)
+
+    return pd.DataFrame(
+        {
+            "length": length,
+            "coverage": length / n_days_period,
+            "zero_ratio": zero_ratio,
+            "cv": cv,
+        },
+        index=pd.Index(cluster_ids, name="cluster_id"),
+    )
+
+
+@dec_validation
+@dec_logger
+def route_clusters(df_profile, dict_config):
+    """ Assign a forecasting engine to every cluster:
+    * skip: at most 2 days, i.e. no forecast (constraint of fbprophet)
+    * snaive: short, sparse or mostly zero time series (seasonal naive)
+    * ses: flat time series (simple exponential smoothing)
+    * prophet: all other time series
+
+    :param df_profile: profile of every cluster
+    :type df_profile: pandas DataFrame
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: engine of every cluster
+    :rtype: pandas Series with index "cluster_id"
+    """
+    is_sparse = (
+        (df_profile["length"] < dict_config["rt_min_days"])
+        | (df_profile["coverage"] < dict_config["rt_min_coverage"])
+        | (df_profile["zero_ratio"] > dict_config["rt_max_zero_ratio"])
+    )
+    is_flat = df_profile["cv"].fillna(0) < dict_config["rt_max_cv"]
+
+    engines = np.select(
+        [df_profile["length"] <= 2, is_sparse, is_flat],
+        ["skip", "snaive", "ses"],
+        default="prophet",
+    )
+
+    return pd.Series(engines, index=df_profile.index, name="engine")
+
+
+def _to_fcst_df(dates, cluster_ids, values, values_fcst, fcst_days):
+    """ Convert the original and forecasted matrices of traffic into the
+    result format, i.e. from the first day of a cluster up to fcst_days days
+    after its last day
+
+    :param dates: dates of the original matrix rows
+    :type dates: pandas DatetimeIndex
+    :param cluster_ids: cluster IDs of the matrix columns
+    :type cluster_ids: list of ints
+    :param values: original matrix of traffic (dates x clusters)
+    :type values: numpy array
+    :param values_fcst: forecasted matrix of traffic (dates + fcst_days rows)
+    :type values_fcst: numpy array
+    :param fcst_days: number of days to be forecasted
+    :type fcst_days: int
+    :return: the original and forecasted time series of all clusters
+    :rtype: pandas DataFrame
+    """
+    dates_fcst = pd.date_range(dates[0], periods=len(values_fcst), freq="D")
+    idx_dates = np.arange(len(values_fcst))[:, None]
+    in_range = ~np.isnan(values)
+    idx_first = in_range.argmax(axis=0)
+    idx_last = len(dates) - 1 - in_range[::-1].argmax(axis=0)
+    is_result = (idx_dates >= idx_first) & (idx_dates <= idx_last + fcst_days)
+
+    # Negative values are no valid original values (see prepare_forecast)
+    y = np.full(values_fcst.shape, np.nan)
+    y[: len(dates)] = np.where(values < 0, np.nan, values)
+
+    # Rows of the result are ordered by cluster and date
+    idx_clusters, idx_days = np.nonzero(is_result.T)
+    return pd.DataFrame(
+        {
+            "ds": dates_fcst[idx_days],
+            "cluster_id": np.asarray(cluster_ids)[idx_clusters],
+            "y": y[idx_days, idx_clusters],
+            "yhat": values_fcst[idx_days, idx_clusters],
+        }
+    )
+
+
+@dec_validation
+@dec_logger
+def forecast_seasonal_naive(dates, cluster_ids, values, dict_config):
+    """ Seasonal naive forecast of all clusters at once, i.e. every day is
+    forecasted with the value of the same day of the previous season (week)
+
+    :param dates: dates of the matrix rows
+    :type dates: pandas DatetimeIndex
+    :param cluster_ids: cluster IDs of the matrix columns
+    :type cluster_ids: list of ints
+    :param values: matrix of traffic (dates x clusters)
+    :type values: numpy array
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: the original and forecasted time series of all clusters
+    :rtype: pandas DataFrame
+    """
+    fcst_days = dict_config["fcst_days"]
+    season = dict_config["rt_season_days"]
+    n_dates, n_clusters = values.shape
+    values_clean = np.maximum(values, 0)
+
+    # In-sample: value of the previous season
+    values_fcst = np.full((n_dates + fcst_days, n_clusters), np.nan)
+    values_fcst[season:n_dates] = values_clean[:-season]
+
+    # Future: repeat the last season of every cluster, which may be shorter
+    # than a season for very short time series
+    idx_last = n_dates - 1 - (~np.isnan(values))[::-1].argmax(axis=0)
+    idx_first = (~np.isnan(values)).argmax(axis=0)
+    season_length = np.minimum(season, idx_last - idx_first + 1)
+    idx_dates = np.arange(n_dates + fcst_days)[:, None]
+    days_ahead = idx_dates - idx_last
+    idx_source = idx_last - season_length + 1 + (days_ahead - 1) % season_length
+    is_future = (days_ahead > 0) & (days_ahead <= fcst_days)
+    cols = np.broadcast_to(np.arange(n_clusters), is_future.shape)
+    values_fcst[is_future] = values_clean[idx_source[is_future], cols[is_future]]
+
+    return _to_fcst_df(dates, cluster_ids, values, values_fcst, fcst_days)
+
+
+@dec_validation
+@dec_logger
+def forecast_ses(dates, cluster_ids, values, dict_config):
+    """ Simple exponential smoothing forecast of all clusters at once, i.e.
+    every day is forecasted with the smoothed level of the previous day and
+    the future with the last level
+
+    :param dates: dates of the matrix rows
+    :type dates: pandas DatetimeIndex
+    :param cluster_ids: cluster IDs of the matrix columns
+    :type cluster_ids: list of ints
+    :param values: matrix of traffic (dates x clusters)
+    :type values: numpy array
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: the original and forecasted time series of all clusters
+    :rtype: pandas DataFrame
+    """
+    fcst_days = dict_config["fcst_days"]
+    alpha = dict_config["rt_ses_alpha"]
+    n_dates, n_clusters = values.shape
+    values_clean = np.maximum(values, 0)
+
+    # Smooth all clusters day by day; the level starts with the first value
+    values_fcst = np.full((n_dates + fcst_days, n_clusters), np.nan)
+    level = np.full(n_clusters, np.nan)
+    for i in range(n_dates):
+        values_fcst[i] = level
+        is_new = np.isnan(level)
+        level = np.where(
+            is_new, values_clean[i], alpha * values_clean[i] + (1 - alpha) * level
+        )
+        # Keep the level after the last day of a cluster
+        level = np.where(np.isnan(values_clean[i]) & ~is_new, values_fcst[i], level)
+
+    # Future: level after the last day of every cluster
+    idx_last = n_dates - 1 - (~np.isnan(values))[::-1].argmax(axis=0)
+    idx_dates = np.arange(n_dates + fcst_days)[:, None]
+    days_ahead = idx_dates - idx_last
+    is_future = (days_ahead > 0) & (days_ahead <= fcst_days)
+    values_fcst[is_future] = np.broadcast_to(level, is_future.shape)[is_future]
+
+    return _to_fcst_df(dates, cluster_ids, values, values_fcst, fcst_days)
+
+
+@dec_validation
+@dec_logger
+def get_routing_summary(sr_engines, seconds_bulk, seconds_prophet, n_processes):
+    """ Summarize the routing split and estimate the time saved, i.e. the
+    estimated fbprophet time of all clusters forecasted in bulk minus the
+    time of the bulk forecasts
+
+    :param sr_engines: engine of every cluster
+    :type sr_engines: pandas Series
+    :param seconds_bulk: duration of routing and bulk forecasts in seconds
+    :type seconds_bulk: float
+    :param seconds_prophet: duration of all fbprophet forecasts in seconds
+    :type seconds_prophet: float
+    :param n_processes: number of processes used for fbprophet forecasts
+    :type n_processes: int
+    :return: summary message
+    :rtype: str
+    """
+    dict_counts = sr_engines.value_counts().to_dict()
+    n_prophet = dict_counts.get("prophet", 0)
+    n_bulk = dict_counts.get("snaive", 0) + dict_counts.get("ses", 0)
+
+    # Estimated fbprophet time per cluster and process
+    seconds_per_cluster = seconds_prophet * n_processes / max(n_prophet, 1)
+    seconds_saved = n_bulk * seconds_per_cluster / n_processes - seconds_bulk
+
+    return (
+        f"Routing split: {dict_counts}\n"
+        f"Bulk forecasts: {seconds_bulk:.1f}s, "
+        f"estimated time saved: {max(seconds_saved, 0):.1f}s"
+    )
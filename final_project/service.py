@@ -0,0 +1,300 @@
+"""
+This module contains functions related to the local forecast query service,
+i.e. a small HTTP service answering forecasts of a cluster for a number of
+days from the result file and the model store
+
+The module contains the following functions and classes:
+* start_service: starts the HTTP service
+* ForecastCache: LRU cache of cluster forecasts with a memory limit
+* ForecastRequestHandler: handler of HTTP requests
+
+Endpoints:
+* GET /forecast?cluster_id=812&days=500: forecast of the next 500 days after
+  the history of cluster 812
+* GET /stats: cache hit rate and latency statistics
+"""
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from .forecasting import *
+from .data import *
+
+
+@dec_validation
+@dec_logger
+def start_service(dict_config, host="127.0.0.1", port=8080, max_bytes=2 ** 28):
+    """ Start the HTTP service, which runs until it is interrupted
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param host: host name or address to listen on
+    :type host: str
+    :param port: port to listen on
+    :type port: int
+    :param max_bytes: memory limit of the forecast cache in bytes
+    :type max_bytes: int
+    """
+    server = ThreadingHTTPServer((host, port), ForecastRequestHandler)
+    server.forecast_cache = ForecastCache(dict_config, max_bytes)
+
+    mp.get_logger().info(f"Serving forecasts on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class ForecastCache:
+    """ LRU cache of the forecasts of clusters with a memory limit. Forecasts
+    are read from the result file (config "f_results"); a forecast beyond the
+    stored horizon is recomputed with the fitted model of the model store.
+    Cached forecasts are invalidated if the size or modification time of the
+    result file has changed since they were loaded.
+    """
+
+    def __init__(self, dict_config, max_bytes):
+        """ Initialize an empty cache
+
+        :param dict_config: config data
+        :type dict_config: Dictionary
+        :param max_bytes: memory limit of all cached forecasts in bytes
+        :type max_bytes: int
+        """
+        self.dict_config = dict_config
+        self.fp_results = os.path.join(
+            dict_config["dir_results_local"],
+            dict_config.get("f_results", "forecast.h5"),
+        )
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.latencies = collections.deque(maxlen=1000)
+
+    def get_forecast(self, cluster_id, days):
+        """ Get the forecast of a cluster for a number of days after the end of
+        its history
+
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        :param days: number of days to be forecasted
+        :type days: int
+        :return: the forecasted time series with columns "ds" and "yhat"
+        :rtype: pandas DataFrame
+        """
+        t_start = time.perf_counter()
+        results_state = self.get_results_state()
+
+        with self.lock:
+            entry = self.entries.get(cluster_id)
+            if entry is not None and entry["results_state"] != results_state:
+                # The result file has been rewritten since
+                self.n_bytes -= self.entries.pop(cluster_id)["n_bytes"]
+                self.stats["invalidations"] += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(cluster_id)
+            is_hit = entry is not None and (
+                entry["end"] >= entry["history_end"] + pd.Timedelta(days=days)
+            )
+            self.stats["hits" if is_hit else "misses"] += 1
+
+        if not is_hit:
+            entry = self.load_entry(cluster_id, days, entry)
+            entry["results_state"] = results_state
+            self.put_entry(cluster_id, entry)
+
+        # Days after the end of the history up to the requested number of days
+        df_fcst = entry["df_fcst"]
+        ds_last = entry["history_end"] + pd.Timedelta(days=days)
+        df_fcst = df_fcst.loc[
+            (df_fcst["ds"] > entry["history_end"]) & (df_fcst["ds"] <= ds_last),
+            ["ds", "yhat"],
+        ]
+
+        with self.lock:
+            self.latencies.append(time.perf_counter() - t_start)
+
+        return df_fcst
+
+    def load_entry(self, cluster_id, days, entry=None):
+        """ Load the forecast of a cluster from the result file or, if the
+        stored horizon is too short, recompute it with the fitted model
+
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        :param days: number of days to be forecasted
+        :type days: int
+        :param entry: cached forecast of the cluster, which is too short
+        :type entry: Dictionary
+        :return: forecast, end of history and last forecasted day
+        :rtype: Dictionary
+        """
+        # A cached forecast is at least as long as the stored one
+        filename = os.path.basename(self.fp_results)
+        if entry is None and os.path.exists(self.fp_results):
+            df_fcst = read_forecast(self.dict_config, [cluster_id], filename=filename)
+            history_end = read_history_end(
+                self.dict_config, [cluster_id], filename=filename
+            ).get(cluster_id, pd.NaT)
+            if not df_fcst.empty and pd.notna(history_end):
+                df_fcst["ds"] = pd.to_datetime(df_fcst["ds"])
+                entry = {
+                    "df_fcst": df_fcst,
+                    "history_end": history_end,
+                    "end": df_fcst["ds"].max(),
+                }
+                if entry["end"] >= history_end + pd.Timedelta(days=days):
+                    return entry
+
+        # Recompute the forecast without fitting
+        if not os.path.exists(get_model_filepath(cluster_id, self.dict_config)):
+            raise KeyError(f"No stored model of cluster ID {cluster_id}")
+        with self.lock:
+            self.stats["recomputes"] += 1
+        model = load_model(cluster_id, self.dict_config)
+        df_fcst = predict_forecast(model, days)[["ds", "y", "yhat"]]
+
+        return {
+            "df_fcst": df_fcst,
+            "history_end": model.history["ds"].max(),
+            "end": df_fcst["ds"].max(),
+        }
+
+    def get_results_state(self):
+        """ Get the state of the result file, i.e. its size and modification
+        time, to detect a rewritten result file
+
+        :return: size and modification time in ns (None if there is no file)
+        :rtype: tuple (int, int)
+        """
+        try:
+            stat = os.stat(self.fp_results)
+        except OSError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns
+
+    def put_entry(self, cluster_id, entry):
+        """ Put the forecast of a cluster into the cache and evict the least
+        recently used forecasts as long as the memory limit is exceeded
+
+        :param cluster_id: a specific cluster ID
+        :type cluster_id: int
+        :param entry: forecast, end of history and last forecasted day
+        :type entry: Dictionary
+        """
+        entry["n_bytes"] = int(entry["df_fcst"].memory_usage(deep=True).sum())
+
+        with self.lock:
+            if cluster_id in self.entries:
+                self.n_bytes -= self.entries.pop(cluster_id)["n_bytes"]
+            self.entries[cluster_id] = entry
+            self.n_bytes += entry["n_bytes"]
+
+            # The latest forecast is kept even if it exceeds the limit alone
+            while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+                _, entry_lru = self.entries.popitem(last=False)
+                self.n_bytes -= entry_lru["n_bytes"]
+                self.stats["evictions"] += 1
+
+    def get_stats(self):
+        """ Get hit rate and latency statistics of the cache
+
+        :return: statistics
+        :rtype: Dictionary
+        """
+        with self.lock:
+            n_requests = self.stats["hits"] + self.stats["misses"]
+            latencies_ms = np.array(self.latencies) * 1000
+
+        return {
+            "requests": n_requests,
+            "hits": self.stats["hits"],
+            "misses": self.stats["misses"],
+            "recomputes": self.stats["recomputes"],
+            "evictions": self.stats["evictions"],
+            "invalidations": self.stats["invalidations"],
+            "hit_rate": self.stats["hits"] / n_requests if n_requests else None,
+            "cached_clusters": len(self.entries),
+            "cached_bytes": self.n_bytes,
+            "max_bytes": self.max_bytes,
+            "latency_ms_p50": np.percentile(latencies_ms, 50)
+            if latencies_ms.size
+            else None,
+            "latency_ms_p95": np.percentile(latencies_ms, 95)
+            if latencies_ms.size
+            else None,
+        }
+
+
+class ForecastRequestHandler(BaseHTTPRequestHandler):
+    """ Handler of HTTP requests to the endpoints /forecast and /stats """
+
+    def do_GET(self):
+        """ Answer a GET request with JSON """
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        cache = self.server.forecast_cache
+
+        if url.path == "/stats":
+            self.send_json(200, cache.get_stats())
+            return
+
+        if url.path != "/forecast":
+            self.send_json(404, {"error": f"Unknown endpoint {url.path}"})
+            return
+
+        try:
+            cluster_id = int(params["cluster_id"][0])
+            days = max(int(params.get("days", ["365"])[0]), 0)
+        except (KeyError, ValueError):
+            self.send_json(400, {"error": "Parameters cluster_id and days required"})
+            return
+
+        try:
+            df_fcst = cache.get_forecast(cluster_id, days)
+        except (KeyError, FileNotFoundError):
+            self.send_json(404, {"error": f"No forecast for cluster ID {cluster_id}"})
+            return
+        except Exception as e:
+            error = f"Forecast of cluster ID {cluster_id} failed"
+            mp.get_logger().error(f"{error}: {e}")
+            self.send_json(500, {"error": error})
+            return
+
+        self.send_json(
+            200,
+            {
+                "cluster_id": cluster_id,
+                "days": days,
+                "ds": df_fcst["ds"].dt.strftime("%Y-%m-%d").tolist(),
+                "yhat": df_fcst["yhat"].astype(float).tolist(),
+            },
+        )
+
+    def send_json(self, status, content):
+        """ Send a JSON response
+
+        :param status: HTTP status code
+        :type status: int
+        :param content: content of the response
+        :type content: Dictionary
+        """
+        body = json.dumps(content, default=float).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Log requests with the application logger """
+        mp.get_logger().info(f"{self.address_string()} {format % args}")
@@ -0,0 +1,144 @@
+"""
+This module contains functions related to the shared result arrays of the
+worker processes, i.e. matrices of clusters x dates in shared memory into which
+the workers write their forecasts instead of returning DataFrames
+
+The module contains the following functions:
+* create_shared_results: preallocates the shared result arrays
+* init_shared_results: makes the shared result arrays available in a worker
+* get_shared_results: returns the shared result arrays of the current process
+* get_shared_arrays: returns numpy views on the shared result arrays
+* write_shared_fcst: writes forecasts into the shared result arrays
+* assemble_fcst_results: converts the shared result arrays into a DataFrame
+"""
+import numpy as np
+import pandas as pd
+from multiprocessing.sharedctypes import RawArray
+from .utils import *
+
+# Shared result arrays of the current worker process
+_dict_shared_results = {}
+
+
+@dec_validation
+@dec_logger
+def create_shared_results(cluster_ids, dict_config):
+    """ Preallocate shared arrays for the original and forecasted values of
+    all clusters (one row per cluster) for all days from the start of the
+    considered period up to the last forecasted day (one column per day)
+
+    :param cluster_ids: cluster IDs to be forecasted
+    :type cluster_ids: list of ints
+    :param dict_config: Dictionary with config data
+    :type dict_config: Dictionary
+    :return: shared arrays and their layout
+    :rtype: Dictionary
+    """
+    date_start = pd.Timestamp(dict_config["ts_input_start"])
+    n_days = (
+        pd.Timestamp(dict_config["ts_input_end"]) - date_start
+    ).days + 1 + dict_config["fcst_days"]
+
+    columns = ["y", "yhat"]
+    if dict_config.get("export_intervals"):
+        columns += ["yhat_lower", "yhat_upper"]
+
+    dict_shared = {
+        "cluster_ids": list(cluster_ids),
+        "date_start": date_start,
+        "shape": (len(cluster_ids), n_days),
+        "arrays": {col: RawArray("d", len(cluster_ids) * n_days) for col in columns},
+    }
+
+    # Days without result are NaN
+    for arr in get_shared_arrays(dict_shared).values():
+        arr.fill(np.nan)
+
+    return dict_shared
+
+
+def init_shared_results(dict_shared):
+    """ Make the shared result arrays available in a worker process (used as
+    initializer of the process pool)
+
+    :param dict_shared: shared arrays and their layout
+    :type dict_shared: Dictionary
+    """
+    _dict_shared_results.clear()
+    _dict_shared_results.update(dict_shared)
+
+
+def get_shared_results():
+    """ Get the shared result arrays of the current process
+
+    :return: shared arrays and their layout (empty if not initialized)
+    :rtype: Dictionary
+    """
+    return _dict_shared_results
+
+
+def get_shared_arrays(dict_shared):
+    """ Get numpy views (no copies) on the shared result arrays
+
+    :param dict_shared: shared arrays and their layout
+    :type dict_shared: Dictionary
+    :return: matrix of clusters x days for every column
+    :rtype: Dictionary (column --> numpy array)
+    """
+    return {
+        col: np.frombuffer(raw, dtype="float64").reshape(dict_shared["shape"])
+        for col, raw in dict_shared["arrays"].items()
+    }
+
+
+@dec_validation
+@dec_logger
+def write_shared_fcst(dict_shared, df_fcst):
+    """ Write original and forecasted values into the shared result arrays;
+    columns of the result arrays not contained in df_fcst are left empty
+
+    :param dict_shared: shared arrays and their layout
+    :type dict_shared: Dictionary
+    :param df_fcst: original and forecasted time series with columns "ds" and
+                    "cluster_id"
+    :type df_fcst: pandas DataFrame
+    """
+    dict_slots = {c: i for i, c in enumerate(dict_shared["cluster_ids"])}
+    slots = df_fcst["cluster_id"].map(dict_slots).values.astype("float64")
+    days = (pd.DatetimeIndex(df_fcst["ds"]) - dict_shared["date_start"]).days.values
+
+    # Ignore unknown clusters and days outside of the arrays
+    is_valid = ~np.isnan(slots) & (days >= 0) & (days < dict_shared["shape"][1])
+    slots = slots[is_valid].astype(int)
+    for col, arr in get_shared_arrays(dict_shared).items():
+        if col in df_fcst.columns:
+            arr[slots, days[is_valid]] = df_fcst[col].values[is_valid]
+
+
+@dec_validation
+@dec_logger
+def assemble_fcst_results(dict_shared):
+    """ Convert the shared result arrays into the result format, i.e. one row
+    for every cluster and day with a forecast or an observed value, ordered by
+    cluster and day; e.g. the first in-sample days of bulk forecasts have no
+    forecast, but their observed values are kept
+
+    :param dict_shared: shared arrays and their layout
+    :type dict_shared: Dictionary
+    :return: the original and forecasted time series for every cluster
+    :rtype: pandas DataFrame
+    """
+    dict_arrays = get_shared_arrays(dict_shared)
+    is_result = ~np.isnan(dict_arrays["yhat"]) | ~np.isnan(dict_arrays["y"])
+    idx_slots, idx_days = np.nonzero(is_result)
+
+    df_fcst_results = pd.DataFrame(
+        {
+            "ds": dict_shared["date_start"] + pd.to_timedelta(idx_days, unit="D"),
+            "cluster_id": np.asarray(dict_shared["cluster_ids"])[idx_slots],
+        }
+    )
+    for col, arr in dict_arrays.items():
+        df_fcst_results[col] = arr[is_result]
+
+    return df_fcst_results
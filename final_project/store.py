@@ -0,0 +1,164 @@
+"""
+This module contains functions related to the persistent local traffic store,
+which contains the daily site records partitioned by date as well as the daily
+traffic aggregated per cluster
+
+The module contains the following functions:
+* ingest_traffic: appends new daily site records to the store and updates the
+                  cluster aggregates
+* rebuild_cluster_aggregates: recalculates all cluster aggregates, e.g. after
+                              a change of the clustering
+* aggregate_traffic: aggregates daily site records per cluster
+* load_cluster_aggregates: loads the daily traffic per cluster from the store
+* get_store_dates: returns the dates contained in the store
+"""
+import glob
+import re
+import pandas as pd
+from .utils import *
+
+
+@dec_validation
+@dec_logger
+def ingest_traffic(df_traffic, dict_so_cluster, dict_config, only_new=True):
+    """ Append daily site records to the date-partitioned store and update
+    the cluster aggregates of these dates. Dates already in the store are
+    replaced, i.e. ingesting the same data twice does not change the store.
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :param only_new: flag indicating if only dates after the last date in the
+                     store shall be ingested
+    :type only_new: bool
+    :return: ingested dates
+    :rtype: list of pandas Timestamps
+    """
+    dir_partitions = os.path.join(dict_config["dir_store"], "traffic")
+    os.makedirs(dir_partitions, exist_ok=True)
+
+    # Ignore dates which are already in the store
+    df_traffic = df_traffic.loc[df_traffic.index.notnull()]
+    store_dates = get_store_dates(dict_config)
+    if only_new and store_dates:
+        df_traffic = df_traffic.loc[df_traffic.index.normalize() > store_dates[-1]]
+    if df_traffic.empty:
+        return []
+
+    # Write one partition per date
+    dates = []
+    for date, df_date in df_traffic.groupby(df_traffic.index.normalize()):
+        fp = os.path.join(dir_partitions, f"date={date:%Y-%m-%d}.h5")
+        df_date.to_hdf(fp, key="df", mode="w")
+        dates.append(date)
+
+    # Replace the cluster aggregates of the ingested dates
+    df_agg = aggregate_traffic(df_traffic, dict_so_cluster)
+    fp_agg = os.path.join(dict_config["dir_store"], "cluster_agg.h5")
+    with pd.HDFStore(fp_agg, mode="a") as store:
+        # Note: PyTables turns "in" lists of more than 31 values into a filter,
+        # which is ignored by remove, i.e. all rows would be removed
+        if "df" in store:
+            for i in range(0, len(dates), 31):
+                batch = dates[i : i + 31]
+                store.remove("df", where="index in batch")
+        store.append("df", df_agg, format="table", data_columns=["cluster_id"])
+
+    return dates
+
+
+@dec_validation
+@dec_logger
+def rebuild_cluster_aggregates(dict_so_cluster, dict_config):
+    """ Recalculate the cluster aggregates of all dates from the partitions of
+    the store, e.g. after a change of the clustering. Partitions are read one
+    after another.
+
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    """
+    fp_agg = os.path.join(dict_config["dir_store"], "cluster_agg.h5")
+    with pd.HDFStore(fp_agg, mode="w") as store:
+        for date in get_store_dates(dict_config):
+            fp = os.path.join(
+                dict_config["dir_store"], "traffic", f"date={date:%Y-%m-%d}.h5"
+            )
+            df_agg = aggregate_traffic(pd.read_hdf(fp, "df"), dict_so_cluster)
+            store.append("df", df_agg, format="table", data_columns=["cluster_id"])
+
+
+@dec_validation
+@dec_logger
+def aggregate_traffic(df_traffic, dict_so_cluster):
+    """ Aggregate daily site records per cluster and date; the total of all
+    sites with a cluster is added with cluster ID -1 (total Germany)
+
+    :param df_traffic: DataFrame with traffic related data and DateTimeIndex
+    :type df_traffic: pandas DataFrame
+    :param dict_so_cluster: dictionary mapping site numbers to cluster IDs
+    :type dict_so_cluster: Dictionary
+    :return: daily traffic per cluster with DateTimeIndex "dt"
+    :rtype: pandas DataFrame with columns "cluster_id" and "gb"
+    """
+    # Assign the cluster ID of every site; sites without cluster are ignored
+    df_sites = pd.DataFrame(
+        {
+            "dt": df_traffic.index.normalize(),
+            "cluster_id": df_traffic["so_number"].map(dict_so_cluster).values,
+            "gb": df_traffic["gb"].values,
+        }
+    ).dropna(subset=["cluster_id"])
+    df_sites["cluster_id"] = df_sites["cluster_id"].astype("int64")
+
+    # Aggregate per cluster and for total Germany
+    df_agg = df_sites.groupby(["dt", "cluster_id"])["gb"].sum().reset_index()
+    df_total = df_sites.groupby("dt")["gb"].sum().reset_index()
+    df_total["cluster_id"] = -1
+
+    df_agg = pd.concat([df_agg, df_total], ignore_index=True, sort=False)
+
+    return df_agg.set_index("dt")[["cluster_id", "gb"]].astype({"gb": "float64"})
+
+
+@dec_validation
+@dec_logger
+def load_cluster_aggregates(dict_config):
+    """ Load the daily traffic per cluster within the configured period from
+    the store
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: daily traffic per cluster with DateTimeIndex "dt"
+    :rtype: pandas DataFrame with columns "cluster_id" and "gb"
+    """
+    ts_start = pd.Timestamp(dict_config["ts_input_start"])
+    ts_end = pd.Timestamp(dict_config["ts_input_end"])
+
+    return pd.read_hdf(
+        os.path.join(dict_config["dir_store"], "cluster_agg.h5"),
+        "df",
+        where="index >= ts_start & index <= ts_end",
+    )
+
+
+@dec_validation
+@dec_logger
+def get_store_dates(dict_config):
+    """ Get the dates of all partitions in the store
+
+    :param dict_config: config data
+    :type dict_config: Dictionary
+    :return: sorted list of dates
+    :rtype: list of pandas Timestamps
+    """
+    filepaths = glob.glob(os.path.join(dict_config["dir_store"], "traffic", "*.h5"))
+    pattern = re.compile(r"date=(\d{4}-\d{2}-\d{2})\.h5$")
+
+    return sorted(
+        pd.Timestamp(m.group(1)) for m in (pattern.search(fp) for fp in filepaths) if m
+    )
@@ -4,7 +4,9 @@ The module contains the following functions:
 * dec_logger: decorator for logging
 * dec_validation: decorator for error handling
 * configure_logger: creates and configures a custom logger
+* get_file_checksum: calculates the MD5 checksum of a file
 """
+import hashlib
 import logging
 import multiprocessing as mp
 import os
@@ -60,7 +62,8 @@ def dec_validation(func):
 
 
 def configure_logger(dict_config):
-    """ Create and configure a logger
+    """ Create and configure a logger once per process; further calls, e.g.
+    for every task of a worker, return the configured logger
 
     :param dict_config: config data
     :type dict_config: Dictionary
@@ -73,6 +76,14 @@ def configure_logger(dict_config):
     # Create a custom logger
     logger = mp.get_logger()
     logger.setLevel(logging.INFO)
+    if getattr(logger, "configured_process", None) == mp.current_process().name:
+        return logger
+
+    # Close the handlers inherited from the parent process (fork)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logger.configured_process = mp.current_process().name
 
     # Console output
     c_handler = logging.StreamHandler(sys.stderr)
@@ -108,3 +119,21 @@ def configure_logger(dict_config):
     logger.addHandler(f_handler_error)
 
     return logger
+
+
+def get_file_checksum(fp, chunk_size=2 ** 20):
+    """ Calculate the MD5 checksum of a file without reading it at once
+
+    :param fp: path of the file
+    :type fp: str
+    :param chunk_size: number of bytes read at once
+    :type chunk_size: int
+    :return: hexadecimal MD5 checksum
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    with open(fp, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
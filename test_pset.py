@@ -3,7 +3,15 @@ import numpy as np
 from moto import mock_s3
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.request import urlopen
 from final_project.process import *
+from final_project.backtesting import *
+from final_project.service import *
+from final_project.pipeline import *
+from final_project.publish import *
+from final_project.cli import get_shard_filepaths, parse_arguments
+import final_project.data
 
 AWS_ACCESS_KEY = "fake_access_key"
 AWS_SECRET_KEY = "fake_secret_key"
@@ -116,6 +124,131 @@ class AwsDownloadTest(TestCase):
             self.assertTrue(self.tempFileContents, content)
 
 
+class AwsUploadTest(TestCase):
+    def setUp(self):
+        # A mock per test, i.e. every test starts with an empty bucket
+        mock = mock_s3()
+        mock.start()
+        self.addCleanup(mock.stop)
+        self.client = boto3.client(
+            "s3",
+            region_name=AWS_REGION,
+            aws_access_key_id=AWS_ACCESS_KEY,
+            aws_secret_access_key=AWS_SECRET_KEY,
+        )
+        self.client.create_bucket(Bucket="cmeier-csci-e-29")
+        final_project.data._dict_uploaded.clear()
+
+    def get_config(self, tmp):
+        dict_config = {
+            "aws_bucket": "cmeier-csci-e-29",
+            "dir_bucket": "final_project",
+            "dir_local": tmp,
+            "dir_results_local": os.path.join(tmp, "fcst_results"),
+            "dir_plot": os.path.join(tmp, "fcst_images"),
+            "f_results": "forecast.h5",
+            "s3_publish_interval": 0.05,
+        }
+        os.makedirs(dict_config["dir_results_local"])
+        os.makedirs(dict_config["dir_plot"])
+        return dict_config
+
+    def test_upload_results_aws(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = self.get_config(tmp)
+            fp_results = os.path.join(dict_config["dir_results_local"], "fcst.h5")
+            fp_plot = os.path.join(dict_config["dir_plot"], "fcst_cluster_1.png")
+            for fp in [fp_results, fp_plot]:
+                with open(fp, "wb") as f:
+                    f.write(b"content")
+
+            uploaded, skipped = upload_results_aws(dict_config, [fp_results, fp_plot])
+            self.assertEqual(
+                uploaded,
+                [
+                    "final_project/fcst_images/fcst_cluster_1.png",
+                    "final_project/fcst_results/fcst.h5",
+                ],
+            )
+            self.assertEqual(skipped, [])
+
+            # Unchanged files are skipped, also according to the object metadata
+            final_project.data._dict_uploaded.clear()
+            with open(fp_plot, "wb") as f:
+                f.write(b"changed")
+            uploaded, skipped = upload_results_aws(dict_config, [fp_results, fp_plot])
+            self.assertEqual(uploaded, ["final_project/fcst_images/fcst_cluster_1.png"])
+            self.assertEqual(skipped, ["final_project/fcst_results/fcst.h5"])
+
+            body = self.client.get_object(Bucket="cmeier-csci-e-29", Key=uploaded[0])
+            self.assertEqual(body["Body"].read(), b"changed")
+
+    def test_result_publisher(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = self.get_config(tmp)
+            with ResultPublisher(dict_config) as publisher:
+                renderer = ForecastRenderer(dict_config)
+                for clu_id in range(3):
+                    fp = os.path.join(dict_config["dir_plot"], f"{clu_id}.png")
+                    with open(fp, "wb") as f:
+                        f.write(b"content")
+                    renderer.add_to_manifest(fp)
+                    time.sleep(0.2)
+
+            self.assertEqual(publisher.n_uploaded, 3)
+            self.assertNotIn("plot_manifest", dict_config)
+            response = self.client.list_objects_v2(Bucket="cmeier-csci-e-29")
+            self.assertEqual(response["KeyCount"], 3)
+
+    def test_result_publisher_error(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = self.get_config(tmp)
+            dict_config["s3_publish_interval"] = 60
+            with open(os.path.join(tmp, "fcst_results/forecast.h5"), "wb") as f:
+                f.write(b"content")
+
+            # The files of a failed run are not uploaded
+            with self.assertRaises(ValueError):
+                with ResultPublisher(dict_config) as publisher:
+                    raise ValueError("failed")
+            self.assertEqual(publisher.n_uploaded, 0)
+            response = self.client.list_objects_v2(Bucket="cmeier-csci-e-29")
+            self.assertEqual(response["KeyCount"], 0)
+
+    def test_get_publish_filepaths(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = self.get_config(tmp)
+            filenames = [
+                "fcst_results/forecast.h5",
+                "fcst_results/forecast_shard_0_of_2.h5",
+                "fcst_results/quality_report.csv",
+                "fcst_images/fcst_cluster_1.png",
+                "fcst_images/plots_clusters_1_to_2.pdf",
+                "fcst_images/fcst_cluster_1.png.tmp",
+            ]
+            for filename in filenames:
+                with open(os.path.join(tmp, filename), "wb") as f:
+                    f.write(b"content")
+            with open(os.path.join(tmp, "fcst_images/stale.png"), "wb") as f:
+                f.write(b"content")
+
+            # Only the result file and the images of the run are published
+            dict_config["plot_manifest"] = os.path.join(tmp, "manifest.txt")
+            renderer = ForecastRenderer(dict_config)
+            for filename in filenames[3:]:
+                renderer.add_to_manifest(os.path.join(tmp, filename))
+            os.remove(os.path.join(tmp, filenames[-1]))
+            filepaths = get_publish_filepaths(dict_config)
+            self.assertEqual(
+                [os.path.relpath(fp, tmp) for fp in filepaths],
+                [
+                    "fcst_images/fcst_cluster_1.png",
+                    "fcst_images/plots_clusters_1_to_2.pdf",
+                    "fcst_results/forecast.h5",
+                ],
+            )
+
+
 class DataTestCase(TestCase):
     def test_no_files(self):
         with TemporaryDirectory() as tmp:
@@ -176,12 +309,794 @@ class DataTestCase(TestCase):
             self.assertEqual(df_test_traffic["y"].iloc[0], 0)
             self.assertEqual(df_test_traffic["yhat"].iloc[0], 0)
 
+    def test_load_cluster_states(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"f_clustering": "clustering.csv", "dir_local": tmp}
+            with open(os.path.join(tmp, "clustering.csv"), "w") as f:
+                f.write(
+                    get_clustering_content()
+                    + "\n444444444;3;50.3;12.1;145233000001;27492;3"
+                    + "\n555555555;3;51.0;13.7;146120000000;27491;3"
+                    + "\n666666666;3;51.0;11.7;160530000000;27490;3"
+                )
+
+            # State of most sites of a cluster; leading zeros may be missing
+            dict_states = load_cluster_states(dict_config)
+            self.assertEqual(dict_states, {1: "NW", 2: "RP", 3: "SN"})
+
+    def test_merge_fcst_results(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_results_local": tmp}
+
+            # Export the results of two shards
+            df_content = get_dataframe_content()
+            export_fcst_results_hdf5(
+                df_content.iloc[:2], dict_config, filename="forecast_shard_0_of_2.h5"
+            )
+            export_fcst_results_hdf5(
+                df_content.iloc[2:], dict_config, filename="forecast_shard_1_of_2.h5"
+            )
+
+            # Merge shards and check that all rows are contained once
+            filepaths = [
+                os.path.join(tmp, f"forecast_shard_{i}_of_2.h5") for i in range(2)
+            ]
+            fp_results = merge_fcst_results_hdf5(filepaths, dict_config)
+            df_merged = pd.read_hdf(fp_results, "df")
+            self.assertEqual(len(df_merged), 5)
+            self.assertEqual(sorted(df_merged["cluster_id"]), [1, 2, 3, 4, 5])
+            self.assertEqual(df_merged["y"].iloc[0], 0)
+
+    def test_read_forecast(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_results_local": tmp}
+            df_export = pd.DataFrame(
+                {
+                    "ds": np.tile(pd.date_range("2019-01-01", periods=4), 3),
+                    "cluster_id": np.repeat([1, 2, -1], 4),
+                    "y": np.nan,
+                    "yhat": np.arange(12, dtype=float),
+                }
+            )
+            export_fcst_results_hdf5(df_export, dict_config)
+
+            # Read only the requested clusters and dates
+            df_fcst = read_forecast(dict_config, [2, -1], "2019-01-02", "2019-01-03")
+            self.assertEqual(len(df_fcst), 4)
+            self.assertEqual(list(df_fcst["yhat"]), [5, 6, 9, 10])
+            self.assertEqual(df_fcst["yhat"].dtype, np.float32)
+            self.assertEqual(df_fcst["y"].iloc[0], 0)
+
+            # Read all clusters and dates
+            df_fcst = read_forecast(dict_config)
+            self.assertEqual(len(df_fcst), 12)
+
+    def test_export_empty_results(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_results_local": tmp}
+
+            # Empty results are exported without a table
+            df_empty = get_dataframe_content().iloc[:0]
+            export_fcst_results_hdf5(df_empty, dict_config, filename="forecast_0.h5")
+            df_fcst = read_forecast(dict_config, [1], filename="forecast_0.h5")
+            self.assertTrue(df_fcst.empty)
+
+            # Empty shards are skipped when merging
+            export_fcst_results_hdf5(
+                get_dataframe_content(), dict_config, filename="forecast_1.h5"
+            )
+            filepaths = [os.path.join(tmp, f"forecast_{i}.h5") for i in range(2)]
+            merge_fcst_results_hdf5(filepaths, dict_config)
+            self.assertEqual(len(read_forecast(dict_config)), 5)
+
+    def test_read_history_end(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_results_local": tmp}
+            df_export = pd.DataFrame(
+                {
+                    "ds": np.tile(pd.date_range("2019-01-01", periods=4), 3),
+                    "cluster_id": np.repeat([1, 2, 3], 4),
+                    "y": [1, 0, np.nan, np.nan, 1, 1, 1, 0] + [np.nan] * 4,
+                    "yhat": np.arange(12, dtype=float),
+                }
+            )
+            export_fcst_results_hdf5(df_export.iloc[:8], dict_config, "f_0.h5")
+            export_fcst_results_hdf5(df_export.iloc[8:], dict_config, "f_1.h5")
+            filepaths = [os.path.join(tmp, f"f_{i}.h5") for i in range(2)]
+            merge_fcst_results_hdf5(filepaths, dict_config)
+
+            # Original values 0 belong to the history, unlike missing values
+            sr_history_end = read_history_end(dict_config)
+            self.assertEqual(sr_history_end[1], pd.Timestamp("2019-01-02"))
+            self.assertEqual(sr_history_end[2], pd.Timestamp("2019-01-04"))
+            self.assertTrue(pd.isna(sr_history_end[3]))
+            self.assertEqual(list(read_history_end(dict_config, [2]).index), [2])
+
     def test_config_data(self):
         config = get_config_data()
         self.assertIsNotNone(config)
         self.assertGreater(len(config), 9)
 
 
+class StoreTestCase(TestCase):
+    def test_ingest_traffic(self):
+        df_traffic = get_fake_timeseries()
+        dict_so_cluster = {1: 1, 2: 2}
+
+        with TemporaryDirectory() as tmp:
+            dict_config = {
+                "dir_store": tmp,
+                "ts_input_start": "2019-01-01",
+                "ts_input_end": "2019-01-05",
+            }
+
+            # Initial ingestion and daily ingestion of the new dates only
+            df_initial = df_traffic.loc[:"2019-01-03"]
+            dates = ingest_traffic(df_initial, dict_so_cluster, dict_config)
+            self.assertEqual(len(dates), 3)
+            dates = ingest_traffic(df_traffic, dict_so_cluster, dict_config)
+            self.assertEqual(len(dates), 2)
+            self.assertEqual(len(get_store_dates(dict_config)), 5)
+
+            # Replacing dates does not duplicate aggregates
+            ingest_traffic(df_traffic, dict_so_cluster, dict_config, only_new=False)
+            df_agg = load_cluster_aggregates(dict_config)
+            self.assertEqual(len(df_agg), 15)
+
+            # Site 3 has no cluster and is not part of total Germany
+            for cluster_id, gb in [(1, 1), (2, 2), (-1, 3)]:
+                df_ts = make_ts(df_agg, {}, cluster_id, dict_config)
+                self.assertEqual(len(df_ts), 5)
+                self.assertTrue((df_ts["gb"] == gb).all())
+
+            # Rebuild with a changed clustering
+            rebuild_cluster_aggregates({1: 1, 2: 1, 3: 1}, dict_config)
+            df_agg = load_cluster_aggregates(dict_config)
+            df_ts = make_ts(df_agg, {}, 1, dict_config)
+            self.assertEqual(df_ts["gb"].iloc[0], 6)
+
+    def test_ingest_many_dates(self):
+        dates = pd.date_range("2019-01-01", periods=100, freq="D").rename("dt")
+        df_traffic = pd.DataFrame({"so_number": 1, "gb": 1.0}, index=dates)
+
+        with TemporaryDirectory() as tmp:
+            dict_config = {
+                "dir_store": tmp,
+                "ts_input_start": "2019-01-01",
+                "ts_input_end": "2019-12-31",
+            }
+
+            # Ingestions of more than 31 dates keep the other stored dates
+            ingest_traffic(df_traffic.iloc[:60], {1: 1}, dict_config)
+            ingest_traffic(df_traffic, {1: 1}, dict_config)
+            self.assertEqual(len(load_cluster_aggregates(dict_config)), 200)
+            ingest_traffic(df_traffic.iloc[60:], {1: 1}, dict_config, only_new=False)
+            df_agg = load_cluster_aggregates(dict_config)
+            self.assertEqual(len(df_agg), 200)
+            self.assertEqual(df_agg.index.nunique(), 100)
+
+
+class CacheTestCase(TestCase):
+    def test_ts_cache(self):
+        df_traffic = get_fake_timeseries()
+        # Gap of one day for cluster 2
+        df_traffic = df_traffic.drop(df_traffic.index[7])
+        dict_so_cluster = {1: 1, 2: 2, 3: 3}
+
+        with TemporaryDirectory() as tmp:
+            dict_config = {"ts_input_start": "2019-01-01", "ts_input_end": "2019-01-05"}
+            dates, cluster_ids, values = build_ts_matrix(
+                df_traffic, dict_so_cluster, dict_config
+            )
+            self.assertEqual(values.shape, (5, 4))
+            self.assertEqual(list(cluster_ids), [-1, 1, 2, 3])
+
+            dict_config["ts_cache"] = os.path.join(tmp, "key")
+            save_ts_matrix(dates, cluster_ids, values, dict_config["ts_cache"])
+
+            # Cached time series equal the pre-processed time series
+            for cluster_id in [-1, 1, 2, 3]:
+                df_ts = make_clean_ts(
+                    make_ts(df_traffic, dict_so_cluster, cluster_id, dict_config)
+                )
+                df_cached = preprocess_data(None, None, cluster_id, dict_config)
+                pd.testing.assert_frame_equal(df_ts, df_cached, check_dtype=False)
+
+            # Unknown clusters have an empty time series
+            df_cached = get_cached_ts(4, dict_config)
+            self.assertEqual(len(df_cached), 0)
+
+
+class RoutingTestCase(TestCase):
+    def get_config(self):
+        return {
+            "fcst_days": 7,
+            "ts_input_start": "2019-01-01",
+            "ts_input_end": "2019-03-31",
+            "rt_min_days": 28,
+            "rt_min_coverage": 0.25,
+            "rt_max_zero_ratio": 0.3,
+            "rt_max_cv": 0.05,
+            "rt_season_days": 7,
+            "rt_ses_alpha": 0.5,
+        }
+
+    def test_route_clusters(self):
+        dict_config = self.get_config()
+        rng = np.random.RandomState(0)
+        values = np.full((90, 5), np.nan)
+        values[:, 0] = 10 + rng.rand(90) * 10  # volatile
+        values[:, 1] = 5  # flat
+        values[:, 2] = np.where(np.arange(90) % 2, 0, 10)  # mostly zero
+        values[-10:, 3] = rng.rand(10)  # short
+        values[-2:, 4] = 1  # too short for a forecast
+
+        df_profile = profile_ts_matrix(values, [1, 2, 3, 4, 5], dict_config)
+        self.assertEqual(df_profile.loc[4, "length"], 10)
+        self.assertAlmostEqual(df_profile.loc[3, "zero_ratio"], 0.5)
+
+        sr_engines = route_clusters(df_profile, dict_config)
+        self.assertEqual(
+            list(sr_engines), ["prophet", "ses", "snaive", "snaive", "skip"]
+        )
+
+    def test_bulk_forecasts(self):
+        dict_config = self.get_config()
+        dates = pd.date_range("2019-01-01", periods=14, freq="D")
+        values = np.full((14, 2), np.nan)
+        values[:, 0] = np.tile(np.arange(7), 2)
+        values[4:10, 1] = 3
+
+        # Seasonal naive repeats the last week after the last day of a cluster
+        df_fcst = forecast_seasonal_naive(dates, [1, 2], values, dict_config)
+        df_fcst_1 = df_fcst[df_fcst["cluster_id"] == 1]
+        self.assertEqual(len(df_fcst_1), 21)
+        self.assertEqual(list(df_fcst_1["yhat"].iloc[-7:]), list(range(7)))
+        self.assertEqual(df_fcst_1["y"].count(), 14)
+        df_fcst_2 = df_fcst[df_fcst["cluster_id"] == 2]
+        self.assertEqual(len(df_fcst_2), 13)
+        self.assertEqual(df_fcst_2["ds"].iloc[-1], pd.Timestamp("2019-01-17"))
+        self.assertTrue((df_fcst_2["yhat"].iloc[-7:] == 3).all())
+
+        # Exponential smoothing forecasts the last level
+        df_fcst = forecast_ses(dates, [1, 2], values, dict_config)
+        df_fcst_2 = df_fcst[df_fcst["cluster_id"] == 2]
+        self.assertTrue((df_fcst_2["yhat"].iloc[1:] == 3).all())
+        self.assertEqual(df_fcst[df_fcst["cluster_id"] == 1]["yhat"].count(), 20)
+
+
+class SharedResultsTestCase(TestCase):
+    def test_shared_results(self):
+        dict_config = {
+            "fcst_days": 2,
+            "ts_input_start": "2019-01-01",
+            "ts_input_end": "2019-01-05",
+        }
+        dict_shared = create_shared_results([1, 2, -1], dict_config)
+        self.assertEqual(dict_shared["shape"], (3, 7))
+
+        # Write the forecasts of two clusters, e.g. from different workers
+        df_fcst = get_dataframe_content().iloc[:2]
+        df_fcst["ds"] = pd.to_datetime(["2019-01-02", "2019-01-07"])
+        df_fcst["cluster_id"] = [-1, 1]
+        init_shared_results(dict_shared)
+        self.addCleanup(init_shared_results, {})
+        write_shared_fcst(get_shared_results(), df_fcst)
+        df_fcst["ds"] = pd.to_datetime(["2018-12-31", "2019-01-01"])
+        df_fcst["cluster_id"] = [1, 3]
+        write_shared_fcst(dict_shared, df_fcst)
+
+        # Days without a forecast are kept if they have an observed value
+        df_fcst = pd.DataFrame(
+            {"ds": pd.to_datetime(["2019-01-03"]), "cluster_id": [2], "y": [5.0]}
+        )
+        df_fcst["yhat"] = np.nan
+        write_shared_fcst(dict_shared, df_fcst)
+
+        # Results are ordered by cluster slot and date; the forecast of
+        # cluster -1 without y and yhat and the unknown cluster 3 are ignored
+        df_results = assemble_fcst_results(dict_shared)
+        self.assertEqual(list(df_results["cluster_id"]), [1, 2])
+        self.assertEqual(
+            list(df_results["ds"]), list(pd.to_datetime(["2019-01-07", "2019-01-03"]))
+        )
+        self.assertEqual(df_results["yhat"].iloc[0], 8.3)
+        self.assertEqual(df_results["y"].iloc[1], 5.0)
+        self.assertTrue(np.isnan(df_results["yhat"].iloc[1]))
+        self.assertEqual(list(df_results.columns), ["ds", "cluster_id", "y", "yhat"])
+
+
+class ServiceTestCase(TestCase):
+    def get_export(self):
+        return pd.DataFrame(
+            {
+                "ds": np.tile(pd.date_range("2019-01-01", periods=10), 2),
+                "cluster_id": np.repeat([1, 2], 10),
+                "y": np.tile([1.0] * 4 + [0.0] + [np.nan] * 5, 2),
+                "yhat": np.arange(20, dtype=float),
+            }
+        )
+
+    def export_forecast(self, tmp):
+        dict_config = {"dir_results_local": tmp, "dir_models": tmp}
+        export_fcst_results_hdf5(self.get_export(), dict_config)
+        return dict_config
+
+    def test_forecast_cache(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = self.export_forecast(tmp)
+            cache = ForecastCache(dict_config, max_bytes=10 ** 6)
+
+            # Forecast after the end of the history from the result file; the
+            # last original value 0 belongs to the history
+            df_fcst = cache.get_forecast(1, 3)
+            self.assertEqual(list(df_fcst["yhat"]), [5, 6, 7])
+            df_fcst = cache.get_forecast(1, 5)
+            self.assertEqual(len(df_fcst), 5)
+            stats = cache.get_stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+            # Forecasts beyond the stored horizon require a stored model
+            with self.assertRaises(KeyError):
+                cache.get_forecast(1, 6)
+
+            # Least recently used forecasts are evicted
+            cache.max_bytes = cache.n_bytes
+            cache.get_forecast(2, 1)
+            self.assertEqual(list(cache.entries), [2])
+            self.assertEqual(cache.get_stats()["evictions"], 1)
+
+    def test_forecast_cache_invalidation(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_results_local": tmp, "dir_models": tmp}
+            df_export = self.get_export()
+            dict_config["f_results"] = "forecast_90d.h5"
+            export_fcst_results_hdf5(df_export, dict_config, "forecast_90d.h5")
+            cache = ForecastCache(dict_config, max_bytes=10 ** 6)
+            self.assertEqual(list(cache.get_forecast(1, 2)["yhat"]), [5, 6])
+
+            # A rewritten result file invalidates the cached forecasts
+            df_export["yhat"] += 100
+            export_fcst_results_hdf5(df_export, dict_config, "forecast_90d.h5")
+            fp = os.path.join(tmp, "forecast_90d.h5")
+            os.utime(fp, ns=(0, os.stat(fp).st_mtime_ns + 10 ** 9))
+            self.assertEqual(list(cache.get_forecast(1, 2)["yhat"]), [105, 106])
+            self.assertEqual(cache.get_stats()["invalidations"], 1)
+
+    def test_service(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = self.export_forecast(tmp)
+            server = ThreadingHTTPServer(("127.0.0.1", 0), ForecastRequestHandler)
+            server.forecast_cache = ForecastCache(dict_config, max_bytes=10 ** 6)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urlopen(f"{url}/forecast?cluster_id=2&days=2") as response:
+                content = json.loads(response.read())
+            self.assertEqual(content["ds"], ["2019-01-06", "2019-01-07"])
+            self.assertEqual(content["yhat"], [15, 16])
+
+            # Unknown clusters are not found; other errors are server errors
+            with open(os.path.join(tmp, "model_cluster_4.pkl.gz"), "w") as f:
+                f.write("no model")
+            for cluster_id, status in [(3, 404), (4, 500)]:
+                with self.assertRaises(HTTPError) as cm:
+                    urlopen(f"{url}/forecast?cluster_id={cluster_id}&days=2")
+                self.assertEqual(cm.exception.code, status)
+                cm.exception.close()
+
+            with urlopen(f"{url}/stats") as response:
+                content = json.loads(response.read())
+            self.assertEqual(content["requests"], 3)
+
+
+class QualityTestCase(TestCase):
+    def get_traffic(self):
+        dates = pd.date_range("2019-01-01", periods=10, freq="D")
+        df_traffic = pd.DataFrame(
+            {
+                "so_number": [1] * 10 + [2] * 10 + [2],
+                "gb": [10, 11, 9, 10, 100, 10, 11, 9, 10, 10]
+                + [5, 0, 5, np.nan, 5, 6, 4, 5, 5, 5]
+                + [7],
+            },
+            index=dates.append(dates).append(dates[[0]]).rename("dt"),
+        )
+        return df_traffic
+
+    def test_clean_traffic(self):
+        dict_config = {"dq_window": "Q", "dq_z_threshold": 5, "dq_fill": "median"}
+        df_clean, df_report = clean_traffic(
+            self.get_traffic(), {1: 1, 2: 2}, dict_config
+        )
+
+        # The last duplicate is kept, outages and spikes are filled with the median
+        self.assertEqual(len(df_clean), 20)
+        self.assertEqual(df_clean.loc["2019-01-01", "gb"].tolist(), [10, 7])
+        self.assertEqual(df_clean.loc["2019-01-05", "gb"].tolist(), [10, 5])
+        self.assertEqual(df_clean.loc["2019-01-02", "gb"].tolist(), [11, 5])
+        self.assertFalse(df_clean["gb"].isnull().any())
+
+        self.assertEqual(list(df_report["cluster_id"]), [1, 2, -1])
+        self.assertEqual(list(df_report["records"]), [10, 11, 21])
+        self.assertEqual(list(df_report["duplicates"]), [0, 1, 1])
+        self.assertEqual(list(df_report["outages"]), [0, 2, 2])
+        self.assertEqual(list(df_report["spikes"]), [1, 0, 1])
+
+        # Masked outages and spikes are removed
+        dict_config["dq_fill"] = "mask"
+        df_clean, _ = clean_traffic(self.get_traffic(), {1: 1, 2: 2}, dict_config)
+        self.assertEqual(len(df_clean), 17)
+
+        # The cleaning is part of the cache key
+        dict_config.update(
+            {
+                "data_quality": True,
+                "dir_local": "",
+                "f_traffic": "",
+                "f_clustering": "",
+                "ts_input_start": "2019-01-01",
+                "ts_input_end": "2019-12-31",
+            }
+        )
+        key_mask = get_ts_cache_key(dict_config)
+        dict_config["dq_fill"] = "median"
+        self.assertNotEqual(get_ts_cache_key(dict_config), key_mask)
+
+    def test_clean_missing_days(self):
+        dates = pd.date_range("2019-01-01", periods=10, freq="D")
+        df_traffic = pd.DataFrame(
+            {"so_number": [1] * 10 + [2] * 8, "gb": [10] * 9 + [100] + [5] * 8},
+            index=dates.append(dates[[0, 1, 2, 5, 6, 7, 8, 9]]).rename("dt"),
+        )
+        dict_config = {"dq_window": "Q", "dq_z_threshold": 5, "dq_fill": "median"}
+        df_clean, df_report = clean_traffic(df_traffic, {1: 1, 2: 2}, dict_config)
+
+        # Missing days of a site are filled; a spike of constant traffic (MAD
+        # 0) is detected with the mean absolute deviation
+        self.assertEqual(len(df_clean), 20)
+        self.assertEqual(df_clean.index.name, "dt")
+        self.assertEqual(df_clean.loc["2019-01-04", "gb"].tolist(), [10, 5])
+        self.assertEqual(df_clean.loc["2019-01-10", "gb"].tolist(), [10, 5])
+        self.assertEqual(list(df_report["records"]), [10, 8, 18])
+        self.assertEqual(list(df_report["missing"]), [0, 2, 2])
+        self.assertEqual(list(df_report["spikes"]), [1, 0, 1])
+        self.assertEqual(df_report["outage_ratio"].iloc[1], 0.2)
+
+        # Masked missing days and spikes are removed
+        dict_config["dq_fill"] = "mask"
+        df_clean, _ = clean_traffic(df_traffic, {1: 1, 2: 2}, dict_config)
+        self.assertEqual(len(df_clean), 17)
+
+    def test_clean_outage_period(self):
+        dates = pd.date_range("2019-03-29", periods=6, freq="D")
+        df_traffic = pd.DataFrame(
+            {"so_number": [1] * 6 + [2] * 2, "gb": [4, 6, 5, 0, 0, 0, 0, 0]},
+            index=dates.append(dates[:2]).rename("dt"),
+        )
+        dict_config = {"dq_window": "Q", "dq_z_threshold": 5, "dq_fill": "median"}
+        df_clean, df_report = clean_traffic(df_traffic, {1: 1, 2: 2}, dict_config)
+
+        # A quarter without valid records is filled with the median of the
+        # site; records of a site without any valid record are removed
+        self.assertEqual(df_clean["so_number"].tolist(), [1] * 6)
+        self.assertEqual(df_clean["gb"].tolist(), [4, 6, 5, 5, 5, 5])
+        self.assertEqual(list(df_report["outages"]), [3, 2, 5])
+        self.assertEqual(list(df_report["unfilled"]), [0, 2, 2])
+
+
+class RenderingTestCase(TestCase):
+    class FakeModel:
+        def predict_seasonal_components(self, df):
+            return pd.DataFrame({"weekly": np.zeros(len(df)), "yearly": 0.1})
+
+    def get_fcst(self, n_days=30):
+        dates = pd.date_range("2019-01-01", periods=n_days, freq="D")
+        yhat = np.linspace(1, 2, n_days)
+        return pd.DataFrame(
+            {
+                "ds": dates,
+                "y": np.where(np.arange(n_days) < 20, yhat, np.nan),
+                "yhat": yhat,
+                "yhat_lower": yhat - 0.1,
+                "yhat_upper": yhat + 0.1,
+                "trend": yhat,
+            }
+        )
+
+    def test_render_files(self):
+        with TemporaryDirectory() as tmp:
+            # One figure per plot type is reused for all clusters
+            with ForecastRenderer({"dir_plot": tmp}) as renderer:
+                renderer.render(self.FakeModel(), self.get_fcst(), 1)
+                fig = renderer.figures["fcst"]
+                renderer.render(self.FakeModel(), self.get_fcst(40), 2)
+                self.assertIs(renderer.figures["fcst"], fig)
+                self.assertEqual(len(fig.axes[0].collections), 1)
+            self.assertEqual(renderer.figures, {})
+            self.assertEqual(
+                sorted(os.listdir(tmp)),
+                [
+                    "components_cluster_1.png",
+                    "components_cluster_2.png",
+                    "fcst_cluster_1.png",
+                    "fcst_cluster_2.png",
+                ],
+            )
+
+    def test_render_packed(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_plot": tmp, "plot_pack": "pdf", "plot_dpi": 20}
+            with ForecastRenderer(dict_config, "a") as renderer:
+                for clu_id in range(3):
+                    renderer.render(self.FakeModel(), self.get_fcst(), clu_id)
+            self.assertEqual(os.listdir(tmp), ["plots_a.pdf"])
+
+        # The PDF is added to the manifest once it is completely written
+        with TemporaryDirectory() as tmp, TemporaryDirectory() as tmp_logs:
+            fp_manifest = os.path.join(tmp_logs, "manifest.txt")
+            dict_pdf = dict(dict_config, dir_plot=tmp, plot_manifest=fp_manifest)
+            with ForecastRenderer(dict_pdf, "a") as renderer:
+                renderer.render(self.FakeModel(), self.get_fcst(), 1)
+                self.assertFalse(os.path.exists(fp_manifest))
+            with open(fp_manifest) as f:
+                self.assertEqual(f.read(), os.path.join(tmp, "plots_a.pdf") + "\n")
+
+        # Atlases contain at most plot_atlas_size plots
+        with TemporaryDirectory() as tmp:
+            dict_config = dict(
+                dict_config,
+                dir_plot=tmp,
+                plot_pack="atlas",
+                plot_atlas_size=2,
+                plot_atlas_cols=2,
+            )
+            with ForecastRenderer(dict_config, "a") as renderer:
+                for clu_id in range(3):
+                    renderer.render(self.FakeModel(), self.get_fcst(), clu_id)
+            self.assertEqual(len(os.listdir(tmp)), 4)
+            atlas = mimage.imread(os.path.join(tmp, "fcst_atlas_a_000.png"))
+            self.assertEqual(atlas.shape[:2], (6 * 20, 2 * 10 * 20))
+
+
+class ProfilingTestCase(TestCase):
+    def test_memory_profiler(self):
+        with TemporaryDirectory() as tmp:
+            dict_config = {"dir_logs": tmp, "profile_memory": True, "mem_top_n": 3}
+
+            # Allocations of a section are recorded with their location
+            with MemoryProfiler("stage load", dict_config) as profiler:
+                data = [np.ones(2 ** 18) for _ in range(4)]
+            self.assertEqual(len(data), 4)
+            self.assertGreaterEqual(profiler.record["traced_peak_mb"], 8)
+            self.assertGreater(profiler.record["rss_peak_mb"], 0)
+            self.assertEqual(len(profiler.record["top_allocations"]), 3)
+            self.assertFalse(tracemalloc.is_tracing())
+
+            # Inactive profilers record nothing
+            with MemoryProfiler("stage plot", {"dir_logs": tmp}) as profiler:
+                pass
+            self.assertIsNone(profiler.record)
+
+            summary = summarize_memory_profile(dict_config)
+            self.assertIn("stage load", summary)
+            self.assertNotIn("stage plot", summary)
+            with open(os.path.join(tmp, "memory_profile.json")) as f:
+                self.assertEqual(len(json.load(f)["sections"]), 1)
+
+    def test_map_with_budget(self):
+        tasks = [[i, i] for i in range(6)]
+
+        # All tasks are completed even if the budget is always exceeded
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            results = map_with_budget(executor, sum, tasks, 1, 2)
+            self.assertEqual(sorted(results), [0, 2, 4, 6, 8, 10])
+
+
+class PipelineTestCase(TestCase):
+    def get_stages(self, calls):
+        def record(name, output):
+            def func(dict_config, *dep_outputs):
+                calls.append(name)
+                return output
+
+            return func
+
+        return [
+            {
+                "name": "inputs",
+                "func": lambda dict_config: dict_config["checksum"],
+                "deps": [],
+                "config_keys": [],
+                "mode": "always",
+            },
+            {
+                "name": "load",
+                "func": record("load", 1),
+                "deps": ["inputs"],
+                "config_keys": [],
+                "mode": "lazy",
+            },
+            {
+                "name": "fcst",
+                "func": record("fcst", 2),
+                "deps": ["load"],
+                "config_keys": ["fcst_days"],
+                "mode": "cached",
+            },
+            {
+                "name": "plot",
+                "func": record("plot", 3),
+                "deps": ["fcst"],
+                "config_keys": ["dir_plot"],
+                "mode": "cached",
+            },
+            {
+                "name": "export",
+                "func": record("export", 4),
+                "deps": ["fcst"],
+                "config_keys": [],
+                "mode": "cached",
+            },
+        ]
+
+    def test_run_pipeline(self):
+        with TemporaryDirectory() as tmp:
+            calls = []
+            stages = self.get_stages(calls)
+            dict_config = {
+                "dir_cache": tmp,
+                "checksum": "a",
+                "fcst_days": 10,
+                "dir_plot": "x",
+            }
+
+            # First run executes every stage, a second run none
+            run_pipeline(dict_config, stages)
+            self.assertEqual(sorted(calls), ["export", "fcst", "load", "plot"])
+            calls.clear()
+            dict_plan = run_pipeline(dict_config, stages)
+            self.assertEqual(calls, [])
+            self.assertFalse(any(node["run"] for node in dict_plan.values()))
+
+            # Changed plot settings only invalidate the plot stage
+            dict_config["dir_plot"] = "y"
+            run_pipeline(dict_config, stages)
+            self.assertEqual(calls, ["plot"])
+
+            # Dry runs execute nothing
+            calls.clear()
+            dict_config["checksum"] = "b"
+            dict_plan = run_pipeline(dict_config, stages, dry_run=True)
+            self.assertEqual(calls, [])
+            self.assertEqual(
+                [name for name, node in dict_plan.items() if node["run"]],
+                ["load", "fcst", "plot", "export"],
+            )
+
+            # Forced stages are executed together with their dependents
+            dict_config["checksum"] = "a"
+            run_pipeline(dict_config, stages, force=["plot"])
+            self.assertEqual(calls, ["plot"])
+            with self.assertRaises(Exception):
+                run_pipeline(dict_config, stages, force=["unknown"])
+
+    def test_pipeline_stages(self):
+        stages = {stage["name"]: stage for stage in get_pipeline_stages()}
+
+        # Plots are rendered by the forecast stage with the models of its run
+        self.assertNotIn("plot", stages)
+        for key in ["dir_plot", "plot_dpi", "plot_pack"]:
+            self.assertIn(key, stages["forecast"]["config_keys"])
+        self.assertNotIn("dir_models", stages["forecast"]["config_keys"])
+        self.assertNotIn("publish", stages)
+
+    def test_check_export(self):
+        with TemporaryDirectory() as tmp:
+            calls = []
+            fp = os.path.join(tmp, "forecast.h5")
+
+            def export(dict_config, *dep_outputs):
+                calls.append("export")
+                with open(fp, "w") as f:
+                    f.write("a")
+                return fp, get_file_checksum(fp)
+
+            stages = [
+                {
+                    "name": "export",
+                    "func": export,
+                    "check": check_export,
+                    "deps": [],
+                    "config_keys": [],
+                    "mode": "cached",
+                }
+            ]
+            dict_config = {"dir_cache": tmp}
+            run_pipeline(dict_config, stages)
+            run_pipeline(dict_config, stages)
+            self.assertEqual(calls, ["export"])
+
+            # An overwritten or deleted result file invalidates the export
+            with open(fp, "w") as f:
+                f.write("b")
+            run_pipeline(dict_config, stages)
+            os.remove(fp)
+            run_pipeline(dict_config, stages)
+            self.assertEqual(calls, ["export"] * 3)
+
+
+class CliTestCase(TestCase):
+    def test_parse_arguments(self):
+        # A subcommand after a forced stage is not taken as a stage
+        args = parse_arguments(["--force", "forecast", "predict"])
+        self.assertEqual((args.command, args.force), ("predict", ["forecast"]))
+        args = parse_arguments(["--force", "load", "--force", "export"])
+        self.assertEqual((args.command, args.force), (None, ["load", "export"]))
+
+        # The cluster selection is accepted before and after the subcommand
+        args = parse_arguments(["predict", "--clusters", "812", "1013", "-d", "90"])
+        self.assertEqual((args.cluster_ids, args.horizons), ([812, 1013], [90]))
+        args = parse_arguments(
+            ["--shard", "0/2", "predict", "--shard-strategy", "cost"]
+        )
+        self.assertEqual((args.shard, args.shard_strategy), ((0, 2), "cost"))
+        args = parse_arguments(["predict"])
+        self.assertEqual((args.cluster_ids, args.shard), (None, None))
+        args = parse_arguments(["backtest", "--clusters", "812", "--horizons", "30"])
+        self.assertEqual((args.cluster_ids, args.horizons), ([812], [30]))
+
+        # The cluster aggregates of the traffic store cannot be cleaned
+        with self.assertRaises(SystemExit):
+            parse_arguments(["--use-store"])
+        args = parse_arguments(["--use-store", "--no-data-quality"])
+        self.assertFalse(args.data_quality)
+
+
+    def test_get_shard_filepaths(self):
+        with TemporaryDirectory() as tmp:
+            filenames = [
+                "forecast.h5",
+                "forecast_shard_1_of_2.h5",
+                "forecast_shard_0_of_2.h5",
+                "forecast_shard_0_of_2_90d.h5",
+            ]
+            for filename in filenames:
+                open(os.path.join(tmp, filename), "w").close()
+
+            # Only the shards of one run without horizon suffix are merged
+            self.assertEqual(
+                [os.path.basename(fp) for fp in get_shard_filepaths(tmp)],
+                ["forecast_shard_0_of_2.h5", "forecast_shard_1_of_2.h5"],
+            )
+
+            # Shard files of several runs or missing shards are rejected
+            open(os.path.join(tmp, "forecast_shard_0_of_3.h5"), "w").close()
+            with self.assertRaises(ValueError):
+                get_shard_filepaths(tmp)
+            os.remove(os.path.join(tmp, "forecast_shard_0_of_2.h5"))
+            os.remove(os.path.join(tmp, "forecast_shard_1_of_2.h5"))
+            with self.assertRaises(ValueError):
+                get_shard_filepaths(tmp)
+
+
+class LoggerTestCase(TestCase):
+    def test_configure_logger(self):
+        logger = mp.get_logger()
+        self.addCleanup(setattr, logger, "configured_process", None)
+        with TemporaryDirectory() as tmp:
+            # Handlers are added only once per process, e.g. for all tasks
+            for _ in range(50):
+                configure_logger({"dir_logs": tmp})
+            self.assertEqual(len(logger.handlers), 3)
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+
+
 class ProcessTestCase(TestCase):
     def test_get_number_processes(self):
         n_cpus = mp.cpu_count()
@@ -211,6 +1126,42 @@ class ProcessTestCase(TestCase):
         chunks = get_cluster_chunks(test_ids, n_processes)
         self.assertEqual(len(chunks), 1)
 
+    def test_select_cluster_ids(self):
+        dict_so_cluster = {"1": 1, "2": 2, "3": 3, "4": 3}
+
+        # All cluster IDs including total Germany
+        cluster_ids = select_cluster_ids(dict_so_cluster, {}, subset=False)
+        self.assertEqual(cluster_ids, [1, 2, 3, -1])
+
+        # Explicit cluster IDs
+        dict_config = {"cluster_ids": [3, 1]}
+        cluster_ids = select_cluster_ids(dict_so_cluster, dict_config)
+        self.assertEqual(cluster_ids, [1, 3])
+        with self.assertRaises(Exception):
+            select_cluster_ids(dict_so_cluster, {"cluster_ids": [5]})
+
+    def test_get_shard(self):
+        dict_so_cluster = {str(i): i % 7 for i in range(100)}
+        cluster_ids = list(range(7)) + [-1]
+
+        for strategy in ["hash", "cost"]:
+            # Shards are disjoint, complete and deterministic
+            shards = [
+                get_shard(cluster_ids, dict_so_cluster, i, 3, strategy)
+                for i in range(3)
+            ]
+            self.assertEqual(sorted(sum(shards, [])), sorted(cluster_ids))
+            self.assertEqual(
+                shards[1], get_shard(cluster_ids, dict_so_cluster, 1, 3, strategy)
+            )
+
+        # Total Germany is the most expensive cluster and has its own shard
+        shard = get_shard(cluster_ids, dict_so_cluster, 0, 3, "cost")
+        self.assertEqual(shard, [-1])
+
+        with self.assertRaises(Exception):
+            get_shard(cluster_ids, dict_so_cluster, 3, 3)
+
     def test_start_process(self):
         # Set-up
         df_traffic = get_fake_timeseries()
@@ -246,6 +1197,40 @@ class ProcessTestCase(TestCase):
             fp_plot = os.path.join(tmp, f"fcst_cluster_{clusters[0]}.png")
             assert os.path.exists(fp_plot)
 
+    def test_start_predict(self):
+        # Set-up
+        df_traffic = get_fake_timeseries()
+        dict_so_cluster = {1: 1, 2: 2}
+
+        with TemporaryDirectory() as tmp:
+            dict_config = {
+                "fcst_days": 1,
+                "dir_plot": tmp,
+                "dir_logs": tmp,
+                "dir_models": tmp,
+                "ts_input_start": "2019-01-01",
+                "ts_input_end": "2019-01-05",
+            }
+            # Fit and store models
+            start_process(
+                df_traffic, dict_so_cluster, dict_config, max_processes=1, subset=False
+            )
+            self.assertEqual(get_stored_cluster_ids(dict_config), [-1, 1, 2])
+
+            # Forecast two horizons with stored models, i.e. without fitting
+            dict_results = start_predict(dict_config, [2, 10], max_processes=1)
+            df_results = dict_results[10]
+            df_result = df_results[df_results["cluster_id"] == 1]
+            self.assertEqual(len(df_result), 15)
+            self.assertEqual(df_result["y"].count(), 5)
+            df_results = dict_results[2]
+            self.assertEqual(len(df_results[df_results["cluster_id"] == 1]), 7)
+
+            # With a memory budget, chunks are submitted as the budget allows
+            dict_config["mem_budget_mb"] = 1
+            dict_results_budget = start_predict(dict_config, [2, 10], max_processes=1)
+            self.assertEqual(len(dict_results_budget[10]), len(dict_results[10]))
+
 
 class PreProcessingTestCase(TestCase):
     def test_make_ts(self):
@@ -286,3 +1271,111 @@ class PreProcessingTestCase(TestCase):
 
             # Check that time series does not contain any NaN value
             self.assertFalse(df_ts_clean["gb"].isnull().any())
+
+
+class BacktestTestCase(TestCase):
+    def test_get_cutoffs(self):
+        dates = pd.date_range("2019-01-01", "2019-12-31", freq="D")
+        df_ts = pd.DataFrame({"gb": 1.0}, index=dates)
+        dict_config = {
+            "bt_initial_days": 180,
+            "bt_period_days": 30,
+            "bt_horizons": [7, 30],
+        }
+
+        # Last cutoff leaves the largest horizon, first one the initial days
+        cutoffs = get_cutoffs(df_ts, dict_config)
+        self.assertEqual(cutoffs[-1], pd.Timestamp("2019-12-01"))
+        self.assertGreaterEqual(cutoffs[0], pd.Timestamp("2019-06-30"))
+        self.assertEqual(len(cutoffs), 6)
+
+        # Warm-start combines all cutoffs of a cluster to one task
+        tasks = get_backtest_tasks({1: df_ts, 2: df_ts.iloc[:10]}, dict_config)
+        self.assertEqual(len(tasks), 6)
+        dict_config["bt_warm_start"] = True
+        tasks = get_backtest_tasks({1: df_ts, 2: df_ts.iloc[:10]}, dict_config)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(len(tasks[0][2]), 6)
+
+    def test_calc_error_metrics(self):
+        dates = pd.date_range("2019-01-01", periods=6, freq="D")
+        df_ts_prophet = pd.DataFrame({"ds": dates, "y": [1, 1, 2, 4, 0, 5]})
+        df_fcst = pd.DataFrame({"ds": dates, "yhat": [1, 1, 1, 2, 1, 5]})
+
+        df_metrics = calc_error_metrics(
+            df_fcst, df_ts_prophet, pd.Timestamp("2019-01-02"), [2, 4]
+        )
+        self.assertEqual(list(df_metrics["n"]), [2, 4])
+        self.assertAlmostEqual(df_metrics["mape"].iloc[0], 0.5)
+        self.assertAlmostEqual(df_metrics["rmse"].iloc[0], math.sqrt(2.5))
+        self.assertAlmostEqual(df_metrics["mape"].iloc[1], 1 / 3)
+
+    def test_export_backtest_metrics(self):
+        with TemporaryDirectory() as tmp:
+            fp_metrics = os.path.join(tmp, "metrics.csv")
+            df_metrics = pd.DataFrame(
+                {
+                    "cluster_id": [1, 1],
+                    "cutoff": ["2019-01-01", "2019-01-01"],
+                    "horizon": [7, 30],
+                    "n": [7, 30],
+                    "mape": [0.1, 0.2],
+                    "rmse": [1.0, 2.0],
+                }
+            )
+
+            # Metrics of two tasks are appended to the same file
+            export_backtest_metrics(df_metrics, fp_metrics)
+            df_metrics["mape"] = [0.3, 0.4]
+            export_backtest_metrics(df_metrics, fp_metrics)
+
+            df_summary = summarize_backtest_metrics(fp_metrics)
+            self.assertEqual(len(df_summary), 2)
+            self.assertEqual(list(df_summary["cutoffs"]), [2, 2])
+            self.assertAlmostEqual(df_summary["mape"].iloc[0], 0.2)
+
+
+class ModelGridTestCase(TestCase):
+    def test_select_variant(self):
+        df_variants = pd.DataFrame(
+            {"variant": ["a", "b", "c"], "mape": [0.3, 0.1, 0.2], "rmse": [1, 2, 1]}
+        )
+
+        # The variant with the lowest error; the first one of a tie
+        self.assertEqual(select_variant(df_variants, "mape"), 1)
+        self.assertEqual(select_variant(df_variants, "rmse"), 0)
+
+        # Failed variants without error are not selected; the first variant if
+        # no variant could be measured
+        df_variants["mape"] = [np.nan, np.nan, 0.5]
+        self.assertEqual(select_variant(df_variants, "mape"), 2)
+        df_variants["mape"] = np.nan
+        self.assertEqual(select_variant(df_variants, "mape"), 0)
+
+    def test_forecast_grid(self):
+        dates = pd.date_range("2019-01-01", periods=60, freq="D")
+        df_ts = pd.DataFrame({"gb": np.arange(60, dtype=float) + 10}, index=dates)
+        dict_config = {
+            "fcst_days": 5,
+            "mg_holdout_days": 10,
+            "mg_metric": "rmse",
+            "model_grid": [
+                # Logistic growth requires a capacity, i.e. its fit fails
+                {"name": "logistic", "growth": "logistic"},
+                {"name": "linear", "seasonality_mode": "additive"},
+                {"name": "flat", "seasonality_mode": "additive", "n_changepoints": 0},
+            ],
+        }
+
+        # The failed variant is not selected; without state holidays in the
+        # grid no holidays are computed
+        n_misses = get_regional_holidays.cache_info().misses
+        df_fcst, model, df_variants = forecast_grid(df_ts, dict_config, "BY")
+        self.assertEqual(get_regional_holidays.cache_info().misses, n_misses)
+        self.assertTrue(np.isnan(df_variants["rmse"].iloc[0]))
+        self.assertEqual(df_variants["selected"].sum(), 1)
+        self.assertFalse(df_variants["selected"].iloc[0])
+        self.assertEqual(
+            df_variants["selected"].idxmax(), df_variants["rmse"].idxmin()
+        )
+        self.assertEqual(len(df_fcst), 65)